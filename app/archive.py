@@ -0,0 +1,128 @@
+import io
+import re
+import asyncio
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from app.log import get_logger
+
+logger = get_logger('app.archive')
+
+
+# ZIP archives of a group streamed as they're built, for GET /image_groups/{group_id}/archive. The JPEGs are stored
+# without compression (they don't compress) so every byte read from S3 is written out as it comes. The next objects
+# are fetched while the current one is written, each in a thread reading chunks into a bounded buffer, so the memory
+# is READ_AHEAD * BUFFERED_CHUNKS * CHUNK_SIZE at most whatever the size of the group, and the download starts with
+# the first chunk instead of after the whole archive is ready.
+
+CHUNK_SIZE = 1024 * 1024
+READ_AHEAD = 4 # objects fetched at the same time, the one being written and the next ones
+BUFFERED_CHUNKS = 4 # chunks read ahead of the writing for each object
+DONE = object() # end of an object in its buffer
+
+# unseekable file zipfile writes into, what's written is taken out after each write so nothing accumulates.
+# zipfile writes the sizes and CRC of the entries in data descriptors after them since it can't seek back
+class ZipSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+# a name safe for a file and a Content-Disposition header
+def archive_name(name):
+    return re.sub(r'[^\w.-]+', '_', name or '').strip('_') or 'images'
+
+# an object read in a thread into a buffer of at most `buffered` chunks, the reading waits for the writing to
+# take the chunks out and stops when the archive is abandoned
+class Prefetch:
+    def __init__(self, file, buffered, stop):
+        self.file = file
+        self.chunks = asyncio.Queue()
+        self.slots = threading.Semaphore(buffered)
+        self.stop = stop
+        self.loop = asyncio.get_running_loop()
+
+    def put(self, item):
+        while not self.slots.acquire(timeout=0.5):
+            if self.stop.is_set():
+                return False
+        self.loop.call_soon_threadsafe(self.chunks.put_nowait, item)
+        return True
+
+    def read(self, read_chunks, chunk_size): # in the thread
+        try:
+            for chunk in read_chunks(self.file['key'], chunk_size):
+                if self.stop.is_set() or not self.put(chunk):
+                    return
+            self.put(DONE)
+        except Exception as e: # handed over to the writing
+            self.put(e)
+
+    async def get(self):
+        item = await self.chunks.get()
+        self.slots.release()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+# the ZIP of the files ({name, key, size, last_modified}) as chunks of bytes, read_chunks(key, chunk_size) is a blocking
+# generator of the bytes of an object. Objects missing when they're read (FileNotFoundError) are left out.
+async def zip_stream(files, read_chunks, executor=None, read_ahead=READ_AHEAD, buffered=BUFFERED_CHUNKS, chunk_size=CHUNK_SIZE):
+    from app.s3_handler import in_executor
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    pool = executor or ThreadPoolExecutor(max_workers=read_ahead, thread_name_prefix='archive')
+    sink = ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED)
+    remaining = iter(files)
+    fetching = deque()
+    def fetch_next():
+        if (file := next(remaining, None)) is not None:
+            prefetch = Prefetch(file, buffered, stop)
+            in_executor(loop, pool, prefetch.read, read_chunks, chunk_size)
+            fetching.append(prefetch)
+
+    written = skipped = 0
+    try:
+        for _ in range(read_ahead):
+            fetch_next()
+        while fetching:
+            prefetch = fetching.popleft()
+            try:
+                chunk = await prefetch.get() # before the entry so a missing object can be left out
+            except FileNotFoundError:
+                logger.warning('Archive file missing', key=prefetch.file['key'])
+                skipped += 1
+                fetch_next()
+                continue
+            info = zipfile.ZipInfo(prefetch.file['name'], date_time=prefetch.file['last_modified'].timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = prefetch.file['size'] # so zipfile knows if the entry needs zip64
+            with archive.open(info, 'w') as entry:
+                while chunk is not DONE:
+                    entry.write(chunk)
+                    yield sink.take()
+                    chunk = await prefetch.get()
+            fetch_next() # its thread is free
+            written += 1
+            if data := sink.take(): # the data descriptor
+                yield data
+        archive.close()
+        yield sink.take() # the central directory
+        logger.info('Archive streamed', files=written, missing=skipped)
+    finally:
+        stop.set() # the client went away or a read failed, the threads stop reading
+        if executor is None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from bson import ObjectId
+
+from app import group_stats, status, log
+from app.processing import BACKFILLED
+
+
+# Bulk ingest of images that are already in the bucket, for migrating the historical archives without uploading them
+# one at a time. Every folder under the source prefix becomes a group (the files right under it go in a group named
+# after the prefix), the groups and image documents are created in bulk, the files are copied to original/ by S3
+# and processed by a pool of workers like the uploads are.
+# Run with: python -m app.backfill <source prefix> [--event EVENT_ID] [--concurrency 8] [--restart] [--dry-run]
+#
+# The keys are processed in the order S3 lists them and the checkpoint is the last key up to which everything is
+# done, so an interrupted backfill resumes from there with StartAfter instead of going through the listing again.
+# It's idempotent either way: the groups are found by their backfill_source and the images already done are skipped.
+# The keys that failed are kept in the checkpoint too and tried again first when it resumes.
+#
+# The copies to original/ are marked with the BACKFILLED metadata so the S3 upload trigger leaves them to the backfill,
+# else both would process the same image at the same time.
+
+logger = log.get_logger('app.backfill')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+CHECKPOINTS = 'backfill_checkpoints' # collection of the checkpoints, by source prefix
+BATCH_SIZE = 500 # keys whose groups and images are created with one bulk insert
+DEFAULT_CONCURRENCY = 8
+REPORT_INTERVAL = 10 # seconds between the progress lines
+
+# the folder of a key under the prefix, and its filename
+def split_key(key, prefix):
+    folder, _, filename = key[len(prefix):].rpartition('/')
+    return folder, filename
+
+def is_image(key):
+    return key.lower().endswith(IMAGE_EXTENSIONS)
+
+# the last key up to which all the keys are done, the workers finish them out of order, and the keys that failed
+class Checkpoint:
+    def __init__(self, collection, source):
+        self.collection = collection
+        self.source = source
+        self.pending = OrderedDict() # key: done, in the listing order
+        document = collection.find_one({'_id': source}) or {}
+        self.after = document.get('after')
+        self.processed = document.get('processed', 0)
+        self.failed_keys = set(document.get('failed_keys', []))
+
+    @property
+    def failed(self):
+        return len(self.failed_keys)
+
+    # the failed keys the listing won't go through again, they're before the checkpoint
+    def retries(self):
+        return sorted(key for key in self.failed_keys if self.after is not None and key <= self.after)
+
+    def reset(self):
+        self.collection.delete_one({'_id': self.source})
+        self.after = None
+        self.processed = 0
+        self.failed_keys = set()
+
+    def start(self, key):
+        self.pending[key] = False
+
+    # a retried key isn't pending, only the failed keys change
+    def finish(self, key, processed=False, failed=False):
+        self.processed += processed
+        if failed:
+            self.failed_keys.add(key)
+        else:
+            self.failed_keys.discard(key)
+        if key not in self.pending:
+            return
+        self.pending[key] = True
+        while self.pending and next(iter(self.pending.values())):
+            self.after, _ = self.pending.popitem(last=False)
+
+    def save(self):
+        self.collection.update_one({'_id': self.source}, {'$set': {
+            'after': self.after,
+            'processed': self.processed,
+            'failed': self.failed,
+            'failed_keys': sorted(self.failed_keys),
+            'updated_at': datetime.now(timezone.utc),
+        }}, upsert=True)
+
+# counts and rates for the progress lines
+class Progress:
+    def __init__(self, total, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.total = total # images to process in this run
+        self.processed = self.failed = self.skipped = 0
+        self.bytes = 0 # downloaded
+        self.megapixels = 0
+
+    def image_processed(self, metrics):
+        self.processed += 1
+        metrics = metrics or {}
+        self.bytes += (metrics.get('bytes') or {}).get('downloaded', 0)
+        self.megapixels += metrics.get('megapixels') or 0
+
+    def summary(self):
+        elapsed = max(self.clock() - self.start, 1e-9)
+        done = self.processed + self.failed
+        rate = done / elapsed
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'total': self.total,
+            'elapsed_s': round(elapsed, 1),
+            'images_per_s': round(rate, 2),
+            'mb_per_s': round(self.bytes / 1_000_000 / elapsed, 2),
+            'megapixels_per_s': round(self.megapixels / elapsed, 2),
+            'eta_s': round((self.total - done) / rate) if rate > 0 else None,
+        }
+
+    def line(self):
+        s = self.summary()
+        eta = f"{s['eta_s']}s" if s['eta_s'] is not None else '-'
+        return (f"{s['processed'] + s['failed']}/{s['total']} images ({s['failed']} failed, {s['skipped']} already done) "
+                f"in {s['elapsed_s']}s: {s['images_per_s']} images/s, {s['mb_per_s']} MB/s, {s['megapixels_per_s']} MP/s, ETA {eta}")
+
+# create the groups and the image documents of a batch of keys, returns the (key, group id, filename) to process
+# and the number of images already done. groups is the folder: group id of the groups found so far
+def prepare_batch(db, source, keys, groups, event=None):
+    groups_collection = db.get_collection('image_groups')
+    images_collection = db.get_collection('images')
+    now = datetime.now(timezone.utc)
+
+    items = [(key, *split_key(key, source)) for key in keys]
+    missing = sorted({folder for _, folder, _ in items if folder not in groups})
+    if missing:
+        for group in groups_collection.find({'backfill_source': {'$in': [source + folder for folder in missing]}}, {'backfill_source': 1}):
+            groups[group['backfill_source'][len(source):]] = group['_id']
+        new_groups = [{
+            'name': folder or source.rstrip('/').rsplit('/', 1)[-1] or now.strftime("%Y-%m-%d"),
+            'backfill_source': source + folder,
+            'created_at': now,
+            'updated_at': now,
+            **({'event': ObjectId(event)} if event is not None else {}),
+        } for folder in missing if folder not in groups]
+        if new_groups:
+            inserted = groups_collection.insert_many(new_groups).inserted_ids
+            for group, group_id in zip(new_groups, inserted):
+                groups[group['backfill_source'][len(source):]] = group_id
+            logger.info('Groups created', groups=len(new_groups), event=event)
+
+    group_ids = list({groups[folder] for _, folder, _ in items})
+    existing = {(image['group'], image['filename']): image.get('status') for image in images_collection.find(
+        {'group': {'$in': group_ids}, 'filename': {'$in': [filename for _, _, filename in items]}}, {'group': 1, 'filename': 1, 'status': 1})}
+    new_images = [{
+        'filename': filename,
+        'data': {},
+        'created_at': now,
+        'updated_at': now,
+        'group': groups[folder],
+        **status.status_fields(status.PENDING),
+    } for _, folder, filename in items if (groups[folder], filename) not in existing]
+    if new_images:
+        images_collection.insert_many(new_images)
+        added = {}
+        for image in new_images:
+            added[image['group']] = added.get(image['group'], 0) + 1
+        for group_id, count in added.items():
+            group_stats.images_added(db, group_id, count)
+
+    to_process = [(key, groups[folder], filename) for key, folder, filename in items if existing.get((groups[folder], filename)) != status.DONE]
+    return to_process, len(items) - len(to_process)
+
+# copy a key to original/ if it isn't there yet and process it, the copy is marked for the upload trigger to skip it
+async def ingest(db, s3, key, group_id, filename):
+    from app.processing import process_image_file
+    original = f"original/{group_id}/{filename}"
+    if not await s3.file_exists(original):
+        await s3.copy_file(key, original, metadata={BACKFILLED: 'true'})
+    return await process_image_file(db, s3, str(group_id), filename)
+
+async def backfill(db, s3, source, event=None, concurrency=DEFAULT_CONCURRENCY, restart=False, dry_run=False,
+                   report=print, report_interval=REPORT_INTERVAL):
+    checkpoint = Checkpoint(db.get_collection(CHECKPOINTS), source)
+    if restart and not dry_run:
+        checkpoint.reset()
+    retries = checkpoint.retries()
+    if checkpoint.after is not None:
+        report(f"Resuming after {checkpoint.after}" + (f", retrying {len(retries)} failed images" if retries else ''))
+    keys = [item['key'] for item in await s3.list_objects(source, start_after=checkpoint.after) if is_image(item['key'])]
+    progress = Progress(len(retries) + len(keys))
+    if dry_run:
+        folders = {split_key(key, source)[0] for key in retries + keys}
+        report(f"{len(retries) + len(keys)} images in {len(folders)} groups to backfill from {source}")
+        return progress.summary()
+
+    queue = asyncio.Queue(maxsize=concurrency * 2) # the listing waits for the workers
+    async def worker():
+        while (item := await queue.get()) is not None:
+            key, group_id, filename = item
+            try:
+                results = await ingest(db, s3, key, group_id, filename)
+                progress.image_processed(results.get('metrics'))
+                checkpoint.finish(key, processed=True)
+            except Exception:
+                logger.exception('Backfill of an image failed', key=key, group=group_id)
+                progress.failed += 1
+                checkpoint.finish(key, failed=True)
+    async def reporter():
+        while True:
+            await asyncio.sleep(report_interval)
+            await asyncio.to_thread(checkpoint.save)
+            report(progress.line())
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    reporting = asyncio.create_task(reporter())
+    groups = {}
+    # the retries first, they're before the checkpoint and don't move it
+    batches = [(retries[start:start + BATCH_SIZE], True) for start in range(0, len(retries), BATCH_SIZE)] + \
+              [(keys[start:start + BATCH_SIZE], False) for start in range(0, len(keys), BATCH_SIZE)]
+    try:
+        for batch, retrying in batches:
+            to_process, skipped = await asyncio.to_thread(prepare_batch, db, source, batch, groups, event)
+            progress.skipped += skipped
+            progress.total -= skipped
+            processing = {key for key, _, _ in to_process}
+            for key in batch: # in the listing order so the checkpoint only moves past finished keys
+                if not retrying:
+                    checkpoint.start(key)
+                if key not in processing:
+                    checkpoint.finish(key)
+            for item in to_process:
+                await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        reporting.cancel()
+        for task in workers:
+            task.cancel()
+        checkpoint.save()
+    report(progress.line())
+    return progress.summary()
+
+def main():
+    from app.db import connect_to_db
+    from app.s3_handler import get_s3_handler
+    parser = argparse.ArgumentParser(description="Create groups and images from the objects under an S3 prefix and process them")
+    parser.add_argument('source', help="Prefix in the bucket to backfill from, each folder under it becomes a group")
+    parser.add_argument('--event', help="Event id for the new groups")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="Images processed at the same time")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint, the images already done are still skipped")
+    parser.add_argument('--dry-run', action='store_true', help="Only count the images and groups")
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL, help="Seconds between the progress lines")
+    args = parser.parse_args()
+
+    source = args.source if args.source.endswith('/') else args.source + '/'
+    db = next(connect_to_db())
+    summary = asyncio.run(backfill(db, get_s3_handler(), source, event=args.event, concurrency=args.concurrency,
+                                   restart=args.restart, dry_run=args.dry_run, report_interval=args.report_interval))
+    logger.info('Backfill finished', event='backfill_finished', source=source, **summary)
+
+if __name__ == '__main__':
+    main()
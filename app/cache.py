@@ -0,0 +1,182 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from app.db import get_db
+
+
+# Response cache for the read endpoints, entries hold the rendered JSON body and its ETag.
+# Lookups go to the in-process LRU first, then to the shared backend if there is one (so other
+# Lambda containers benefit from the same entries). Writes invalidate both.
+#
+# Each entry also has the version of its key when it was read, and the versions are kept in MongoDB
+# (cache_versions) and bumped by every write. An entry is only served while its version is the current one,
+# so a write in another container, or by the processing function, is seen right away even without the shared
+# backend, at the cost of one lookup by _id per read.
+
+VERSIONS = 'cache_versions' # collection of the version of each cache key
+
+# the current version of a cache key, 0 until it's first bumped
+def current_version(db, key):
+    document = db.get_collection(VERSIONS).find_one({'_id': key}, {'version': 1})
+    return (document or {}).get('version', 0)
+
+# a write changed what the keys are rendered from, there are only a few keys per write
+def bump_versions(db, keys):
+    for key in sorted(set(keys)):
+        db.get_collection(VERSIONS).update_one({'_id': key}, {'$inc': {'version': 1}}, upsert=True)
+
+# Interface for the cache backends, a shared backend only needs get, set and delete
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+    def set(self, key, entry, ttl):
+        raise NotImplementedError
+    def delete(self, key):
+        raise NotImplementedError
+
+# In-process LRU with a bound on the number of entries and a TTL on each entry
+class LRUCache(CacheBackend):
+    def __init__(self, max_size=256, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict() # key: (expires, entry), oldest used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires <= self.clock(): # expired
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key) # mark as recently used
+            return entry
+
+    def set(self, key, entry, ttl=None):
+        if self.max_size <= 0: # cache disabled
+            return
+        with self.lock:
+            self.entries[key] = (self.clock() + (ttl or self.ttl), entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size: # evict least recently used
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+# Shared backend using a MongoDB collection, expired entries are removed by a TTL index
+class MongoCacheBackend(CacheBackend):
+    def __init__(self, collection=None):
+        self._collection = collection
+
+    @property
+    def collection(self): # on the client shared by the container, created on first use
+        if self._collection is None:
+            self._collection = get_db().get_collection('response_cache')
+            self._collection.create_index('expires_at', expireAfterSeconds=0)
+        return self._collection
+
+    def get(self, key):
+        document = self.collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}})
+        if document is None:
+            return None
+        return {'etag': document['etag'], 'body': bytes(document['body']), 'version': document.get('version')}
+
+    def set(self, key, entry, ttl):
+        self.collection.replace_one({'_id': key}, {
+            '_id': key,
+            'etag': entry['etag'],
+            'body': entry['body'],
+            'version': entry.get('version'),
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        }, upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+# get the shared backend set by RESPONSE_CACHE_BACKEND, None when there isn't one
+def shared_backend_from_env():
+    backend = os.getenv('RESPONSE_CACHE_BACKEND', '').lower()
+    if backend == 'mongo':
+        return MongoCacheBackend()
+    return None
+
+# strong ETag from the body, the same body always gets the same ETag
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+# check an If-None-Match header against an ETag, If-None-Match uses the weak comparison
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any(tag.removeprefix('W/') == etag.removeprefix('W/') for tag in tags)
+
+class ResponseCache:
+    def __init__(self, max_size=256, ttl=60, shared: CacheBackend = None):
+        self.local = LRUCache(max_size, ttl)
+        self.shared = shared
+        self.ttl = ttl
+        # bumped on every invalidation, a body read before an invalidation isn't stored
+        # so a slow read can't put back what a write just invalidated
+        self.generation = 0
+
+    # the entry of a key, None if there isn't one for the version (from current_version) when it's given
+    def get(self, key, version=None):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is not None and version is not None and entry.get('version') != version:
+            return None # written since, by this container or another one
+        return entry
+
+    # store a rendered body, generation is the value of self.generation and version the version of the key
+    # from before the read
+    def set(self, key, body: bytes, generation=None, version=None):
+        entry = {'etag': make_etag(body), 'body': body, 'version': version}
+        if generation is not None and generation != self.generation:
+            return entry # invalidated while reading, return it without storing
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.ttl)
+        return entry
+
+    # remove the entries of the keys, and bump their versions in db for the other containers
+    def invalidate(self, *keys, db=None):
+        self.generation += 1
+        if db is not None:
+            bump_versions(db, keys)
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    def clear(self):
+        self.generation += 1
+        self.local.clear()
+
+# cache keys for the group and image reads
+def group_key(group_id):
+    return f"group:{group_id}"
+def image_key(image_id):
+    return f"image:{image_id}"
+def event_key(event_id):
+    return f"event:{event_id}"
@@ -3,20 +3,18 @@ from typing import AsyncGenerator
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from contextlib import asynccontextmanager, contextmanager
-from fastapi import FastAPI
+from app import instrumentation, log
 
 load_dotenv() # load environment variables from .env file
+logger = log.get_logger('app.db')
 
 
 # for the database connection
 @asynccontextmanager
-async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+async def lifespan(app) -> AsyncGenerator[None, None]:
     # Start the database connection
-    print(app)
-    print("MongoBD startup")
-    mongo_connection = connect_to_db()
-    print(mongo_connection)
-    app.db = next(mongo_connection)
+    logger.info('MongoDB startup')
+    app.db = get_db()
     app.client = app.db.client
 
     """ app.client = mongo_connection[0]
@@ -25,18 +23,33 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     # Close the database connection
     await shutdown_db_client(app)
 
+# MongoClient shared by everything in the container, it has its own connection pool
+# so it's created once instead of connecting again for every request
+client = None
+
+# get the database from the shared client, connecting on first use
+def get_db():
+    global client
+    if client is None:
+        # the listener times the commands of the requests being profiled
+        client = MongoClient(os.getenv('MONGO_DB_CONNECTION_STRING'), event_listeners=[instrumentation.mongo_listener])
+        logger.info('MongoDB connected')
+    return client.get_database(os.getenv('MONGO_DB_NAME'))
+
+# close the shared client, the next get_db connects again
+def reset_db():
+    global client
+    if client is not None:
+        client.close()
+    client = None
+
 # method to connect to the MongoDb Connection for dependency injection
 def connect_to_db():
-    with MongoClient(os.getenv('MONGO_DB_CONNECTION_STRING')) as client:
-        db = client.get_database(os.getenv('MONGO_DB_NAME'))
-        print(client)
-        print(db)
-        print("MongoDB connected.")
-        yield db
+    yield get_db()
 
 
 
 # method to close the database connection
 async def shutdown_db_client(app):
-    app.client.close()
-    print("Database disconnected.")
\ No newline at end of file
+    reset_db()
+    logger.info('MongoDB disconnected')
\ No newline at end of file
@@ -0,0 +1,107 @@
+from bson.objectid import ObjectId
+
+
+# Near-duplicate detection for bursts and images uploaded twice, with a perceptual hash of every image.
+# The hash is a 64 bit dHash: the thumbnail is reduced to 9x8 grey pixels and each bit says if a pixel is
+# brighter than its left neighbour, so it survives resizing, recompression and small exposure changes.
+# Similar images have hashes a few bits apart, the search uses a BK-tree to only compare the hashes that can be
+# within the distance instead of every pair.
+
+HASH_SIZE = 8 # bits per row and rows, 64 bits
+DEFAULT_MAX_DISTANCE = 6 # differing bits still counted as the same picture
+PHASH = 'data.phash'
+
+# dHash of a PIL image as 16 hex digits, numpy and Pillow are only imported by the processing
+def dhash(image, size=HASH_SIZE):
+    import numpy as np
+    from PIL import Image
+    pixels = np.asarray(image.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1] # brighter than the pixel on the left
+    return np.packbits(bits).tobytes().hex()
+
+def hamming(a: int, b: int):
+    return (a ^ b).bit_count()
+
+# BK-tree over the hashes, children are keyed by their distance to the node so a search only visits the
+# children whose distance is within max_distance of the query's distance to the node (triangle inequality)
+class BKTree:
+    def __init__(self):
+        self.root = None # [hash, items, {distance: child}]
+
+    def add(self, hash: int, item):
+        if self.root is None:
+            self.root = [hash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash, [item], {}]
+                return
+            node = child
+
+    # items within max_distance of hash, as (distance, item)
+    def search(self, hash: int, max_distance: int):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_hash, items, children = stack.pop()
+            distance = hamming(hash, node_hash)
+            if distance <= max_distance:
+                found.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+# sets of near-duplicates in the images, an image is in a set when it's within max_distance of another one in it
+def duplicate_sets(images, max_distance=DEFAULT_MAX_DISTANCE):
+    hashes = [int(image['data']['phash'], 16) for image in images]
+    parents = list(range(len(images))) # union-find of the images
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    tree = BKTree()
+    for i, hash in enumerate(hashes):
+        for _, j in tree.search(hash, max_distance):
+            parents[find(i)] = find(j)
+        tree.add(hash, i)
+
+    members = {}
+    for i in range(len(images)):
+        members.setdefault(find(i), []).append(i)
+    sets = []
+    for indexes in members.values():
+        if len(indexes) < 2:
+            continue
+        first = hashes[indexes[0]] # distances are to the first image uploaded
+        sets.append({
+            'images': [{
+                'id': images[i]['_id'],
+                'filename': images[i].get('filename'),
+                'group': images[i].get('group'),
+                'phash': images[i]['data']['phash'],
+                'distance': hamming(hashes[i], first),
+            } for i in indexes],
+        })
+    sets.sort(key=lambda duplicates: len(duplicates['images']), reverse=True)
+    return sets
+
+# near-duplicates of the hashed images in a group or in the groups of an event
+def find_duplicates(db, group_ids: list[ObjectId], max_distance=DEFAULT_MAX_DISTANCE):
+    images = list(db.get_collection('images').find(
+        {'group': {'$in': group_ids}, PHASH: {'$exists': True}},
+        {'filename': 1, 'group': 1, PHASH: 1},
+    ).sort('_id', 1))
+    return {
+        'max_distance': max_distance,
+        'hashed_images': len(images),
+        'sets': duplicate_sets(images, max_distance),
+    }
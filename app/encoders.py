@@ -0,0 +1,102 @@
+import json
+from functools import lru_cache
+from types import NoneType
+from typing import Annotated, Union, get_args, get_origin
+
+from bson import ObjectId
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import to_json, to_jsonable_python
+
+
+# Fast JSON encoding straight from the BSON documents returned by pymongo.
+# The output matches what FastAPI produces through the response_model (validate into the Pydantic model
+# then serialize it), but skips building the model instances which is most of the cost for big groups.
+# Documents are reshaped to the model's fields in Python and pydantic_core does the actual JSON encoding,
+# so datetimes are written the same way as the models. Only float exponents differ (1e-05 is written 1e-5).
+
+# find out if a field annotation holds another model (or a list of them), ex: Optional[list[ImageData]]
+def nested_model(annotation):
+    origin = get_origin(annotation)
+    if origin is Union:
+        for arg in get_args(annotation):
+            if arg is not NoneType:
+                return nested_model(arg)
+    elif origin is list:
+        model, _ = nested_model(get_args(annotation)[0])
+        return (model, True) if model is not None else (None, False)
+    elif isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation, False
+    return None, False
+
+# check if a field annotation is a PyObjectId, those are serialized as strings
+def is_object_id(annotation):
+    if annotation is ObjectId:
+        return True
+    if get_origin(annotation) is Annotated:
+        return is_object_id(get_args(annotation)[0])
+    return any(is_object_id(arg) for arg in get_args(annotation))
+
+# the encoding plan for a model, one entry per field in the order pydantic outputs them
+@lru_cache(maxsize=None)
+def model_plan(model, by_alias, exclude_none):
+    plan = []
+    for name, field in model.model_fields.items():
+        input_keys = (field.alias, name) if field.alias else (name,) # populate_by_name so both are accepted
+        output_key = (field.serialization_alias or field.alias or name) if by_alias else name
+        nested, is_list = nested_model(field.annotation)
+        nested_plan = model_plan(nested, by_alias, exclude_none) if nested is not None else None
+        plan.append((input_keys, output_key, field, nested_plan, is_list, is_object_id(field.annotation)))
+    return tuple(plan)
+
+# reshape a single document to the model's fields, missing fields get the model's defaults
+def shape_document(plan, document, exclude_none):
+    shaped = {}
+    for input_keys, output_key, field, nested_plan, is_list, object_id in plan:
+        for key in input_keys:
+            if key in document:
+                value = document[key]
+                break
+        else:
+            value = field.get_default(call_default_factory=True)
+
+        if value is None:
+            if not exclude_none:
+                shaped[output_key] = None
+        elif object_id:
+            shaped[output_key] = str(value)
+        elif nested_plan is None:
+            shaped[output_key] = value # left for pydantic_core to encode
+        elif is_list:
+            shaped[output_key] = [None if item is None else shape_document(nested_plan, item, exclude_none) for item in value]
+        else:
+            shaped[output_key] = shape_document(nested_plan, value, exclude_none)
+    return shaped
+
+# reshape content for a response model, which can be a model or a list of a model like List[ImageGroup]
+def shape(response_model, content, by_alias=False, exclude_none=True):
+    model, is_list = nested_model(response_model)
+    if model is None:
+        return content
+    plan = model_plan(model, by_alias, exclude_none)
+    if is_list:
+        return [shape_document(plan, item, exclude_none) for item in content]
+    return shape_document(plan, content, exclude_none)
+
+# encode content to JSON compatible python values, like model_dump(mode='json')
+def encode(response_model, content, by_alias=False, exclude_none=True):
+    return to_jsonable_python(shape(response_model, content, by_alias, exclude_none), fallback=str)
+
+# render the content to JSON bytes, the same bytes starlette's JSONResponse writes for the model
+def render(response_model, content, by_alias=False, exclude_none=True) -> bytes:
+    return to_json(shape(response_model, content, by_alias, exclude_none), fallback=str)
+
+# render content the way FastAPI does with a response_model, validate into the model then serialize it
+def render_with_model(response_model, content, by_alias=False, exclude_none=True) -> bytes:
+    adapter = type_adapter(response_model)
+    value = adapter.validate_python(content)
+    content = adapter.dump_python(value, mode='json', by_alias=by_alias, exclude_none=exclude_none)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+@lru_cache(maxsize=None)
+def type_adapter(response_model):
+    return TypeAdapter(response_model)
@@ -0,0 +1,98 @@
+import math
+import argparse
+from pymongo import UpdateOne
+
+
+# Geospatial queries over the image coordinates. The coordinates are stored as data.coords.{latitude,longitude}
+# for the clients and as a GeoJSON Point in data.location which the 2dsphere index uses.
+
+# MongoDB's CRS for polygons bigger than a hemisphere, the ring has to be counterclockwise
+STRICT_WINDING_CRS = {'type': 'name', 'properties': {'name': 'urn:x-mongodb:crs:strictwinding:EPSG:4326'}}
+EDGE_STEP = 10 # max degrees between the points on an edge of a box
+
+# check that coordinates are numbers the 2dsphere index accepts, EXIF GPS can be out of range or not a number
+def valid_coordinates(latitude, longitude):
+    return all(isinstance(value, (int, float)) and math.isfinite(value) for value in (latitude, longitude)) \
+        and abs(latitude) <= 90 and abs(longitude) <= 180
+
+# GeoJSON Point for coordinates, GeoJSON has longitude first
+def location(latitude, longitude):
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+# points from start to end (not including end) no more than EDGE_STEP degrees apart
+def edge(start, end):
+    steps = max(1, int(abs(end - start) // EDGE_STEP) + 1)
+    return [start + (end - start) * i / steps for i in range(steps)]
+
+def normalize_longitude(longitude):
+    return longitude - 360 if longitude > 180 else longitude
+
+# $geoWithin query for images in a bounding box, the box crosses the antimeridian when min_longitude > max_longitude
+# Edges of a polygon are geodesics on the sphere, so they're split into short pieces to follow the lines of latitude
+def within_query(min_latitude, min_longitude, max_latitude, max_longitude):
+    if max_longitude < min_longitude: # crossing the antimeridian
+        max_longitude += 360
+    if max_longitude - min_longitude >= 360: # all longitudes, only the latitudes narrow it down
+        return {
+            'data.location': {'$exists': True},
+            'data.coords.latitude': {'$gte': min_latitude, '$lte': max_latitude},
+        }
+    ring = []
+    ring += [[normalize_longitude(lng), min_latitude] for lng in edge(min_longitude, max_longitude)] # bottom, west to east
+    ring += [[normalize_longitude(max_longitude), lat] for lat in edge(min_latitude, max_latitude)] # east side, going north
+    ring += [[normalize_longitude(lng), max_latitude] for lng in edge(max_longitude, min_longitude)] # top, east to west
+    ring += [[normalize_longitude(min_longitude), lat] for lat in edge(max_latitude, min_latitude)] # west side, going south
+    ring.append(ring[0]) # close the ring
+    return {
+        'data.location': {
+            '$geoWithin': {
+                '$geometry': {'type': 'Polygon', 'coordinates': [ring], 'crs': STRICT_WINDING_CRS}
+            }
+        }
+    }
+
+# $near query for images closest to a point, nearest first, max_distance in meters
+def near_query(latitude, longitude, max_distance=None):
+    near = {'$geometry': location(latitude, longitude)}
+    if max_distance is not None:
+        near['$maxDistance'] = max_distance
+    return {'data.location': {'$near': near}}
+
+# add data.location to images which have coordinates but were processed before it was stored
+# Coordinates the 2dsphere index would reject are skipped, returns the number updated and the number skipped
+def backfill_locations(db, batch_size=1000):
+    images_collection = db.get_collection('images')
+    cursor = images_collection.find(
+        {'data.coords': {'$exists': True}, 'data.location': {'$exists': False}},
+        {'data.coords': 1}
+    )
+    updated = skipped = 0
+    operations = []
+    for image in cursor:
+        coords = image['data']['coords'] or {}
+        if not valid_coordinates(coords.get('latitude'), coords.get('longitude')):
+            skipped += 1
+            continue
+        operations.append(UpdateOne({'_id': image['_id']}, {'$set': {'data.location': location(coords['latitude'], coords['longitude'])}}))
+        if len(operations) >= batch_size:
+            updated += images_collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += images_collection.bulk_write(operations, ordered=False).modified_count
+    return updated, skipped
+
+# backfill command: python -m app.geo
+def main():
+    from app.db import connect_to_db
+    from app.indexes import ensure_indexes
+    parser = argparse.ArgumentParser(description="Backfill data.location for images with coordinates and create the geo index")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Number of updates in each bulk write")
+    args = parser.parse_args()
+
+    db = next(connect_to_db())
+    ensure_indexes(db)
+    updated, skipped = backfill_locations(db, args.batch_size)
+    print(f"Added locations to {updated} images, skipped {skipped} with invalid coordinates")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import argparse
+from bson import ObjectId
+from pymongo import UpdateOne
+
+
+# Aggregates kept on the image_groups documents so the gallery doesn't have to $lookup every image:
+# image_count, cover (the first processed image), first_taken/last_taken and the bounds of the coordinates.
+# They're updated incrementally with $inc/$min/$max as images are added, processed, moved and deleted,
+# and rebuild() recomputes them from the images collection to fix any drift.
+
+STATS_FIELDS = ['image_count', 'cover', 'first_taken', 'last_taken', 'bounds']
+
+# when the image was taken, DateTimeOriginal if there is one
+def taken_at(data):
+    return data.get('DateTimeOriginal') or data.get('DateTime')
+
+# the cover of a group points to the thumbnail of one of its images, with its placeholder to show until it loads
+def make_cover(group_id, image):
+    cover = {
+        'image': image['_id'],
+        'filename': image['filename'],
+        'thumb': f"thumb/{group_id}/{image['filename']}",
+    }
+    data = image.get('data') or {}
+    for field in ['placeholder', 'dominant_color']:
+        if field in data:
+            cover[field] = data[field]
+    return cover
+
+# $min and $max updates to extend the group's time span and bounds with an image
+def extend_update(data):
+    minimums, maximums = {}, {}
+    if (taken := taken_at(data)) is not None:
+        minimums['first_taken'] = taken
+        maximums['last_taken'] = taken
+    if (coords := data.get('coords')) is not None:
+        minimums['bounds.min_latitude'] = coords['latitude']
+        maximums['bounds.max_latitude'] = coords['latitude']
+        minimums['bounds.min_longitude'] = coords['longitude']
+        maximums['bounds.max_longitude'] = coords['longitude']
+    update = {}
+    if minimums:
+        update['$min'] = minimums
+        update['$max'] = maximums
+    return update
+
+# new image documents were added to a group, before they're processed
+def images_added(db, group_id, count):
+    if count > 0:
+        db.get_collection('image_groups').update_one({'_id': ObjectId(group_id)}, {'$inc': {'image_count': count}})
+
+# an image was processed and has its data now
+def image_processed(db, image):
+    groups_collection = db.get_collection('image_groups')
+    group_id = image['group']
+    if update := extend_update(image.get('data') or {}):
+        groups_collection.update_one({'_id': group_id}, update)
+    # the first processed image becomes the cover, cover: None matches a missing cover too
+    groups_collection.update_one({'_id': group_id, 'cover': None}, {'$set': {'cover': make_cover(group_id, image)}})
+
+# check if removing an image could shrink the group's time span or bounds, or takes away its cover
+def affects_extremes(group, image):
+    if (group.get('cover') or {}).get('image') == image['_id']:
+        return True
+    data = image.get('data') or {}
+    if (taken := taken_at(data)) is not None and taken in (group.get('first_taken'), group.get('last_taken')):
+        return True
+    if (coords := data.get('coords')) is not None:
+        bounds = group.get('bounds') or {}
+        if coords['latitude'] in (bounds.get('min_latitude'), bounds.get('max_latitude')) or \
+                coords['longitude'] in (bounds.get('min_longitude'), bounds.get('max_longitude')):
+            return True
+    return False
+
+# an image was removed from a group, either deleted or moved to another group
+def image_removed(db, group_id, image):
+    groups_collection = db.get_collection('image_groups')
+    group = groups_collection.find_one_and_update({'_id': group_id}, {'$inc': {'image_count': -1}}, return_document=True)
+    if group is not None and affects_extremes(group, image):
+        rebuild(db, [group_id]) # $min/$max can't shrink, so recompute this group from its images
+
+# an image was moved from one group to another
+def image_moved(db, old_group_id, new_group_id, image):
+    image_removed(db, old_group_id, image)
+    images_added(db, new_group_id, 1)
+    if image.get('data'): # it was already processed
+        image_processed(db, {**image, 'group': new_group_id})
+
+# compute the aggregates of the groups from the images collection, all the groups if group_ids is None
+def compute(db, group_ids=None):
+    images_collection = db.get_collection('images')
+    query = {} if group_ids is None else {'group': {'$in': [ObjectId(group_id) for group_id in group_ids]}}
+    projection = {'group': 1, 'filename': 1, 'created_at': 1, 'data.DateTimeOriginal': 1, 'data.DateTime': 1, 'data.coords': 1,
+                  'data.placeholder': 1, 'data.dominant_color': 1}
+
+    stats = {}
+    # stream through the images so only the aggregates are kept in memory
+    for image in images_collection.find(query, projection).sort([('group', 1), ('created_at', 1)]):
+        group_id = image['group']
+        group_stats = stats.setdefault(group_id, {'image_count': 0})
+        group_stats['image_count'] += 1
+        data = image.get('data') or {}
+        if not data:
+            continue # not processed yet
+        if 'cover' not in group_stats: # first processed image by upload time
+            group_stats['cover'] = make_cover(group_id, image)
+        if (taken := taken_at(data)) is not None:
+            group_stats['first_taken'] = min(group_stats.get('first_taken', taken), taken)
+            group_stats['last_taken'] = max(group_stats.get('last_taken', taken), taken)
+        if (coords := data.get('coords')) is not None:
+            bounds = group_stats.setdefault('bounds', {
+                'min_latitude': coords['latitude'], 'max_latitude': coords['latitude'],
+                'min_longitude': coords['longitude'], 'max_longitude': coords['longitude'],
+            })
+            bounds['min_latitude'] = min(bounds['min_latitude'], coords['latitude'])
+            bounds['max_latitude'] = max(bounds['max_latitude'], coords['latitude'])
+            bounds['min_longitude'] = min(bounds['min_longitude'], coords['longitude'])
+            bounds['max_longitude'] = max(bounds['max_longitude'], coords['longitude'])
+    return stats
+
+# recompute and save the aggregates, returns the number of groups updated
+def rebuild(db, group_ids=None):
+    groups_collection = db.get_collection('image_groups')
+    stats = compute(db, group_ids)
+
+    if group_ids is None:
+        group_ids = [group['_id'] for group in groups_collection.find({}, {'_id': 1})]
+    operations = []
+    for group_id in group_ids:
+        group_id = ObjectId(group_id)
+        group_stats = stats.get(group_id, {'image_count': 0})
+        unset = {field: '' for field in STATS_FIELDS if field not in group_stats}
+        update = {'$set': group_stats}
+        if unset:
+            update['$unset'] = unset
+        operations.append(UpdateOne({'_id': group_id}, update))
+    if operations:
+        groups_collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+# pipeline for the summary of an event from the aggregates of its groups, one $facet for the group list and the totals
+# so the event page doesn't have to $lookup the images of every group
+def event_summary_pipeline(event_id):
+    return [
+        {'$match': {'event': ObjectId(event_id)}}, # uses the event index
+        {'$facet': {
+            'groups': [
+                {'$sort': {'first_taken': 1, '_id': 1}},
+                {'$project': {'name': 1, 'description': 1, **{field: 1 for field in STATS_FIELDS}}},
+            ],
+            'totals': [
+                {'$group': {
+                    '_id': None,
+                    'group_count': {'$sum': 1},
+                    'image_count': {'$sum': '$image_count'},
+                    'first_taken': {'$min': '$first_taken'},
+                    'last_taken': {'$max': '$last_taken'},
+                    'min_latitude': {'$min': '$bounds.min_latitude'},
+                    'max_latitude': {'$max': '$bounds.max_latitude'},
+                    'min_longitude': {'$min': '$bounds.min_longitude'},
+                    'max_longitude': {'$max': '$bounds.max_longitude'},
+                }},
+            ],
+        }},
+    ]
+
+# summary of an event, with zeros for an event without groups
+def event_summary(db, event_id):
+    result = next(db.get_collection('image_groups').aggregate(event_summary_pipeline(event_id)))
+    totals = result['totals'][0] if result['totals'] else {}
+    summary = {
+        'event': ObjectId(event_id),
+        'group_count': totals.get('group_count', 0),
+        'image_count': totals.get('image_count', 0),
+        'first_taken': totals.get('first_taken'),
+        'last_taken': totals.get('last_taken'),
+        'groups': result['groups'],
+    }
+    bounds = {field: totals.get(field) for field in ['min_latitude', 'max_latitude', 'min_longitude', 'max_longitude']}
+    if all(value is not None for value in bounds.values()):
+        summary['bounds'] = bounds
+    return summary
+
+# rebuild command: python -m app.group_stats [--group GROUP_ID ...]
+def main():
+    from app.db import connect_to_db
+    parser = argparse.ArgumentParser(description="Rebuild the image_count, cover, time span and bounds of image groups")
+    parser.add_argument('--group', action='append', help="Group id to rebuild, all groups when not given")
+    args = parser.parse_args()
+
+    db = next(connect_to_db())
+    updated = rebuild(db, args.group)
+    print(f"Rebuilt stats for {updated} groups")
+
+if __name__ == '__main__':
+    main()
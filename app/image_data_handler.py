@@ -3,6 +3,7 @@ from PIL.ExifTags import TAGS, GPSTAGS
 from datetime import datetime
 import piexif
 import re
+from app.geo import location, valid_coordinates
 
 class ImageDataHandler:
     def __init__(self, image:Image.Image):
@@ -62,12 +63,18 @@ class ImageDataHandler:
             gps_keys = ['GPSLatitude', 'GPSLatitudeRef', 'GPSLongitude', 'GPSLongitudeRef'] #GPS keys to check
             if (all(key in gps_info for key in gps_keys)): #check if all keys exist in gps_info
                 # convert GPS coordinates to decimal values that can be used by something like Google Maps
-                latval = self.convert_degrees_to_decimal(gps_info['GPSLatitude'])
-                lat =  latval if gps_info['GPSLatitudeRef'] == 'N' else -latval
-                longval = self.convert_degrees_to_decimal(gps_info['GPSLongitude'])
-                long = longval if gps_info['GPSLongitudeRef'] == 'E' else -longval
+                try:
+                    latval = self.convert_degrees_to_decimal(gps_info['GPSLatitude'])
+                    lat =  latval if gps_info['GPSLatitudeRef'] == 'N' else -latval
+                    longval = self.convert_degrees_to_decimal(gps_info['GPSLongitude'])
+                    long = longval if gps_info['GPSLongitudeRef'] == 'E' else -longval
+                except (TypeError, ValueError, ZeroDivisionError): # malformed GPS values
+                    lat = long = float('nan')
 
-                data["coords"] = {'latitude':lat, 'longitude':long} # assign coordinates to data
+                # only coordinates the geo index accepts, else the whole image update would fail
+                if valid_coordinates(lat, long):
+                    data["coords"] = {'latitude':lat, 'longitude':long} # assign coordinates to data
+                    data["location"] = location(lat, long) # GeoJSON point for the geo index
 
         return data
 
@@ -81,6 +88,8 @@ class ImageDataHandler:
         return datetime(year, month, day, hour, minute, second)
 
     def remove_gps(self, image):
+        if not image.info.get('exif'): # no exif, so no gps to remove (piexif.load would take '' as a filename)
+            return b''
         exif_data = piexif.load(image.info.get('exif',''))
         del exif_data['GPS']
         return piexif.dump(exif_data)
@@ -0,0 +1,36 @@
+# The indexes used by the queries, create them with: python -m app.indexes
+INDEXES = {
+    'images': [
+        # bounding box and near queries, with the group for queries scoped to an event
+        ([('data.location', '2dsphere'), ('group', 1)], {'name': 'location_group'}),
+        # timeline range and sort, the _id is the tie breaker of the keyset pagination
+        ([('data.DateTimeOriginal', 1), ('_id', 1)], {'name': 'taken'}),
+        ([('group', 1), ('data.DateTimeOriginal', 1), ('_id', 1)], {'name': 'group_taken'}),
+        # processing status changes of a group, for the long-poll and event stream
+        ([('group', 1), ('status_at', 1)], {'name': 'group_status'}),
+        # perceptual hashes of a group's images, for the near-duplicate search
+        ([('group', 1), ('data.phash', 1)], {'name': 'group_phash'}),
+    ],
+    'image_groups': [
+        # groups of an event, for the event summary and the event's group list
+        ([('event', 1)], {'name': 'event'}),
+    ],
+}
+
+# create any missing indexes, creating an index that already exists does nothing
+def ensure_indexes(db):
+    created = []
+    for collection_name, indexes in INDEXES.items():
+        collection = db.get_collection(collection_name)
+        for keys, options in indexes:
+            created.append(collection.create_index(keys, **options))
+    return created
+
+def main():
+    from app.db import connect_to_db
+    db = next(connect_to_db())
+    for name in ensure_indexes(db):
+        print('Index:', name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import io
+import os
+import json
+import time
+import hmac
+import random
+import asyncio
+import cProfile
+import pstats
+import contextvars
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from pymongo import monitoring
+
+from app import metrics, log
+
+logger = log.get_logger('app.instrumentation')
+
+
+# On-demand profiling of single requests, to see where a slow request spends its time in production.
+# A sampled request (PROFILE_SAMPLE_RATE, 0 to 1) or one with the header X-Debug-Profile set to PROFILE_TOKEN
+# runs under cProfile, and every MongoDB command and S3 call it makes is timed. The result is written to
+# PROFILE_DIR as <id>.json (request, calls and the top functions) and <id>.prof (for pstats or snakeviz),
+# the id is returned in the X-Profile-Id header. With neither setting the middleware only passes requests on.
+# Only the newest PROFILE_MAX_FILES profiles are kept, the older ones are deleted when a profile is saved.
+# The MongoDB listener and the S3 hooks also time every call for app/metrics.py.
+
+HEADER = b'x-debug-profile'
+TOP_FUNCTIONS = 30
+
+# profile of the request being handled, None when it isn't profiled
+current = contextvars.ContextVar('profile', default=None)
+profiler_busy = False # cProfile can only profile one request at a time
+
+class RequestProfile:
+    def __init__(self, method, path):
+        self.id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{ObjectId()}"
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.calls = [] # the MongoDB and S3 calls, appended from the threads that make them
+        self.profiler = None
+
+    # start cProfile, unless another request already has it
+    def start_profiler(self):
+        global profiler_busy
+        if profiler_busy:
+            return
+        profiler_busy = True
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        global profiler_busy
+        self.duration_ms = round((time.perf_counter() - self.start) * 1000, 3)
+        if self.profiler is not None:
+            self.profiler.disable()
+            profiler_busy = False
+
+    def record(self, kind, name, ms, ok=True, **detail):
+        self.calls.append({'type': kind, 'name': name, 'ms': round(ms, 3), 'ok': ok,
+                           'at_ms': round((time.perf_counter() - self.start) * 1000 - ms, 3), **detail})
+
+    # functions with the most cumulative time
+    def top_functions(self):
+        if self.profiler is None:
+            return None
+        stats = pstats.Stats(self.profiler).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        return [{'function': f"{filename}:{line}({name})", 'calls': calls, 'own_ms': round(own * 1000, 3), 'cumulative_ms': round(cumulative * 1000, 3)}
+                for (filename, line, name), (_, calls, own, cumulative, _) in top]
+
+    def summary(self):
+        totals = {}
+        for call in self.calls:
+            total = totals.setdefault(call['type'], {'count': 0, 'ms': 0})
+            total['count'] += 1
+            total['ms'] = round(total['ms'] + call['ms'], 3)
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'route': self.route,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': self.duration_ms,
+            'totals': totals,
+            'calls': self.calls,
+            'profiled': self.profiler is not None, # False when another request had the profiler
+            'top_functions': self.top_functions(),
+        }
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.id}.json"), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(directory, f"{self.id}.prof"))
+
+# delete the oldest profiles past max_profiles, the ids start with the time so they sort oldest first
+def prune_profiles(directory, max_profiles):
+    files = [name for name in os.listdir(directory) if name.endswith(('.json', '.prof'))]
+    ids = sorted({os.path.splitext(name)[0] for name in files})
+    old = set(ids[:max(0, len(ids) - max_profiles)])
+    for name in files:
+        if os.path.splitext(name)[0] in old:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError: # another container or request deleted it first
+                pass
+    return len(old)
+
+# ASGI middleware rather than an @app.middleware, so requests that aren't profiled (and streamed responses) go straight through
+class ProfilingMiddleware:
+    def __init__(self, app, sample_rate=None, token=None, directory=None, max_profiles=None):
+        self.app = app
+        self.sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', 0)) if sample_rate is None else sample_rate
+        self.token = os.getenv('PROFILE_TOKEN') if token is None else token
+        self.directory = directory or os.getenv('PROFILE_DIR', '/tmp/profiles') # /tmp is what's writable on Lambda
+        # /tmp is 512 MB by default on Lambda and a .prof can be a few MB
+        self.max_profiles = int(os.getenv('PROFILE_MAX_FILES', 50)) if max_profiles is None else max_profiles
+
+    def save(self, profile):
+        profile.save(self.directory)
+        prune_profiles(self.directory, self.max_profiles)
+
+    def wanted(self, scope):
+        if self.token:
+            for name, value in scope['headers']:
+                if name == HEADER and hmac.compare_digest(value, self.token.encode()):
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not (self.sample_rate or self.token) or not self.wanted(scope):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope['method'], scope['path'])
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                profile.status = message['status']
+                message['headers'] = [*message.get('headers', []), (b'x-profile-id', profile.id.encode())]
+            await send(message)
+
+        reset = current.set(profile)
+        # the profiler sees everything on the event loop while it's on, including other requests running at the same time
+        profile.start_profiler()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.stop()
+            current.reset(reset)
+            route = scope.get('route') # set by the router
+            profile.route = getattr(route, 'name', None)
+            try:
+                await asyncio.to_thread(self.save, profile)
+                logger.info('Profile saved', profile=profile.id, method=profile.method, path=profile.path)
+            except OSError as e:
+                logger.error('Profile not saved', profile=profile.id, error=str(e))
+
+# MongoDB commands for the metrics and the request being profiled, registered on the shared MongoClient
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self.collections = {} # request id: collection, the finished events don't have the command
+
+    def started(self, event):
+        # the collection is the value of the command name, except for getMore
+        collection = event.command.get('collection' if event.command_name == 'getMore' else event.command_name)
+        self.collections[event.request_id] = collection if isinstance(collection, str) else None
+
+    def succeeded(self, event):
+        self.record(event, True)
+
+    def failed(self, event):
+        self.record(event, False)
+
+    def record(self, event, ok):
+        collection = self.collections.pop(event.request_id, None)
+        metrics.mongo_commands.observe(event.duration_micros / 1_000_000, collection=collection, command=event.command_name)
+        if not ok:
+            metrics.mongo_failures.inc(collection=collection, command=event.command_name)
+        if (profile := current.get()) is not None:
+            profile.record('mongo', event.command_name, event.duration_micros / 1000, ok, collection=collection)
+
+mongo_listener = MongoCommandListener()
+
+# size of a request body, which can be bytes or a file object
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    try:
+        position = body.tell()
+        size = body.seek(0, io.SEEK_END) - position
+        body.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return 0
+
+# S3 calls for the metrics and the request being profiled, registered on the boto3 clients
+def before_call(context, params, **kwargs):
+    context['call_start'] = time.perf_counter()
+    context['call_bytes_sent'] = body_size(params.get('body'))
+
+# after-call has the http response, after-call-error the exception
+def after_call(context, event_name, http_response=None, model=None, **kwargs):
+    if 'call_start' not in context:
+        return
+    seconds = time.perf_counter() - context.pop('call_start')
+    ok = http_response is not None and http_response.status_code < 400
+    operation = event_name.split('.')[-1] # after-call.s3.HeadObject
+    metrics.s3_calls.observe(seconds, operation=operation)
+    if not ok:
+        metrics.s3_failures.inc(operation=operation)
+    if sent := context.pop('call_bytes_sent', 0):
+        metrics.s3_bytes.inc(sent, operation=operation, direction='sent')
+    if http_response is not None and model is not None:
+        # a streamed body (GetObject) hasn't been read yet, its size is in the headers
+        received = int(http_response.headers.get('content-length', 0)) if model.has_streaming_output else len(http_response.content)
+        if received:
+            metrics.s3_bytes.inc(received, operation=operation, direction='received')
+    if (profile := current.get()) is not None:
+        profile.record('s3', operation, seconds * 1000, ok)
+
+def instrument_boto_client(client):
+    client.meta.events.register('before-call.*', before_call)
+    client.meta.events.register('after-call.*', after_call)
+    client.meta.events.register('after-call-error.*', after_call)
+    return client
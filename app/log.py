@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import uuid
+import logging
+import contextvars
+from datetime import datetime, timezone
+
+
+# Structured logging, one JSON line per message with its level, logger and fields and the correlation id
+# of the request or S3 event it's for, so the logs of one upload can be followed from the API to the processing.
+# The fields are only serialized when the level is enabled, pass the objects rather than formatting them first.
+# LOG_LEVEL sets the level (default INFO), whole documents are only logged at DEBUG.
+
+HEADER = b'x-request-id'
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if (current := correlation_id.get()) is not None:
+            line['correlation_id'] = current
+        line.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str) # ObjectIds, datetimes and the rest as strings
+
+# writes to whatever sys.stdout is when logging, Lambda sends stdout to CloudWatch
+class StdoutHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+# the app logger, configured once
+def setup(level=None):
+    logger = logging.getLogger('app')
+    if not logger.handlers:
+        handler = StdoutHandler()
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False # Lambda's root logger has its own handler
+    logger.setLevel((level or os.getenv('LOG_LEVEL', 'INFO')).upper())
+    return logger
+
+class Logger:
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, message, exc_info=None, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, exc_info=exc_info, extra={'fields': fields}, stacklevel=3)
+
+    def is_debug(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, message, **fields):
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(logging.ERROR, message, **fields)
+
+    def exception(self, message, **fields):
+        self.log(logging.ERROR, message, exc_info=True, **fields)
+
+def get_logger(name):
+    setup()
+    return Logger(name)
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+# ASGI middleware setting the correlation id of a request: the X-Request-Id header, the Lambda request id
+# or a new one, returned in the X-Request-Id header of the response
+class CorrelationIdMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        request_id = next((value.decode('latin-1')[:128] for name, value in scope['headers'] if name == HEADER), None)
+        if not request_id:
+            aws_context = scope.get('aws.context') # set by Mangum
+            request_id = getattr(aws_context, 'aws_request_id', None) or new_correlation_id()
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (HEADER, request_id.encode('latin-1'))]
+            await send(message)
+
+        reset = correlation_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            correlation_id.reset(reset)
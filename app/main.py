@@ -1,32 +1,31 @@
-from fastapi import FastAPI, UploadFile, HTTPException, Depends, Body, Form, File
+from fastapi import FastAPI, UploadFile, HTTPException, Depends, Body, Form, File, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse, RedirectResponse
 from http import HTTPStatus
 
-from typing import List
-from app.image_data_handler import ImageDataHandler
+from typing import List, Optional, Literal
 #from maps_info import MapsInfo
-from PIL import Image
 from bson.objectid import ObjectId
 
-import io
+import os
 from datetime import datetime, timezone
 
-from app.db import lifespan, connect_to_db
-from app.models import ImageGroup, ImageData, UpdateImageData, UpdateGroupData
+from app.db import lifespan, connect_to_db, get_db
+from app.models import ImageGroup, ImageData, UpdateImageData, UpdateGroupData, BulkImageUpdate, TimelinePage, HistogramBin, EventSummary, ImageBatch, Duplicates, ArchiveManifest
+from app import encoders, cache, singleflight, group_stats, geo, timeline, status, instrumentation, metrics, log, duplicates, renditions, archive
+from app.cache import ResponseCache
 from typing_extensions import Annotated
 
-from app.s3_handler import S3Handler
-
 from mangum import Mangum # Use mangum for AWS
 
 from starlette.requests import Request
 
 import asyncio
-import concurrent.futures
+from pymongo import UpdateOne
 
 app = FastAPI(lifespan=lifespan) # start FastAPI with lifespan
-print('app:',app)
+logger = log.get_logger('app.main')
 
 # CORS settings
 app.add_middleware(
@@ -37,10 +36,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Profiling of sampled requests or the ones with the debug header, configured with PROFILE_SAMPLE_RATE and PROFILE_TOKEN
+app.add_middleware(instrumentation.ProfilingMiddleware)
+# Request latency by route for GET /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+# Correlation id of the request for the logs, from X-Request-Id or the Lambda request id
+app.add_middleware(log.CorrelationIdMiddleware)
+
 
 def setup_s3_handler(): #prepare the S3 handler by dependency injection
-    s3 = S3Handler()
-    yield s3
+    from app.s3_handler import get_s3_handler # boto3 is only imported once a route needs S3
+    yield get_s3_handler()
+
+# Opt-in fast path that encodes the MongoDB documents directly instead of validating them into the response_model
+fast_responses = os.getenv('FAST_RESPONSE_ENCODER', 'false').lower() == 'true'
+
+# render a response body the way the route's response_model would
+def render_body(request: Request, content) -> bytes:
+    route = request.scope['route'] # use the same response_model settings as the route
+    render = encoders.render if fast_responses else encoders.render_with_model
+    return render(route.response_model, content,
+                  by_alias=route.response_model_by_alias, exclude_none=route.response_model_exclude_none)
+
+def fast_json_response(request: Request, content):
+    return Response(content=render_body(request, content), media_type='application/json')
+
+# Cache for the group and image reads, the write endpoints invalidate what they change
+response_cache = ResponseCache(
+    max_size=int(os.getenv('RESPONSE_CACHE_SIZE', 256)),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 60)),
+    shared=cache.shared_backend_from_env()
+)
+
+# Coalescing of concurrent identical reads, configured per route with SINGLE_FLIGHT_ROUTES
+single_flights = singleflight.routes_from_env()
+single_flights.enabled_routes.add('get_rendition') # concurrent misses of a dynamic rendition always make it once
+
+# Widths and heights accepted by GET /images/{image_id}/rendition, configured with RENDITION_SIZES
+rendition_sizes = renditions.sizes_from_env()
+RENDITION_URL_EXPIRES = 3600 # seconds the redirect to a dynamic rendition is valid
+
+# respond with a cache entry, or 304 if the client already has that version
+def cached_response(request: Request, entry):
+    headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache'} # clients revalidate with If-None-Match
+    if cache.etag_matches(request.headers.get('if-none-match'), entry['etag']):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(content=entry['body'], media_type='application/json', headers=headers)
+
+# invalidate cached groups along with the summaries of the events they're in
+def invalidate_groups(db, group_ids, *keys):
+    group_ids = [ObjectId(group_id) for group_id in group_ids if group_id is not None]
+    events = db.get_collection('image_groups').distinct('event', {'_id': {'$in': group_ids}})
+    response_cache.invalidate(*keys, *[cache.group_key(group_id) for group_id in group_ids],
+                              *[cache.event_key(event) for event in events if event is not None], db=db)
 
 @app.get("/")
 async def read_root():
@@ -48,21 +96,30 @@ async def read_root():
 
 @app.post("/")
 async def hello(request: Request):
-    print('Request:',request)
+    logger.debug('Lambda event', event=request.scope['aws.event'])
     return {"aws_event": request.scope["aws.event"]}
 
+# How many requests were coalesced for each route
+@app.get("/stats/single_flight", response_description="Single-flight coalescing counts per route")
+async def single_flight_stats():
+    return single_flights.stats()
+
+# Metrics of this container in the Prometheus text format
+@app.get("/metrics", response_description="Metrics in the Prometheus text format")
+async def get_metrics():
+    return Response(content=metrics.registry.render(), media_type='text/plain; version=0.0.4')
+
 ################### IMAGE GROUPS ###################
 # Get all image groups
 @app.get("/image_groups/")
 @app.get("/image_groups", response_model=List[ImageGroup], response_model_by_alias=True, response_model_exclude_none=True,
          response_description="Get all image_groups")
-async def get_image_groups(event: str | None = None, db=Depends(connect_to_db)) -> List[ImageGroup]:
+async def get_image_groups(request: Request, event: str | None = None, db=Depends(connect_to_db)) -> List[ImageGroup]:
     groups_collection = db.get_collection('image_groups')
     if event is None: # return all groups no aggregate
         groups = groups_collection.find({})
         group_list = list(groups)
     else: # return groups in event with aggregate
-        print('event_id', event)
         pipeline = [
             {
                 '$match':{ #match group id in image_groups
@@ -86,7 +143,10 @@ async def get_image_groups(event: str | None = None, db=Depends(connect_to_db))
         cursor = groups_collection.aggregate(pipeline=pipeline) # run aggregate query
         group_list = list(cursor) # convert cursor to list
 
-    print('group list', group_list)
+    logger.info('Image groups', event=event, groups=len(group_list))
+    logger.debug('Image group documents', groups=group_list)
+    if fast_responses:
+        return fast_json_response(request, group_list)
     return group_list
 
 
@@ -96,17 +156,12 @@ async def get_image_groups(event: str | None = None, db=Depends(connect_to_db))
 @app.post("/image_groups", response_description="Upload images and create a new image_group")
 async def upload_images(group:Annotated[UpdateGroupData, Body(embed=True)], db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
     #exclude None values from the image
-    print(group)
-    print('Removing none from group')
     group = {
         k: v for k, v in group.model_dump(by_alias=True).items() if v is not None
     }
-    print('group', group)
     if 'images' in group:
         images = group['images']
         del group['images']
-        print('Images:', images)
-        print('Number of images:', len(images))
     else:
         images = []
 
@@ -125,7 +180,9 @@ async def upload_images(group:Annotated[UpdateGroupData, Body(embed=True)], db=D
 
     inserted_group = groups_collection.insert_one(group)
     collection_id = inserted_group.inserted_id # get group id
-    print(collection_id)
+    logger.info('Group created', group=collection_id, event=group.get('event'), images=len(images))
+    if 'event' in group:
+        response_cache.invalidate(cache.event_key(group['event']), db=db) # new group in the event summary
 
 
     # add images to group
@@ -142,18 +199,18 @@ async def upload_images(group:Annotated[UpdateGroupData, Body(embed=True)], db=D
     }
 # add images to a group, used in upload_images and add to group
 async def add_images_to_group(group_id: str, images: list[str], db, s3):
-    print('Number of images:', len(images))
-    print('db:', db)
-    print(images)
     images_collection = db.get_collection('images')
     image_data = []
     group = ObjectId(group_id) # convert to ObjectId
-    print('Group:', group)
+    logger.info('Adding images', group=group, images=len(images))
+    logger.debug('Image filenames', group=group, filenames=images)
 
     # process each of the images
     for image in images:
         uploaded = await prepare_upload_single_image(group, image, images_collection, s3)
         image_data.append(uploaded)
+    group_stats.images_added(db, group, len(image_data))
+    invalidate_groups(db, [group])
     return image_data # return the list of images
 
 async def prepare_upload_single_image(group: ObjectId, filename: str, images_collection, s3, image_id:ObjectId = None):
@@ -166,11 +223,8 @@ async def prepare_upload_single_image(group: ObjectId, filename: str, images_col
     print('Date and coords:', date_and_coords) """
 
     path = await s3.check_and_rename_file(str(group), filename) # rename file if it exists
-    print('Path:', filename)
     filename = path.split('/')[-1] # get the filename from the path
-    print('Filename:', filename)
     presigned = await s3.presign_file(path) # get presigned url for the file
-    print('presigned', presigned)
     # insert into db
     if image_id is not None: # update existing image
         updated_image = images_collection.find_one_and_update({
@@ -178,7 +232,8 @@ async def prepare_upload_single_image(group: ObjectId, filename: str, images_col
         },
         {'$set': {
             'filename': filename,
-            'updated_at': datetime.now(timezone.utc)
+            'updated_at': datetime.now(timezone.utc),
+            **status.status_fields(status.PENDING), # processed again once the new file is uploaded
         }},
         return_document=True
         )
@@ -188,9 +243,9 @@ async def prepare_upload_single_image(group: ObjectId, filename: str, images_col
             'data': {},
             'created_at': datetime.now(timezone.utc),
             'updated_at': datetime.now(timezone.utc),
-            'group': group
+            'group': group,
+            **status.status_fields(status.PENDING),
         })
-        print('Inserted image:', inserted_image)
     return {
         '_id': str(inserted_image.inserted_id) if image_id is None else str(updated_image['_id']),
         'filename': path,
@@ -202,9 +257,21 @@ async def prepare_upload_single_image(group: ObjectId, filename: str, images_col
 # Get all images in a group
 @app.get("/image_groups/{group_id}", response_model=ImageGroup, response_model_by_alias=False, response_model_exclude_none=True,
          response_description="Get the image_group and all of its images")
-async def get_images(group_id: str, db = Depends(connect_to_db)):
+async def get_images(request: Request, group_id: str, db = Depends(connect_to_db)):
+    key = cache.group_key(group_id)
+    version = await asyncio.to_thread(cache.current_version, db, key) # bumped by the writes of every container
+    if (entry := response_cache.get(key, version)) is not None:
+        return cached_response(request, entry)
+    # concurrent requests for the same group share one query and rendered body
+    entry = await single_flights['get_images'].do((group_id, version), lambda: load_group(request, group_id, db, version))
+    return cached_response(request, entry)
+
+# run the group aggregation and render it into the cache, shared by coalesced get_images requests
+async def load_group(request: Request, group_id: str, db, version=None):
+    key = cache.group_key(group_id)
+    generation = response_cache.generation
+
     group_collection = db.get_collection('image_groups')
-    print(group_id, db)
 
     # pipeline to get group and all its images
     pipeline = [
@@ -227,44 +294,80 @@ async def get_images(group_id: str, db = Depends(connect_to_db)):
             }
         }
     ]
-    cursor = group_collection.aggregate(pipeline=pipeline) # run aggregate query
-    group_list = list(cursor) # convert cursor to list
+    # run aggregate query in a thread so other requests can join this one while it runs
+    group_list = await asyncio.to_thread(lambda: list(group_collection.aggregate(pipeline=pipeline)))
     if len(group_list) > 0:
         group = group_list[0] # get the first group which there probably should only be one
-        print('image group', group)
-        return group
+        logger.debug('Image group', group=group)
+        return response_cache.set(key, render_body(request, group), generation, version)
     else:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Group with that ID not found")
 
+# the since and seen of a status request, from its cursor when there's one, else the changes at since are taken as seen
+def status_position(db, group_id, since, cursor):
+    if cursor is not None:
+        try:
+            return status.decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    if since is not None:
+        return since, status.seen_at(db, group_id, since)
+    return None, None
+
+# Long-poll for the processing status of the images in a group, returns as soon as there are changes after the cursor
+# (or since) or with no changes when the timeout runs out, pass the cursor of the response to the next request
+@app.get("/image_groups/{group_id}/status", response_description="Wait for changes to the processing status of the images in a group")
+async def get_group_status(group_id: str, since: datetime | None = None, cursor: str | None = None,
+                           timeout: float = Query(20, ge=0, le=25), db=Depends(connect_to_db)):
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid group id")
+    group_id = ObjectId(group_id)
+    since, seen = status_position(db, group_id, since, cursor)
+    changes = await status.wait_for_changes(db, group_id, since, timeout, seen=seen)
+    since, seen = status.advance(since, seen, changes)
+    return {
+        'changes': [status.change_json(image) for image in changes],
+        'in_progress': await asyncio.to_thread(status.count_in_progress, db, group_id),
+        'since': status.naive_utc(since).replace(tzinfo=timezone.utc).isoformat() if since is not None else None,
+        'cursor': status.encode_cursor(since, seen or set()) if since is not None else None,
+    }
+
+# Server-sent events for the processing status of the images in a group, the stream ends when they're all done or failed
+# Lambda through API Gateway buffers responses, so use the long-poll there
+@app.get("/image_groups/{group_id}/status/stream", response_description="Stream the processing status changes of the images in a group")
+async def stream_group_status(group_id: str, since: datetime | None = None, cursor: str | None = None, db=Depends(connect_to_db)):
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid group id")
+    since, seen = status_position(db, ObjectId(group_id), since, cursor)
+    return StreamingResponse(status.event_stream(db, ObjectId(group_id), since, seen=seen), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Edit a group of images
 @app.patch("/image_groups/{group_id}", response_model=ImageGroup, response_model_by_alias=False, response_model_exclude_none=True,
          response_description="Edit an image_group")
 async def edit_group(group_id: str, group:Annotated[ImageGroup, Body(embed=True)], db=Depends(connect_to_db)):
-    print('Group:', group)
-    print(db)
-
     group_collection = db.get_collection('image_groups')
     group_id = ObjectId(group_id) # convert to ObjectId
 
     group.created_at = None #remove created_at
-    #exclude None values from the group
+    #exclude None values from the group, and the aggregates which are maintained from the images
     group = {
-        k: v for k, v in group.model_dump(by_alias=True).items() if v is not None
+        k: v for k, v in group.model_dump(by_alias=True, exclude=set(group_stats.STATS_FIELDS)).items() if v is not None
     }
-    print('Group:', group)
     if (len(group) > 0):
         #group['updated_at'] = datetime.now(timezone.utc)
         if 'event' in group:
             group['event'] = ObjectId(group['event'])
 
-        print('Group:', group)
+        previous = group_collection.find_one({'_id': group_id}, {'event': 1}) or {} # the group may move out of an event
         update_result = group_collection.find_one_and_update(
             {'_id': group_id}, # find group by id
             {'$set': group}, # set group values
             return_document= True # return the updated group
         )
-        print('Update result:', update_result)
         if update_result is not None:
+            events = {previous.get('event'), update_result.get('event')} - {None}
+            response_cache.invalidate(cache.group_key(group_id), *[cache.event_key(event) for event in events], db=db)
             return update_result
         else:
             raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Group with that ID not found")
@@ -302,6 +405,10 @@ async def delete_group(group_id:str, db=Depends(connect_to_db), s3=Depends(setup
 
     #delete images in group
     image_collection.delete_many({'group': group_id})
+    keys = [cache.group_key(group_id), *[cache.image_key(image['_id']) for image in images]]
+    if group is not None and group.get('event') is not None:
+        keys.append(cache.event_key(group['event']))
+    response_cache.invalidate(*keys, db=db)
 
     return result
 
@@ -312,23 +419,95 @@ async def remove_event_from_groups(event_id:str, db=Depends(connect_to_db)):
     event_id = ObjectId(event_id) # convert to ObjectId
     group_collection = db.get_collection('image_groups')
 
+    group_ids = [group['_id'] for group in group_collection.find({'event': event_id}, {'_id': 1})]
     update_result = group_collection.update_many(
         {'event': event_id},
         {'$set':
             {'event':None}
         })
-    print(update_result)
+    logger.info('Event removed from groups', event=event_id, groups=update_result.modified_count)
+    response_cache.invalidate(cache.event_key(event_id), *[cache.group_key(group_id) for group_id in group_ids], db=db)
     return {
         'acknowledged':update_result.acknowledged,
         'modified_count':update_result.modified_count
     }
 
+# Summary of an event, the groups with their counts and covers and the totals over all of them
+@app.get("/events/{event_id}/summary", response_model=EventSummary, response_model_by_alias=False, response_model_exclude_none=True,
+         response_description="Get the groups, image count, time span and bounds of an event")
+async def get_event_summary(request: Request, event_id: str, db=Depends(connect_to_db)):
+    if not ObjectId.is_valid(event_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid event id")
+    key = cache.event_key(event_id)
+    version = await asyncio.to_thread(cache.current_version, db, key)
+    if (entry := response_cache.get(key, version)) is not None:
+        return cached_response(request, entry)
+    entry = await single_flights['get_event_summary'].do((event_id, version), lambda: load_event_summary(request, event_id, db, version))
+    return cached_response(request, entry)
+
+async def load_event_summary(request: Request, event_id: str, db, version=None):
+    generation = response_cache.generation
+    summary = await asyncio.to_thread(group_stats.event_summary, db, event_id)
+    return response_cache.set(cache.event_key(event_id), render_body(request, summary), generation, version)
+
+# Near-duplicates in a group, images whose perceptual hashes are at most max_distance bits apart
+@app.get("/image_groups/{group_id}/duplicates", response_model=Duplicates, response_model_by_alias=False,
+         response_description="Get the sets of near-duplicate images in a group")
+async def get_group_duplicates(group_id: str, max_distance: int = Query(duplicates.DEFAULT_MAX_DISTANCE, ge=0, le=16),
+                               db=Depends(connect_to_db)):
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid group id")
+    return await asyncio.to_thread(duplicates.find_duplicates, db, [ObjectId(group_id)], max_distance)
+
+# Near-duplicates over all the groups of an event
+@app.get("/events/{event_id}/duplicates", response_model=Duplicates, response_model_by_alias=False,
+         response_description="Get the sets of near-duplicate images in the groups of an event")
+async def get_event_duplicates(event_id: str, max_distance: int = Query(duplicates.DEFAULT_MAX_DISTANCE, ge=0, le=16),
+                               db=Depends(connect_to_db)):
+    if not ObjectId.is_valid(event_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid event id")
+    group_ids = [group['_id'] for group in db.get_collection('image_groups').find({'event': ObjectId(event_id)}, {'_id': 1})]
+    return await asyncio.to_thread(duplicates.find_duplicates, db, group_ids, max_distance)
+
+ARCHIVE_URL_EXPIRES = 6 * 3600 # seconds the URLs of an archive manifest are valid
+
+# the group and the files of its source folder for an archive, as {name, key, size, last_modified}
+async def archive_files(group_id: str, source: str, db, s3):
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid group id")
+    group = await asyncio.to_thread(db.get_collection('image_groups').find_one, {'_id': ObjectId(group_id)}, {'name': 1})
+    if group is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Group with that ID not found")
+    files = await s3.list_objects(f"{source}/{group_id}/")
+    return group, [{**file, 'name': file['key'].rsplit('/', 1)[-1]} for file in files]
+
+# Download all the images of a group as one ZIP, streamed while it's read from S3
+@app.get("/image_groups/{group_id}/archive", response_class=StreamingResponse, response_description="ZIP of the images of a group")
+async def get_group_archive(group_id: str, source: Literal['original', 'fullsize'] = 'original', db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
+    group, files = await archive_files(group_id, source, db, s3)
+    logger.info('Streaming archive', group=group_id, source=source, files=len(files), bytes=sum(file['size'] for file in files))
+    filename = f"{archive.archive_name(group.get('name'))}.zip"
+    return StreamingResponse(archive.zip_stream(files, s3.read_chunks), media_type='application/zip',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# Presigned URLs of all the images of a group, for groups too large to download as one ZIP
+@app.get("/image_groups/{group_id}/archive/manifest", response_model=ArchiveManifest, response_description="Presigned URLs of the images of a group")
+async def get_group_archive_manifest(group_id: str, source: Literal['original', 'fullsize'] = 'original', db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
+    group, files = await archive_files(group_id, source, db, s3)
+    urls = await s3.presign_downloads([file['key'] for file in files], ARCHIVE_URL_EXPIRES)
+    return {
+        'name': archive.archive_name(group.get('name')),
+        'source': source,
+        'expires_in': ARCHIVE_URL_EXPIRES,
+        'total_bytes': sum(file['size'] for file in files),
+        'files': [{'name': file['name'], 'size': file['size'], 'url': url} for file, url in zip(files, urls)],
+    }
+
 ################### IMAGES ###################
 # Add images to an existing group
 @app.post("/images/{group_id}", response_description="Upload images to a group")
 async def prepare_upload_images_to_group(group_id: str, images: list[str]=Body(None, embed=True), db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
     group_id = ObjectId(group_id) # convert to ObjectId
-    print('Group:', group_id)
 
     group_collection = db.get_collection('image_groups')
     if (group := group_collection.find_one({'_id': group_id})) is not None:
@@ -337,7 +516,6 @@ async def prepare_upload_images_to_group(group_id: str, images: list[str]=Body(N
             image_data = await add_images_to_group(str(group_id), images, db, s3)
         else:
             image_data = []
-        print('Image data:', image_data)
         return {
             'added_images': image_data,
             'group_id': str(group_id),
@@ -346,18 +524,169 @@ async def prepare_upload_images_to_group(group_id: str, images: list[str]=Body(N
     else:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Group with that ID not found")
 
+# scope a query to the groups of an event
+def in_event(query, event, db):
+    if event is not None:
+        group_ids = [group['_id'] for group in db.get_collection('image_groups').find({'event': ObjectId(event)}, {'_id': 1})]
+        query['group'] = {'$in': group_ids}
+    return query
+
+# Get images within a bounding box, for the map view
+@app.get("/images/geo/within", response_model=List[ImageData], response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get images with coordinates within a bounding box, optionally in an event")
+async def get_images_within(request: Request,
+                            min_latitude: float = Query(..., ge=-90, le=90), min_longitude: float = Query(..., ge=-180, le=180),
+                            max_latitude: float = Query(..., ge=-90, le=90), max_longitude: float = Query(..., ge=-180, le=180),
+                            event: str | None = None, limit: int = Query(500, ge=1, le=5000), db=Depends(connect_to_db)):
+    if min_latitude > max_latitude:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="min_latitude is greater than max_latitude")
+    # a box with no area makes a degenerate polygon which the 2dsphere index rejects
+    if min_latitude == max_latitude or min_longitude == max_longitude:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="The bounding box has no area")
+    query = in_event(geo.within_query(min_latitude, min_longitude, max_latitude, max_longitude), event, db)
+    images = list(db.get_collection('images').find(query).limit(limit))
+    if fast_responses:
+        return fast_json_response(request, images)
+    return images
+
+# Get images nearest to a point, nearest first
+@app.get("/images/geo/near", response_model=List[ImageData], response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get images nearest to a point, optionally in an event")
+async def get_images_near(request: Request,
+                          latitude: float = Query(..., ge=-90, le=90), longitude: float = Query(..., ge=-180, le=180),
+                          max_distance: float | None = Query(None, gt=0, description="Max distance in meters"),
+                          event: str | None = None, limit: int = Query(100, ge=1, le=5000), db=Depends(connect_to_db)):
+    query = in_event(geo.near_query(latitude, longitude, max_distance), event, db)
+    images = list(db.get_collection('images').find(query).limit(limit))
+    if fast_responses:
+        return fast_json_response(request, images)
+    return images
+
+# scope a timeline query to a group or to the groups of an event
+def in_group_or_event(query, group, event, db):
+    if group is not None:
+        query['group'] = ObjectId(group)
+        return query
+    return in_event(query, event, db)
+
+# Get images sorted by when they were taken, a page at a time
+@app.get("/timeline/images", response_model=TimelinePage, response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get a page of images taken between start and end, pass next as after to get the next page")
+async def get_timeline_images(request: Request, start: datetime | None = None, end: datetime | None = None,
+                              event: str | None = None, group: str | None = None, after: str | None = None,
+                              order: str = Query('asc', pattern='^(asc|desc)$'), limit: int = Query(100, ge=1, le=1000),
+                              db=Depends(connect_to_db)):
+    query = in_group_or_event(timeline.range_query(start, end), group, event, db)
+    try:
+        images, next_cursor = timeline.find_page(db.get_collection('images'), query, limit, after, order == 'desc')
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    page = {'images': images, 'next': next_cursor}
+    if fast_responses:
+        return fast_json_response(request, page)
+    return page
+
+# Get the number of images taken per minute/hour/day, for the timeline scrubber
+@app.get("/timeline/histogram", response_model=List[HistogramBin], response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get the number of images taken in each bin of time between start and end")
+async def get_timeline_histogram(start: datetime | None = None, end: datetime | None = None,
+                                 event: str | None = None, group: str | None = None,
+                                 unit: str = Query('hour', pattern='^(minute|hour|day)$'), bin_size: int = Query(1, ge=1, le=1000),
+                                 db=Depends(connect_to_db)):
+    query = in_group_or_event(timeline.range_query(start, end), group, event, db)
+    return list(db.get_collection('images').aggregate(timeline.histogram_pipeline(query, unit, bin_size)))
+
+MAX_BATCH_IDS = 1000
+
+# find the images for a list of ids with one $in query, in the order of the ids
+def find_images_by_ids(db, ids: list[str]):
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    object_ids = list({ObjectId(image_id) for image_id in ids if ObjectId.is_valid(image_id)})
+    found = {str(image['_id']): image for image in db.get_collection('images').find({'_id': {'$in': object_ids}})}
+    images = [found.get(image_id) for image_id in ids]
+    return {
+        'images': images,
+        'not_found': [image_id for image_id, image in zip(ids, images) if image is None],
+    }
+
+# Get several images at once, ids is a comma separated list (or repeated), use POST /images for long lists
+@app.get("/images", response_model=ImageBatch, response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get the images for a list of ids, in the same order with null for the ids not found")
+async def get_images_by_ids(request: Request, ids: list[str] = Query(...), db=Depends(connect_to_db)):
+    ids = [image_id.strip() for value in ids for image_id in value.split(',') if image_id.strip()]
+    batch = await asyncio.to_thread(find_images_by_ids, db, ids)
+    if fast_responses:
+        return fast_json_response(request, batch)
+    return batch
+
+@app.post("/images", response_model=ImageBatch, response_model_by_alias=False, response_model_exclude_none=True,
+    response_description="Get the images for a list of ids in the body, in the same order with null for the ids not found")
+async def post_images_by_ids(request: Request, ids: list[str] = Body(..., embed=True), db=Depends(connect_to_db)):
+    batch = await asyncio.to_thread(find_images_by_ids, db, ids)
+    if fast_responses:
+        return fast_json_response(request, batch)
+    return batch
+
 @app.get("/images/{image_id}", response_model=ImageData, response_model_by_alias=False, response_model_exclude_none=True,
     response_description="Get image by id")
-async def get_image(image_id: str, db=Depends(connect_to_db)):
+async def get_image(request: Request, image_id: str, db=Depends(connect_to_db)):
+    key = cache.image_key(image_id)
+    version = await asyncio.to_thread(cache.current_version, db, key)
+    if (entry := response_cache.get(key, version)) is not None:
+        return cached_response(request, entry)
+    entry = await single_flights['get_image'].do((image_id, version), lambda: load_image(request, image_id, db, version))
+    return cached_response(request, entry)
+
+# find the image and render it into the cache, shared by coalesced get_image requests
+async def load_image(request: Request, image_id: str, db, version=None):
+    key = cache.image_key(image_id)
+    generation = response_cache.generation
+
     image_id = ObjectId(image_id) # Convert to ObjectId
     image_collection = db.get_collection('images')
 
-    if (image := image_collection.find_one({'_id': image_id})) is not None:
-        print(image)
-        return image
+    if (image := await asyncio.to_thread(image_collection.find_one, {'_id': image_id})) is not None:
+        return response_cache.set(key, render_body(request, image), generation, version)
     else:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
 
+# Redirect to the image resized to a width and/or height, made from the ladder and cached in S3 on the first request
+@app.get("/images/{image_id}/rendition", response_class=RedirectResponse, status_code=HTTPStatus.TEMPORARY_REDIRECT,
+    response_description="Redirect to the image resized to the width and/or height")
+async def get_rendition(image_id: str, width: Optional[int] = Query(None, gt=0), height: Optional[int] = Query(None, gt=0),
+                        fit: Literal[renditions.FITS] = 'contain', image_format: Literal[tuple(renditions.FORMATS)] = Query('jpeg', alias='format'),
+                        db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
+    if not ObjectId.is_valid(image_id):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid image id")
+    if width is None and height is None:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="A width or a height is needed")
+    if any(size is not None and size not in rendition_sizes for size in (width, height)):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=f"Sizes must be one of {sorted(rendition_sizes)}")
+    image = await asyncio.to_thread(db.get_collection('images').find_one, {'_id': ObjectId(image_id)},
+                                    {'group': 1, 'filename': 1, renditions.RENDITIONS: 1})
+    if image is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
+
+    prefix = renditions.cache_prefix(image['group'], image['filename'])
+    name = renditions.cache_name(width, height, fit, image_format)
+    key = f"{prefix}/{name}"
+    async def make_rendition(): # on a miss, shared by the concurrent requests for the same one
+        if await s3.file_exists(key):
+            return
+        source = renditions.source_key(image, width, height, fit)
+        body = await s3.download_file(source)
+        if body is None:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image not processed yet")
+        rendered = await asyncio.to_thread(renditions.render, body, width, height, fit, image_format)
+        await asyncio.to_thread(s3.upload_file, rendered, prefix, name)
+        logger.info('Dynamic rendition made', key=key, source=source, bytes=len(rendered))
+    await single_flights['get_rendition'].do(key, make_rendition)
+
+    url = await s3.presign_download(key, RENDITION_URL_EXPIRES)
+    # cached for less than the URL is valid
+    return RedirectResponse(url, status_code=HTTPStatus.TEMPORARY_REDIRECT, headers={'Cache-Control': f"private, max-age={RENDITION_URL_EXPIRES // 2}"})
+
 @app.patch("/images/{image_id}", response_model=ImageData, response_model_by_alias=False, response_model_exclude_none=True,
     response_description="Edit an image of that id, description and group to change")
 async def edit_image(image_id: str, data:Annotated[UpdateImageData, Body(embed=True)], db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
@@ -371,25 +700,126 @@ async def edit_image(image_id: str, data:Annotated[UpdateImageData, Body(embed=T
 
     if (len(data) > 0):
         if 'group' in data:
-            print('moving image to another group')
             data['group'] = ObjectId(data['group'])
+        old_image = image_collection.find_one({'_id': image_id})
+        if old_image is None:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
+        moving = 'group' in data and data['group'] != old_image['group']
+        if moving:
+            # move the files first, the image is only updated once they're in the new group
+            logger.info('Moving image', image=image_id, from_group=old_image['group'], to_group=data['group'])
+            moved = await s3.move_image(str(old_image['group']), str(data['group']), old_image['filename'])
+            if errors := [item['error'] for item in moved if 'error' in item]: # the files were moved back
+                raise HTTPException(status_code=HTTPStatus.BAD_GATEWAY, detail=f"Moving the image files failed: {errors[0]}")
+            if (filename := moved_filename(moved)) != old_image['filename']: # renamed, the name was taken in the new group
+                data['filename'] = filename
+            if old_renditions := (old_image.get('data') or {}).get('renditions'):
+                data[renditions.RENDITIONS] = renditions.moved(old_renditions, data['group'], filename)
         data_result = image_collection.find_one_and_update({'_id': image_id}, {'$set': data}, return_document=True) # update image
-        print('edit image result', data_result)
         if data_result is None:
             raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
-        elif 'group' in data:
-            #move image
-            print('move image prepare')
-            await s3.move_image(str(data_result['group']), data['group'], data_result['filename'])
+        if moving:
+            group_stats.image_moved(db, old_image['group'], data['group'], old_image)
+        invalidate_groups(db, [old_image['group'], data_result['group']], cache.image_key(image_id))
 
     else:
         data_result = image_collection.find_one({'_id': image_id})
 
     return data_result
 
+S3_MOVE_CONCURRENCY = 16 # image moves running at the same time in a bulk edit
+
+# the filename of an image after s3.move_image, from the key of its original
+def moved_filename(moved):
+    return moved[0]['new_key'].rsplit('/', 1)[-1]
+
+# Edit many images at once, the descriptions and groups, with one bulk write
+@app.patch("/images", response_description="Edit a list of images, returns a result for each of them in the same order")
+async def edit_images(updates: list[BulkImageUpdate] = Body(..., embed=True), db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
+    if len(updates) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=f"At most {MAX_BATCH_IDS} images per request")
+    image_collection = db.get_collection('images')
+    results = [{'id': update.id} for update in updates]
+
+    # the images and destination groups, one query each
+    object_ids = [ObjectId(update.id) for update in updates if ObjectId.is_valid(update.id)]
+    old_images = {image['_id']: image for image in image_collection.find({'_id': {'$in': object_ids}})}
+    new_groups = {ObjectId(update.group) for update in updates if update.group is not None and ObjectId.is_valid(update.group)}
+    existing_groups = {group['_id'] for group in db.get_collection('image_groups').find({'_id': {'$in': list(new_groups)}}, {'_id': 1})}
+
+    operations = []
+    moves = {} # destination group: [(old group, image, update, result)]
+    seen = set()
+    for update, result in zip(updates, results):
+        data = {k: v for k, v in update.model_dump(exclude={'id'}).items() if v is not None}
+        if not ObjectId.is_valid(update.id):
+            result['status'] = 'invalid_id'
+            continue
+        image_id = ObjectId(update.id)
+        if image_id in seen:
+            result['status'] = 'duplicate'
+            continue
+        seen.add(image_id)
+        if (old_image := old_images.get(image_id)) is None:
+            result['status'] = 'not_found'
+            continue
+        if 'group' in data:
+            if not ObjectId.is_valid(data['group']) or ObjectId(data['group']) not in existing_groups:
+                result['status'] = 'group_not_found'
+                continue
+            data['group'] = ObjectId(data['group'])
+        if all(old_image.get(k) == v for k, v in data.items()):
+            result['status'] = 'unchanged'
+            continue
+        result['status'] = 'updated'
+        if data.get('group', old_image['group']) != old_image['group']:
+            moves.setdefault(data['group'], []).append((old_image['group'], old_image, data, result))
+        else:
+            operations.append(UpdateOne({'_id': image_id}, {'$set': data}))
+
+    # move the files first, each destination group in turn with the moves into it in parallel. Only the images whose
+    # files moved are updated, so an image's group is always the one its files are in
+    semaphore = asyncio.Semaphore(S3_MOVE_CONCURRENCY)
+    async def move(old_group, new_group, image, data, result, new_filename):
+        async with semaphore:
+            moved = await s3.move_image(str(old_group), str(new_group), image['filename'], new_filename)
+        errors = [item['error'] for item in moved if 'error' in item]
+        result['moved'] = not errors
+        if errors:
+            result['status'] = 'move_failed'
+            result['error'] = errors[0]
+            return
+        update = dict(data)
+        if (filename := moved_filename(moved)) != image['filename']: # renamed, the name was taken in the new group
+            update['filename'] = result['filename'] = filename
+        if old_renditions := (image.get('data') or {}).get('renditions'): # the rendition keys are in the new group
+            update[renditions.RENDITIONS] = renditions.moved(old_renditions, new_group, filename)
+        operations.append(UpdateOne({'_id': image['_id']}, {'$set': update}))
+        moved_groups.update([old_group, new_group])
+    moved_groups = set()
+    for new_group, images in moves.items():
+        # the names are picked together so two images with the same filename don't get the same key
+        names = await s3.reserve_filenames(str(new_group), [image['filename'] for _, image, _, _ in images])
+        await asyncio.gather(*[move(old_group, new_group, image, data, result, name)
+                               for (old_group, image, data, result), name in zip(images, names)])
+    if operations:
+        image_collection.bulk_write(operations, ordered=False)
+
+    # recompute the aggregates of the groups images moved between, cheaper than updating them one image at a time
+    if moved_groups:
+        group_stats.rebuild(db, list(moved_groups))
+    updated_ids = [ObjectId(result['id']) for result in results if result['status'] == 'updated']
+    touched_groups = moved_groups | {old_images[image_id]['group'] for image_id in updated_ids}
+    invalidate_groups(db, touched_groups, *[cache.image_key(image_id) for image_id in updated_ids])
+
+    return {
+        'updated': len(updated_ids),
+        'moved': sum(1 for result in results if result.get('moved')),
+        'results': results,
+    }
+
 @app.patch("/images/{image_id}/file", response_description="Edit an image of that id")
 async def replace_image(image_id: str, image:str=Body(..., embed=True), db=Depends(connect_to_db), s3=Depends(setup_s3_handler)):
-    print('Image:', image)
     image_id = ObjectId(image_id) # Convert to ObjectId
     image_collection = db.get_collection('images')
 
@@ -402,6 +832,7 @@ async def replace_image(image_id: str, image:str=Body(..., embed=True), db=Depen
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
 
     image_result = await prepare_upload_single_image(old_image['group'], image, image_collection, s3, image_id)
+    invalidate_groups(db, [old_image['group']], cache.image_key(image_id))
 
     return image_result
 
@@ -415,80 +846,34 @@ async def delete_image(image_id:str, db=Depends(connect_to_db), s3=Depends(setup
     result = image_collection.find_one_and_delete({'_id': image_id})
     if result is None:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Image with that ID not found")
-    print('delete_image, prepare', result)
+    logger.info('Image deleted', image=image_id, group=result['group'], filename=result['filename'])
+    group_stats.image_removed(db, result['group'], result)
+    invalidate_groups(db, [result['group']], cache.image_key(image_id))
     await s3.delete_image(result['group'], result['filename']) # delete image from s3
 
     return result
 
 
 
-# Process S3 image after upload, called by handler in response to S3 event
-async def process_s3_image(event, context):
-    print('Processing S3 image...')
-    print('Event:', event)
-    s3_event = event["Records"][0]["s3"]
-    #bucket_name = s3_event['bucket']['name']
-    key = s3_event['object']['key']
+asgi_handler = Mangum(app=app, lifespan="off") # Use Mangum to handle AWS Lambda events, created once per container
 
-    path_parts = key.split('/')
-    if (len(path_parts) == 3):
-        group_id = path_parts[1]
-        filename = path_parts[-1]
-
-        # Depends won't work here because not in FastAPI context
-        dbo = connect_to_db()
-        print(dbo)
-        print(type(dbo))
-        db = next(dbo) # Get db connection
-        print(db)
-        s3 = S3Handler() # Get S3 handler
-
-        processed_image = await s3.process_image(group_id, filename)
-
-        image_collection = db.get_collection('images')
-        image = image_collection.find_one_and_update({
-            'filename': filename,
-            'group': ObjectId(group_id)
-        },
-        {'$set': {
-            'data': processed_image['data'],
-            'updated_at': datetime.now(timezone.utc)
-        }},
-        return_document=True)
-        print(image)
-        if 'data' in image and 'DateTime' in image['data']:
-            image['data']['DateTime'] = image['data']['DateTime'].astimezone(timezone.utc).isoformat() # Convert DateTime to ISO format
-        if 'data' in image and 'DateTimeOriginal' in image['data']:
-            image['data']['DateTimeOriginal'] = image['data']['DateTimeOriginal'].astimezone(timezone.utc).isoformat() # Convert DateTime to ISO format
-        results = {
-            'id': str(image['_id']),
-            'filename': image['filename'],
-            'group': str(image['group']),
-            'data': image['data'],
-            'files': processed_image['files']
-        }
-        print('Processed image results:', results)
-        return results
-    else:
-        return {'error':'Invalid S3 key format, Expecting "orginal/<group_id>/<filename>"'}
 # This is the handler that AWS Lambda will call first, check event here
 def handler(event, context):
-    print('Event:', event)
-    print('Context:', context)
+    log.correlation_id.set(getattr(context, 'aws_request_id', None) or log.new_correlation_id())
+    logger.debug('Lambda event', event=event)
     if event.get("Records") and event["Records"][0].get('eventSource') == 'aws:s3': # Check if the event is from S3
-        # call the process s3 function
-        loop = asyncio.new_event_loop()
-        t = loop.run_until_complete(process_s3_image(event, context))
-        return t
-
+        # hand it over to the processing entry point, imported here since it's the only path that needs Pillow
+        from app import processing
+        results = processing.handler(event, context)
+        if 'id' in results: # the responses cached in this container
+            invalidate_groups(get_db(), [results['group']], cache.image_key(results['id']))
+        return results
 
-    asgi_handler = Mangum(app=app, lifespan="off") # Use Mangum to handle AWS Lambda events
     response = asgi_handler(event, context) # Call the instance with the event arguments
+    metrics.flush_emf()
 
     return response
 
-#handler = Mangum(app=app, lifespan="off") # Use Mangum to handle AWS Lambda events
-
 if __name__ == "__main__":
    import uvicorn
    uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import threading
+
+
+# In-process metrics, for the limits of a container instead of guessing them from the prints.
+# GET /metrics has them in the Prometheus text format, cumulative since the container started.
+# With METRICS_EMF_NAMESPACE set, the Lambda handlers also print them after every invocation as
+# CloudWatch embedded metric format (EMF) lines, with what changed since the last flush.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+PROCESSING_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60) # seconds
+MEGAPIXELS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+EMF_MAX_VALUES = 100 # distinct values per metric in an EMF line, the most EMF takes
+EMF_DIGITS = 3 # significant digits the histogram values are kept with for EMF, so the same values are counted together
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labels=(), unit='None'):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.unit = unit # the CloudWatch unit for EMF
+        self.values = {} # label values: value
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def series(self):
+        with self.registry.lock:
+            return list(self.values.items())
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flushed = {} # label values: value at the last EMF flush
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    # callback returns {label values: value} when it's read, for values that are cheaper to look at than to keep up to date
+    def __init__(self, *args, callback=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def series(self):
+        if self.callback is not None:
+            return list((self.callback() or {}).items())
+        return super().series()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    # each series is [count per bucket (the last one is +Inf), sum, count, {value: count} since the last EMF flush]
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        rounded = float(f"{value:.{EMF_DIGITS}g}")
+        with self.registry.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0, {}]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+            series[3][rounded] = series[3].get(rounded, 0) + 1
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(str(value))}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), unit='Count'):
+        return self.add(Counter(self, name, help, labels, unit))
+
+    def gauge(self, name, help, labels=(), unit='Count', callback=None):
+        return self.add(Gauge(self, name, help, labels, unit, callback=callback))
+
+    def histogram(self, name, help, labels=(), unit='Seconds', buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(self, name, help, labels, unit, buckets=buckets))
+
+    # the Prometheus text format
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, value in sorted(metric.series()):
+                if metric.kind != 'histogram':
+                    lines.append(f"{metric.name}{format_labels(metric.labels, key)} {format_value(value)}")
+                    continue
+                counts, total, count, _ = value
+                cumulative = 0
+                for bound, bucket_count in zip([*metric.buckets, '+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric.name}_bucket{format_labels(metric.labels, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{format_labels(metric.labels, key)} {format_value(total)}")
+                lines.append(f"{metric.name}_count{format_labels(metric.labels, key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    # EMF lines with the counter increments and the histogram values since the last flush, and the gauges as they are.
+    # The histogram values are sent as Values and Counts, every observation is counted, over more than one line
+    # when there are more than EMF_MAX_VALUES distinct values
+    def emf(self, namespace, timestamp=None):
+        timestamp = int((timestamp or time.time()) * 1000)
+        lines = []
+        def add_line(metric, key, value):
+            lines.append(json.dumps({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [list(metric.labels)],
+                    'Metrics': [{'Name': metric.name, 'Unit': metric.unit}],
+                }]},
+                **dict(zip(metric.labels, key)),
+                metric.name: value,
+            }))
+        for metric in self.metrics.values():
+            for key, value in metric.series():
+                if metric.kind == 'counter':
+                    with self.lock:
+                        increment = value - metric.flushed.get(key, 0)
+                        metric.flushed[key] = value
+                    if increment:
+                        add_line(metric, key, increment)
+                elif metric.kind == 'histogram':
+                    with self.lock:
+                        observed = sorted(value[3].items())
+                        value[3].clear()
+                    for start in range(0, len(observed), EMF_MAX_VALUES):
+                        values, counts = zip(*observed[start:start + EMF_MAX_VALUES])
+                        add_line(metric, key, {'Values': list(values), 'Counts': list(counts)})
+                elif value is not None:
+                    add_line(metric, key, value)
+        return lines
+
+registry = Registry()
+
+# waiting and running work in the thread pools, the asyncio default executor is used by asyncio.to_thread and
+# run_in_executor(None), the anyio limiter by the sync dependencies and routes
+def executor_stats():
+    stats = {}
+    try:
+        executor = asyncio.get_running_loop()._default_executor # private, None until something used it
+    except RuntimeError:
+        executor = None
+    if executor is not None:
+        stats['asyncio_default'] = (executor._work_queue.qsize(), len(executor._threads))
+    try:
+        import anyio.to_thread
+        limiter_stats = anyio.to_thread.current_default_thread_limiter().statistics()
+        stats['anyio'] = (limiter_stats.tasks_waiting, limiter_stats.borrowed_tokens)
+    except Exception: # no anyio or no running event loop
+        pass
+    return stats
+
+requests = registry.histogram('http_request_duration_seconds', 'Request latency by route', ('route', 'method', 'status'))
+requests_in_progress = registry.gauge('http_requests_in_progress', 'Requests being handled')
+mongo_commands = registry.histogram('mongodb_command_duration_seconds', 'MongoDB command latency', ('collection', 'command'))
+mongo_failures = registry.counter('mongodb_command_failures_total', 'Failed MongoDB commands', ('collection', 'command'))
+s3_calls = registry.histogram('s3_request_duration_seconds', 'S3 call latency', ('operation',))
+s3_failures = registry.counter('s3_request_failures_total', 'Failed S3 calls', ('operation',))
+s3_bytes = registry.counter('s3_bytes_total', 'Bytes sent to and received from S3', ('operation', 'direction'), unit='Bytes')
+images_processed = registry.counter('images_processed_total', 'Images processed', ('status',))
+pixels_processed = registry.counter('image_pixels_processed_total', 'Pixels of the processed images')
+processing_duration = registry.histogram('image_processing_duration_seconds', 'Time to process an image', buckets=PROCESSING_BUCKETS)
+processing_rate = registry.histogram('image_processing_megapixels_per_second', 'Megapixels per second for each processed image',
+                                     unit='None', buckets=MEGAPIXELS_PER_SECOND_BUCKETS)
+executor_queue = registry.gauge('executor_queue_depth', 'Work waiting for a thread', ('executor',),
+                                callback=lambda: {(name, ): waiting for name, (waiting, _) in executor_stats().items()})
+executor_workers = registry.gauge('executor_workers', 'Threads of the executor, for anyio the ones in use', ('executor',),
+                                  callback=lambda: {(name, ): workers for name, (_, workers) in executor_stats().items()})
+
+# record a processed image from the metrics of S3Handler.process_image
+def image_processed(image_metrics):
+    images_processed.inc(status='done')
+    if not image_metrics:
+        return
+    pixels_processed.inc(image_metrics['width'] * image_metrics['height'])
+    seconds = image_metrics['total_ms'] / 1000
+    processing_duration.observe(seconds)
+    if seconds > 0:
+        processing_rate.observe(image_metrics['megapixels'] / seconds)
+
+def emf_namespace():
+    return os.getenv('METRICS_EMF_NAMESPACE')
+
+# print the EMF lines for CloudWatch, at the end of a Lambda invocation
+def flush_emf():
+    if (namespace := emf_namespace()) is None:
+        return
+    for line in registry.emf(namespace):
+        print(line) # not through the logger, CloudWatch only reads EMF from lines that are just the JSON
+
+# ASGI middleware for the request latency by route name, pure ASGI so streamed responses aren't buffered
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status = 500 # unless a response starts
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        requests_in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_progress.dec()
+            route = getattr(scope.get('route'), 'name', None) or 'unmatched' # set by the router
+            requests.observe(time.perf_counter() - start, route=route, method=scope['method'], status=status)
@@ -41,15 +41,33 @@ class ImageData(MongoDBModel):
 
     description: Optional[str] = Field(default=None, description="Description of the image")
     group: Optional[PyObjectId] = Field(default=None, description="Group which the image belongs to")
+    status: Optional[str] = Field(default=None, description="Processing status: pending, metadata, renditions, done or failed")
+    status_at: Optional[datetime] = Field(default=None, description="When the status changed")
+    status_error: Optional[str] = Field(default=None, description="Why the processing failed")
 
 
     @field_serializer("group", when_used="json", check_fields=False) # Serializer for id field when used in JSON
     def field_to_str(self, v: PyObjectId) -> str:
         return str(v) if v else None
+class TimelinePage(BaseModel): # page of images sorted by when they were taken
+    images: list[ImageData] = Field(default_factory=list, description="Images in the page")
+    next: Optional[str] = Field(default=None, description="Cursor of the next page, none on the last page")
+
+class ImageBatch(BaseModel): # images for a list of ids
+    images: list[Optional[ImageData]] = Field(default_factory=list, description="Images in the order of the ids, null for the ids not found")
+    not_found: list[str] = Field(default_factory=list, description="Ids which weren't found or aren't valid")
+
+class HistogramBin(BaseModel): # number of images taken in a bin of time
+    start: datetime = Field(description="Start of the bin")
+    count: int = Field(description="Number of images taken in the bin")
+
 class UpdateImageData(BaseModel): # update model for image data because of group id
     description: Optional[str] = Field(default=None, description="Description of the image")
     group: Optional[str] = Field(default=None, description="Group which the image belongs to")
 
+class BulkImageUpdate(UpdateImageData): # update of one image in a bulk edit
+    id: str = Field(description="Id of the image to update")
+
 class UpdateGroupData(BaseModel): # update model for image data because of group id
     name: Optional[str] = Field(default=None, description="Name of the image group")
     description: Optional[str] = Field(default=None, description="Description of the image group")
@@ -57,6 +75,21 @@ class UpdateGroupData(BaseModel): # update model for image data because of group
     images: Optional[list[str]] = Field(default=None, description="List of image names")
 
 
+class GroupCover(BaseModel): # cover image of a group
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    image: Optional[PyObjectId] = Field(default=None, description="Id of the cover image")
+    filename: Optional[str] = Field(default=None, description="Filename of the cover image")
+    thumb: Optional[str] = Field(default=None, description="S3 key of the cover thumbnail")
+    placeholder: Optional[str] = Field(default=None, description="Tiny JPEG data URI to show until the thumbnail loads")
+    dominant_color: Optional[str] = Field(default=None, description="Most common color of the cover, #rrggbb")
+
+class GroupBounds(BaseModel): # bounding box of the coordinates of the images in a group
+    min_latitude: Optional[float] = None
+    max_latitude: Optional[float] = None
+    min_longitude: Optional[float] = None
+    max_longitude: Optional[float] = None
+
 class ImageGroup(MongoDBModel):
     id: Optional[PyObjectId] = Field(alias='_id', default=None, serialization_alias='id')
     name: Optional[str] = None
@@ -65,6 +98,64 @@ class ImageGroup(MongoDBModel):
     event: Optional[PyObjectId] = Field(default=None, description="Event which the group belongs to")
     description: Optional[str] = Field(default=None, description="Description of the group")
 
+    # aggregates maintained from the images, see group_stats
+    image_count: Optional[int] = Field(default=None, description="Number of images in the group")
+    cover: Optional[GroupCover] = Field(default=None, description="Cover image of the group")
+    first_taken: Optional[datetime] = Field(default=None, description="When the earliest image was taken")
+    last_taken: Optional[datetime] = Field(default=None, description="When the latest image was taken")
+    bounds: Optional[GroupBounds] = Field(default=None, description="Bounding box of the image coordinates")
+
     @field_serializer("event", when_used="json", check_fields=False) # Serializer for id field when used in JSON
     def field_to_str(self, v: PyObjectId) -> str:
-        return str(v) if v else None
\ No newline at end of file
+        return str(v) if v else None
+class EventGroup(BaseModel): # group in an event summary, only the name and the aggregates
+    model_config = ConfigDict(arbitrary_types_allowed=True, populate_by_name=True)
+
+    id: Optional[PyObjectId] = Field(alias='_id', default=None, serialization_alias='id')
+    name: Optional[str] = None
+    description: Optional[str] = None
+    image_count: Optional[int] = None
+    cover: Optional[GroupCover] = None
+    first_taken: Optional[datetime] = None
+    last_taken: Optional[datetime] = None
+    bounds: Optional[GroupBounds] = None
+
+class EventSummary(BaseModel): # totals of an event over all of its groups
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    event: Optional[PyObjectId] = Field(default=None, description="Id of the event")
+    group_count: int = Field(default=0, description="Number of groups in the event")
+    image_count: int = Field(default=0, description="Number of images in all the groups")
+    first_taken: Optional[datetime] = Field(default=None, description="When the earliest image was taken")
+    last_taken: Optional[datetime] = Field(default=None, description="When the latest image was taken")
+    bounds: Optional[GroupBounds] = Field(default=None, description="Bounding box of the coordinates of all the images")
+    groups: list[EventGroup] = Field(default_factory=list, description="Groups with their counts and covers, earliest first")
+
+class DuplicateImage(BaseModel): # image in a set of near-duplicates
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    id: Optional[PyObjectId] = Field(default=None, description="Id of the image")
+    filename: Optional[str] = Field(default=None, description="Filename of the image")
+    group: Optional[PyObjectId] = Field(default=None, description="Group of the image")
+    phash: str = Field(description="Perceptual hash of the image, 16 hex digits")
+    distance: int = Field(description="Bits different from the hash of the first image of the set")
+
+class DuplicateSet(BaseModel): # images which are near-duplicates of each other
+    images: list[DuplicateImage] = Field(default_factory=list, description="The images, in the order they were uploaded")
+
+class Duplicates(BaseModel): # near-duplicates in a group or event
+    max_distance: int = Field(description="Most bits different for images to count as duplicates")
+    hashed_images: int = Field(description="Number of images with a perceptual hash which were compared")
+    sets: list[DuplicateSet] = Field(default_factory=list, description="Sets of near-duplicates, the largest first")
+
+class ArchiveFile(BaseModel): # file of a group to download, with a presigned URL
+    name: str = Field(description="Filename in the group")
+    size: int = Field(description="Size in bytes")
+    url: str = Field(description="Presigned URL to download the file")
+
+class ArchiveManifest(BaseModel): # presigned URLs of the files of a group, instead of the ZIP for large groups
+    name: str = Field(description="Name of the group, as used for the ZIP")
+    source: str = Field(description="original or fullsize")
+    expires_in: int = Field(description="Seconds the URLs are valid")
+    total_bytes: int = Field(description="Sum of the sizes of the files")
+    files: list[ArchiveFile] = Field(default_factory=list, description="The files, in the order of their keys")
@@ -0,0 +1,37 @@
+import io
+import base64
+
+
+# Placeholders the gallery can paint before the thumbnails load, made from the thumbnail during the processing.
+# The placeholder is a tiny JPEG as a data URI (a few hundred bytes, shown blurred and stretched) and the
+# dominant color is a hex color for the background of the grid cell. Both are in the image data so the group
+# and image listings have them without any extra request.
+
+PLACEHOLDER_SIDE = 16 # longest side of the placeholder in pixels
+PLACEHOLDER_QUALITY = 40
+COLOR_SAMPLE_SIDE = 64 # the dominant color is taken from the thumbnail reduced to this
+COLOR_BITS = 4 # bits kept of each channel when counting the colors, 4096 buckets
+
+# the image as a tiny JPEG data URI, without the exif
+def placeholder(image, side=PLACEHOLDER_SIDE, quality=PLACEHOLDER_QUALITY):
+    from PIL import Image
+    tiny = image.convert('RGB')
+    tiny.thumbnail((side, side), Image.Resampling.BILINEAR)
+    stream = io.BytesIO()
+    tiny.save(stream, format='JPEG', quality=quality, optimize=True)
+    return 'data:image/jpeg;base64,' + base64.b64encode(stream.getvalue()).decode('ascii')
+
+# the most common color, the pixels are counted in buckets of similar colors and the
+# average of the fullest bucket is returned so it's a color of the image rather than a blend of all of them
+def dominant_color(image, side=COLOR_SAMPLE_SIDE, bits=COLOR_BITS):
+    import numpy as np
+    from PIL import Image
+    sample = image.convert('RGB')
+    sample.thumbnail((side, side), Image.Resampling.BILINEAR)
+    pixels = np.asarray(sample, dtype=np.uint8).reshape(-1, 3)
+    shift = 8 - bits
+    quantized = (pixels >> shift).astype(np.int32)
+    buckets = (quantized[:, 0] << (2 * bits)) | (quantized[:, 1] << bits) | quantized[:, 2]
+    fullest = np.bincount(buckets).argmax()
+    red, green, blue = pixels[buckets == fullest].mean(axis=0).round().astype(int)
+    return f"#{red:02x}{green:02x}{blue:02x}"
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+
+from app.db import get_db
+from app.s3_handler import get_s3_handler
+from app import group_stats, cache, status, metrics, log
+
+
+# Entry point for the S3 upload events. It only imports what the processing needs (no FastAPI or the API routes),
+# so the image processing can be deployed as its own Lambda function with the handler processing.handler.
+# main.handler still hands S3 events over to this module for a single function deployment.
+
+logger = log.get_logger('app.processing')
+shared_cache = cache.shared_backend_from_env() # the API's shared response cache, if there is one
+loop = None # event loop reused by the invocations in the container
+BACKFILLED = 'backfill' # metadata of the originals copied by the backfill, which processes them itself
+
+# invalidate the API responses cached for a processed image, their versions are bumped for the API containers
+# and they're removed from the shared cache
+def invalidate_cached(db, image):
+    keys = [cache.image_key(image['_id']), cache.group_key(image['group'])]
+    group = db.get_collection('image_groups').find_one({'_id': image['group']}, {'event': 1}) or {}
+    if group.get('event') is not None:
+        keys.append(cache.event_key(group['event']))
+    cache.bump_versions(db, keys)
+    if shared_cache is not None:
+        for key in keys:
+            shared_cache.delete(key)
+
+# set the processing status of an image, the responses showing it are invalidated so the clients see each stage
+def set_status(db, image_query, stage, error=None):
+    if (image := status.set_status(db.get_collection('images'), image_query, stage, error)) is not None:
+        invalidate_cached(db, image)
+
+# Process S3 image after upload, extracting its data and creating the fullsize and thumbnail images
+async def process_s3_image(event, context):
+    logger.debug('S3 event', event=event)
+    s3_event = event["Records"][0]["s3"]
+    #bucket_name = s3_event['bucket']['name']
+    key = s3_event['object']['key']
+
+    path_parts = key.split('/')
+    if (len(path_parts) == 3):
+        group_id = path_parts[1]
+        filename = path_parts[-1]
+        # use the clients shared by the container
+        s3 = get_s3_handler()
+        if ((await s3.file_metadata(key)) or {}).get(BACKFILLED):
+            logger.info('Skipping a backfilled image, the backfill processes it', key=key)
+            return {'skipped': key}
+        return await process_image_file(get_db(), s3, group_id, filename)
+    else:
+        return {'error':'Invalid S3 key format, Expecting "orginal/<group_id>/<filename>"'}
+
+# Process the image original/<group_id>/<filename> and save its data, for the S3 events and the backfill
+async def process_image_file(db, s3, group_id, filename):
+    image_collection = db.get_collection('images')
+    image_query = {'filename': filename, 'group': ObjectId(group_id)}
+    set_status(db, image_query, status.METADATA)
+    try:
+        processed_image = await s3.process_image(group_id, filename,
+            on_stage=lambda stage: set_status(db, image_query, stage))
+    except Exception as e:
+        set_status(db, image_query, status.FAILED, str(e) or type(e).__name__)
+        logger.exception('Processing failed', group=group_id, filename=filename)
+        metrics.images_processed.inc(status='failed')
+        raise
+
+    image = image_collection.find_one_and_update(image_query,
+    {'$set': {
+        'data': processed_image['data'],
+        'updated_at': datetime.now(timezone.utc),
+        **status.status_fields(status.DONE),
+    }, '$unset': {'status_error': ''}},
+    return_document=True)
+    metrics.image_processed(processed_image.get('metrics'))
+    group_stats.image_processed(db, image)
+    invalidate_cached(db, image)
+    if 'data' in image and 'DateTime' in image['data']:
+        image['data']['DateTime'] = image['data']['DateTime'].astimezone(timezone.utc).isoformat() # Convert DateTime to ISO format
+    if 'data' in image and 'DateTimeOriginal' in image['data']:
+        image['data']['DateTimeOriginal'] = image['data']['DateTimeOriginal'].astimezone(timezone.utc).isoformat() # Convert DateTime to ISO format
+    results = {
+        'id': str(image['_id']),
+        'filename': image['filename'],
+        'group': str(image['group']),
+        'data': image['data'],
+        'files': processed_image['files'],
+        'metrics': processed_image.get('metrics'),
+    }
+    # one line per image for the log queries, ex: the slowest stage by megapixels
+    logger.info('Image processed', event='image_processed', image=results['id'], group=results['group'], filename=filename, **(results['metrics'] or {}))
+    logger.debug('Processed image data', image=results['id'], data=results['data'], files=results['files'])
+    return results
+
+# check if a Lambda event is an S3 event
+def is_s3_event(event):
+    return bool(event.get("Records")) and event["Records"][0].get('eventSource') == 'aws:s3'
+
+# This is the handler that AWS Lambda calls for the S3 events
+def handler(event, context):
+    global loop
+    log.correlation_id.set(getattr(context, 'aws_request_id', None) or log.new_correlation_id())
+    if not is_s3_event(event):
+        return {'error': 'Not an S3 event'}
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(process_s3_image(event, context))
+    finally:
+        metrics.flush_emf()
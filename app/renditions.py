@@ -0,0 +1,152 @@
+import io
+import os
+import json
+import hashlib
+
+
+# The width ladder of every image, so the gallery can give the browser a srcset and let it pick the size for the
+# layout and screen density instead of always loading the fullsize image. The top of the ladder is the fullsize image
+# (2880 pixels on the longest side at most), below it the narrower widths are in a folder each: w{width}/{group}/{filename}.
+# The widths that aren't narrower than the fullsize image are skipped, nothing is upscaled.
+# The renditions of an image are in its data as [{width, height, key}], narrowest first.
+
+LADDER_WIDTHS = (320, 640, 1280, 1920) # below the fullsize image
+FULLSIZE_FOLDER = 'fullsize'
+RENDITIONS = 'data.renditions'
+
+def folder(width):
+    return f"w{width}"
+
+# the folders of the ladder widths, for deleting and moving all the files of an image
+def ladder_folders(widths=LADDER_WIDTHS):
+    return [folder(width) for width in widths]
+
+def key(folder, group, filename):
+    return f"{folder}/{group}/{filename}"
+
+# the renditions of an image for its data, from its fullsize image and its ladder as (width, image) widest first
+def entries(group, filename, fullsize_image, ladder):
+    return [
+        *[{'width': image.width, 'height': image.height, 'key': key(folder(width), group, filename)} for width, image in reversed(ladder)],
+        {'width': fullsize_image.width, 'height': fullsize_image.height, 'key': key(FULLSIZE_FOLDER, group, filename)},
+    ]
+
+# the renditions with their keys in another group, for when the image is moved
+def moved(renditions, group, filename):
+    return [{**rendition, 'key': key(rendition['key'].split('/', 1)[0], group, filename)} for rendition in renditions]
+
+# Dynamic renditions, for the sizes the ladder doesn't have. GET /images/{image_id}/rendition resizes the image to a
+# width and/or height on the first request and keeps the result in cache/{group}/{filename}/, the next requests are
+# redirected to it. They're made from the narrowest ladder width that's still large enough, never from the original,
+# and only the sizes in RENDITION_SIZES are accepted so the cache stays bounded.
+
+CACHE_FOLDER = 'cache'
+DEFAULT_SIZES = (80, 160, 240, 320, 480, 640, 800, 960, 1280, 1600, 1920)
+FITS = ('contain', 'cover') # in the box keeping the shape, or filling the box and cropping the rest
+FORMATS = {'jpeg': 'JPEG', 'webp': 'WEBP'} # format parameter: Pillow format
+
+# the widths and heights accepted, RENDITION_SIZES is a comma separated list of pixels
+def sizes_from_env():
+    sizes = os.getenv('RENDITION_SIZES')
+    if not sizes:
+        return set(DEFAULT_SIZES)
+    return {int(size) for size in sizes.split(',') if size.strip()}
+
+def cache_prefix(group, filename):
+    return f"{CACHE_FOLDER}/{group}/{filename}"
+
+# the name of a dynamic rendition in the cache prefix of its image, ex: 640x-contain.webp or 320x320-cover.jpeg
+def cache_name(width, height, fit, format):
+    return f"{width or ''}x{height or ''}-{fit}.{format}"
+
+# the size the image is resized to and the size after the crop, for an image of size and the requested box,
+# the image is never upscaled
+def output_size(size, width=None, height=None, fit='contain'):
+    image_width, image_height = size
+    if fit == 'cover' and width and height:
+        shrink = min(1, image_width / width, image_height / height) # a box larger than the image is reduced, keeping its shape
+        cropped = (max(1, round(width * shrink)), max(1, round(height * shrink)))
+        scale = max(cropped[0] / image_width, cropped[1] / image_height)
+        resized = (max(cropped[0], round(image_width * scale)), max(cropped[1], round(image_height * scale)))
+        return resized, cropped
+    scale = min(1, *[box / side for box, side in ((width, image_width), (height, image_height)) if box])
+    resized = (max(1, round(image_width * scale)), max(1, round(image_height * scale)))
+    return resized, resized
+
+# the key of the rendition to make a dynamic one from, the narrowest of the ladder that's at least as large as it
+# has to be resized to, the fullsize image for the images processed before the ladder
+def source_key(image, width=None, height=None, fit='contain'):
+    ladder = (image.get('data') or {}).get('renditions')
+    if not ladder:
+        return key(FULLSIZE_FOLDER, image['group'], image['filename'])
+    widest = ladder[-1]
+    needed_width = output_size((widest['width'], widest['height']), width, height, fit)[0][0]
+    return next(rendition['key'] for rendition in ladder if rendition['width'] >= needed_width or rendition is widest)
+
+# the image in source resized to the box, as bytes in the format, the exif (without GPS in the renditions) is kept
+def render(source: bytes, width=None, height=None, fit='contain', format='jpeg'):
+    from PIL import Image
+    image = Image.open(io.BytesIO(source))
+    resized, cropped = output_size(image.size, width, height, fit)
+    exif = image.info.get('exif')
+    image.draft('RGB', resized) # JPEGs are decoded at a smaller scale when it's still larger than the result
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image = image.resize(resized, Image.LANCZOS)
+    if cropped != resized: # cover, the middle of the image
+        left, top = (resized[0] - cropped[0]) // 2, (resized[1] - cropped[1]) // 2
+        image = image.crop((left, top, left + cropped[0], top + cropped[1]))
+    stream = io.BytesIO()
+    image.save(stream, format=FORMATS[format], **({'exif': exif} if exif else {}))
+    return stream.getvalue()
+
+# Versions of the rendition settings, so the images can be brought up to date when they change (python -m app.reprocess).
+# The processing records in the image data the rendition_version, a hash of the settings, and the rendition_specs,
+# the format and size each file was made with by folder: {'fullsize': 'jpeg/2880', 'thumb': 'jpeg/300', 'w320': 'jpeg/320'}.
+
+LEGACY_FORMAT = 'jpeg' # the settings before they were recorded
+LEGACY_FULLSIZE_SIDE = 2880
+LEGACY_THUMBNAIL_SIDE = 300
+
+# the rendition settings of an S3Handler
+def settings(handler):
+    return {
+        'format': handler.rendition_format,
+        'fullsize_side': handler.fullsize_side,
+        'thumbnail_side': handler.thumbnail_side,
+        'ladder_widths': sorted(handler.ladder_widths),
+    }
+
+def version(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+def spec(format, size):
+    return f"{format}/{size}"
+
+def spec_size(spec):
+    return int(spec.rsplit('/', 1)[-1])
+
+# the specs of the files of an image with those settings, the ladder depends on the width of its fullsize image
+def specs(settings, fullsize_width):
+    format = settings['format']
+    expected = {
+        FULLSIZE_FOLDER: spec(format, settings['fullsize_side']),
+        'thumb': spec(format, settings['thumbnail_side']),
+    }
+    for width in settings['ladder_widths']:
+        if width < fullsize_width:
+            expected[folder(width)] = spec(format, width)
+    return expected
+
+# the specs the files of an image were made with, from its data
+def recorded_specs(data):
+    if 'rendition_specs' in data:
+        return data['rendition_specs']
+    # processed before the specs were recorded, with the settings of the time
+    recorded = {
+        FULLSIZE_FOLDER: spec(LEGACY_FORMAT, LEGACY_FULLSIZE_SIDE),
+        'thumb': spec(LEGACY_FORMAT, LEGACY_THUMBNAIL_SIDE),
+    }
+    for rendition in (data.get('renditions') or [])[:-1]:
+        recorded[folder(rendition['width'])] = spec(LEGACY_FORMAT, rendition['width'])
+    return recorded
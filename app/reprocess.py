@@ -0,0 +1,232 @@
+import io
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from app import renditions, duplicates, placeholders, status, log
+from app.backfill import Progress
+
+
+# Bring the renditions of the images already processed up to date after the rendition settings of S3Handler change
+# (fullsize_side, thumbnail_side, ladder_widths or rendition_format). Only the images whose rendition_version isn't
+# the current one are looked at, and only their files whose spec changed are made again, the others are left alone.
+# They're made from the fullsize image when it's large enough, which is a few MB instead of the original, and from the
+# original (a full processing) only when the fullsize side grew past what the old fullsize image has.
+# Run with: python -m app.reprocess [--group GROUP_ID ...] [--concurrency 4] [--s3-rate 50] [--dry-run]
+#
+# An image gets the current rendition_version once it's done, so an interrupted run resumes by running it again.
+
+logger = log.get_logger('app.reprocess')
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_S3_RATE = 50 # S3 requests per second, 0 for no limit
+BATCH_SIZE = 200 # images read from MongoDB at a time
+REPORT_INTERVAL = 10 # seconds between the progress lines
+IN_PROGRESS = [status.PENDING, status.METADATA, status.RENDITIONS, status.FAILED] # left to the upload processing
+
+# token bucket of the S3 requests, acquire waits until there are enough tokens, a count larger than the
+# bucket is let through when it's full and leaves it in debt
+class RateLimiter:
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, count=1):
+        if not self.rate:
+            return
+        async with self.lock: # in turn, so a large count isn't starved by the small ones
+            while True:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                needed = min(count, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+# the query for the images to bring up to date
+def stale_query(version, group_ids=None):
+    query = {
+        'data.rendition_version': {'$ne': version},
+        'data': {'$exists': True, '$ne': {}}, # processed
+        'status': {'$nin': IN_PROGRESS},
+    }
+    if group_ids:
+        query['group'] = {'$in': list(group_ids)}
+    return query
+
+# what's out of date in an image's files and what to make them from: the fullsize image when it has at least as many
+# pixels as the new fullsize image needs, else the original. stale and extra (folders to delete) are None when they
+# depend on the width of the new fullsize image, which is only known once it's made
+def plan(data, settings):
+    recorded = renditions.recorded_specs(data)
+    ladder = data.get('renditions') or []
+    fullsize_size = (ladder[-1]['width'], ladder[-1]['height']) if ladder else None
+    fullsize_spec = renditions.spec(settings['format'], settings['fullsize_side'])
+    if recorded.get(renditions.FULLSIZE_FOLDER) == fullsize_spec and fullsize_size is not None:
+        expected = renditions.specs(settings, fullsize_size[0])
+        return {
+            'source': renditions.FULLSIZE_FOLDER,
+            'stale': {folder for folder, spec in expected.items() if recorded.get(folder) != spec},
+            'extra': set(recorded) - set(expected),
+        }
+    old_side = renditions.spec_size(recorded[renditions.FULLSIZE_FOLDER])
+    original_size = data.get('original_size') or fullsize_size
+    # the old fullsize image is large enough if it's smaller than the old side, it's the original's size then
+    large_enough = settings['fullsize_side'] <= old_side or (original_size is not None and max(original_size) < old_side)
+    return {'source': renditions.FULLSIZE_FOLDER if large_enough else 'original', 'stale': None, 'extra': None}
+
+# make the stale files of an image from its fullsize image, returns the fields of its data to $set,
+# None if the fullsize image is missing
+async def remake_from_fullsize(s3, image, settings, limiter):
+    from PIL import Image
+    group, filename = str(image['group']), image['filename']
+    data = image['data']
+    recorded = renditions.recorded_specs(data)
+    await limiter.acquire()
+    body = await s3.download_file(renditions.key(renditions.FULLSIZE_FOLDER, group, filename))
+    if body is None:
+        return None
+
+    def make(): # in a thread, Pillow releases the GIL while resizing and encoding
+        source = Image.open(io.BytesIO(body))
+        exif = source.info.get('exif') # the fullsize image has no GPS data
+        fullsize_image, ladder, thumbnail_image = s3.make_renditions(source)
+        expected = renditions.specs(settings, fullsize_image.width)
+        stale = {folder for folder, spec in expected.items() if recorded.get(folder) != spec}
+        images = {renditions.FULLSIZE_FOLDER: fullsize_image, 'thumb': thumbnail_image,
+                  **{renditions.folder(width): rung for width, rung in ladder}}
+        streams = {folder: s3.encode_rendition(images[folder], exif) for folder in stale}
+        fields = {
+            'data.renditions': renditions.entries(group, filename, fullsize_image, ladder),
+            'data.rendition_specs': expected,
+        }
+        if 'thumb' in stale: # they're made from the thumbnail
+            fields['data.phash'] = duplicates.dhash(thumbnail_image)
+            fields['data.placeholder'] = placeholders.placeholder(thumbnail_image)
+            fields['data.dominant_color'] = placeholders.dominant_color(thumbnail_image)
+        return streams, set(recorded) - set(expected), fields
+    streams, extra, fields = await asyncio.to_thread(make)
+
+    await limiter.acquire(len(streams) + len(extra))
+    content_type = f"image/{settings['format']}"
+    await asyncio.gather(
+        *[asyncio.to_thread(s3.upload_file, stream, f"{folder}/{group}", filename, content_type) for folder, stream in streams.items()],
+        *[asyncio.to_thread(s3.delete_file, renditions.key(folder, group, filename)) for folder in extra],
+    )
+    return fields
+
+# bring one image up to date, returns what was done: version (nothing to make), fullsize (made from the fullsize
+# image) or original (processed again)
+async def reprocess_image(db, s3, image, settings, limiter):
+    from app.processing import invalidate_cached, process_image_file
+    images_collection = db.get_collection('images')
+    group, filename = str(image['group']), image['filename']
+    version = renditions.version(settings)
+    planned = plan(image['data'], settings)
+
+    if planned['stale'] is not None and not planned['stale'] and not planned['extra']:
+        images_collection.update_one({'_id': image['_id']}, {'$set': {'data.rendition_version': version}})
+        return 'version'
+    if planned['source'] == renditions.FULLSIZE_FOLDER:
+        fields = await remake_from_fullsize(s3, image, settings, limiter)
+        if fields is not None:
+            fields['data.rendition_version'] = version
+            fields['updated_at'] = datetime.now(timezone.utc)
+            updated = images_collection.find_one_and_update({'_id': image['_id']}, {'$set': fields}, return_document=True)
+            invalidate_cached(db, updated)
+            return renditions.FULLSIZE_FOLDER
+        logger.warning('Fullsize image missing, processing the original', group=group, filename=filename)
+
+    # every file is made from the original, then the ones no longer in the settings are deleted
+    await limiter.acquire(3 + len(settings['ladder_widths']) + 2) # the checks, download and uploads
+    if not await s3.file_exists(f"original/{group}/{filename}"):
+        raise FileNotFoundError(f"original/{group}/{filename}") # before the processing, which would mark the image as failed
+    results = await process_image_file(db, s3, group, filename)
+    extra = set(renditions.recorded_specs(image['data'])) - set(results['data']['rendition_specs'])
+    await limiter.acquire(len(extra))
+    await asyncio.gather(*[asyncio.to_thread(s3.delete_file, renditions.key(folder, group, filename)) for folder in extra])
+    return 'original'
+
+async def reprocess(db, s3, group_ids=None, concurrency=DEFAULT_CONCURRENCY, s3_rate=DEFAULT_S3_RATE, dry_run=False,
+                    report=print, report_interval=REPORT_INTERVAL):
+    settings = renditions.settings(s3)
+    version = renditions.version(settings)
+    images_collection = db.get_collection('images')
+    query = stale_query(version, group_ids)
+    progress = Progress(images_collection.count_documents(query))
+    report(f"{progress.total} images to bring up to rendition version {version}")
+    if dry_run:
+        sources = {}
+        for image in images_collection.find(query, {'data': 1}):
+            source = plan(image['data'], settings)['source']
+            sources[source] = sources.get(source, 0) + 1
+        report(', '.join(f"{count} from the {source}" for source, count in sorted(sources.items())) or 'Nothing to do')
+        return {**progress.summary(), 'sources': sources}
+
+    limiter = RateLimiter(s3_rate)
+    outcomes = {}
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    async def worker():
+        while (image := await queue.get()) is not None:
+            try:
+                outcome = await reprocess_image(db, s3, image, settings, limiter)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                progress.image_processed(None)
+            except Exception:
+                logger.exception('Reprocessing an image failed', image=image['_id'], group=image['group'])
+                progress.failed += 1
+    async def reporter():
+        while True:
+            await asyncio.sleep(report_interval)
+            report(progress.line())
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    reporting = asyncio.create_task(reporter())
+    try:
+        last_id = None
+        while True: # in batches by _id, the images done drop out of the query and the failed ones are passed
+            batch_query = query if last_id is None else {**query, '_id': {'$gt': last_id}}
+            batch = await asyncio.to_thread(lambda: list(images_collection.find(batch_query, {'group': 1, 'filename': 1, 'data': 1})
+                                                         .sort('_id', 1).limit(BATCH_SIZE)))
+            if not batch:
+                break
+            for image in batch:
+                await queue.put(image)
+            last_id = batch[-1]['_id']
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        reporting.cancel()
+        for task in workers:
+            task.cancel()
+    report(progress.line())
+    return {**progress.summary(), 'outcomes': outcomes}
+
+def main():
+    from bson import ObjectId
+    from app.db import connect_to_db
+    from app.s3_handler import get_s3_handler
+    parser = argparse.ArgumentParser(description="Make the renditions of the images processed with older rendition settings again")
+    parser.add_argument('--group', action='append', help="Group id to reprocess, all groups when not given")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="Images reprocessed at the same time")
+    parser.add_argument('--s3-rate', type=float, default=DEFAULT_S3_RATE, help="Most S3 requests per second, 0 for no limit")
+    parser.add_argument('--dry-run', action='store_true', help="Only count the images and what they'd be made from")
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL, help="Seconds between the progress lines")
+    args = parser.parse_args()
+
+    db = next(connect_to_db())
+    group_ids = [ObjectId(group) for group in args.group] if args.group else None
+    summary = asyncio.run(reprocess(db, get_s3_handler(), group_ids, concurrency=args.concurrency, s3_rate=args.s3_rate,
+                                    dry_run=args.dry_run, report_interval=args.report_interval))
+    logger.info('Reprocess finished', event='reprocess_finished', **summary)
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,31 @@ import boto3
 from botocore.exceptions import ClientError
 import os
 from dotenv import load_dotenv
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
 
 import io
 import asyncio
 import re
 import mimetypes
+from datetime import datetime, timedelta, timezone
+import contextvars
 from concurrent.futures import ThreadPoolExecutor
-from app.image_data_handler import ImageDataHandler
+from app.timing import StageTimer, peak_rss_mb
+from app.instrumentation import instrument_boto_client
+from app.log import get_logger
+from app import duplicates, placeholders, renditions, status
 
+logger = get_logger('app.s3_handler')
+
+# run_in_executor with the caller's context, like asyncio.to_thread, so the S3 calls are timed for the request
+# profiling them and logged with its correlation id
+def in_executor(loop, pool, fn, *args):
+    return loop.run_in_executor(pool, contextvars.copy_context().run, fn, *args)
 
 class S3Handler:
     fullsize_side = 2880
     thumbnail_side = 300
+    ladder_widths = renditions.LADDER_WIDTHS # below the fullsize side, for srcset
+    rendition_format = 'jpeg' # jpeg or webp, changing these needs python -m app.reprocess for the images already processed
 
     # Initialize the S3 client, assuming a role to access S3
     def __init__(self):
@@ -29,71 +40,73 @@ class S3Handler:
             RoleSessionName='bandpics-s3-session'
         )
         temp_credentials = response["Credentials"]
+        self.expiration = temp_credentials.get('Expiration') # when the assumed role credentials expire
 
-        self.s3_client = boto3.client('s3',
+        self.s3_client = instrument_boto_client(boto3.client('s3',
             region_name=self.aws_region,
             aws_secret_access_key=temp_credentials['SecretAccessKey'],
             aws_access_key_id=temp_credentials['AccessKeyId'],
-            aws_session_token=temp_credentials['SessionToken'])
+            aws_session_token=temp_credentials['SessionToken']))
         self.bucket_name = os.getenv('S3_BUCKET_NAME')
 
+    # check if the credentials expire within the margin, so a shared handler can be replaced before they do
+    def expiring(self, margin=timedelta(minutes=5)):
+        return self.expiration is not None and datetime.now(timezone.utc) + margin >= self.expiration
+
     # Direct upload to S3, deprecated since lambda's limits favour presigned URLs
-    def upload_file(self, file_bytes, prefix, filename):
+    def upload_file(self, file_bytes, prefix, filename, content_type=None):
         try:
-            print(f"Bucket: {self.bucket_name}")
-            mime, encoding = mimetypes.guess_type(filename)
+            mime = content_type or mimetypes.guess_type(filename)[0]
             s3_task = self.s3_client.put_object(
                 Body=file_bytes,
                 Bucket=self.bucket_name,
                 Key=f"{prefix}/{filename}",
                 ContentType=mime
             )
-            print(f"File {prefix}/{filename} (Etag: {s3_task['ETag']}) uploaded")
+            logger.debug('File uploaded', key=f"{prefix}/{filename}", etag=s3_task['ETag'])
             return s3_task
         except ClientError as e:
             return {'error': str(e)}
 
     # Delete a file from S3
     def delete_file(self, key):
-        print('deleting', key)
+        logger.debug('Deleting file', key=key)
         try:
             s3_task = self.s3_client.delete_object(
                 Bucket=self.bucket_name,
                 Key=key
             )
-            print(s3_task)
             return s3_task
         except ClientError as e:
-            print(str(e))
+            logger.error('Deleting file failed', key=key, error=str(e))
             return {'error': str(e)}
     # Check if a file exists in S3
     async def file_exists(self, key):
         try:
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: self.s3_client.head_object(Bucket=self.bucket_name, Key=key))
+            await in_executor(loop, None, lambda: self.s3_client.head_object(Bucket=self.bucket_name, Key=key))
             return True
         except ClientError as e:
             if e.response['Error']['Code'] == '404':
                 return False
             else:
-                print(str(e))
+                logger.error('Checking file failed', key=key, error=str(e))
             return False
     # List files in S3 with a prefix
     async def list_files(self, prefix):
         try:
             loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix))
+            response = await in_executor(loop, None, lambda: self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix))
             contents = response.get('Contents', [])
             contents = [item['Key'] for item in contents]
             return contents
         except ClientError as e:
-            print(str(e))
+            logger.error('Listing files failed', prefix=prefix, error=str(e))
             return None
     # Generate a new filename by appending a number if it exists, ex: "image.jpg" becomes "image-1.jpg"
     async def number_matching_files(self, key):
         find = re.sub(r"\.[^.]*$", "", key) # Remove the file extension
         ext = re.search(r"\.[^.]*$", key).group(0) # Get the file extension
-        print(find, ext)
 
         matching_files = await self.list_files(find)
 
@@ -116,22 +129,47 @@ class S3Handler:
             key = await self.number_matching_files(key) # append number to filename if it exists
         return key
 
+    # Copy a file within the bucket, S3 copies it without it being downloaded
+    # the copy keeps the metadata of the file unless new metadata is given, it keeps its content type either way
+    async def copy_file(self, old_key, new_key, metadata=None):
+        loop = asyncio.get_event_loop()
+        replace = {}
+        if metadata is not None: # replacing the metadata replaces the content type too
+            source = await in_executor(loop, None, lambda: self.s3_client.head_object(Bucket=self.bucket_name, Key=old_key))
+            replace = {'Metadata': metadata, 'MetadataDirective': 'REPLACE', 'ContentType': source.get('ContentType', 'binary/octet-stream')}
+        return await in_executor(loop, None, lambda: self.s3_client.copy_object(
+            Bucket=self.bucket_name,
+            CopySource=f"{self.bucket_name}/{old_key}",
+            Key=new_key,
+            **replace
+        ))
+    # The user metadata of a file, None if it doesn't exist
+    async def file_metadata(self, key):
+        loop = asyncio.get_event_loop()
+        try:
+            response = await in_executor(loop, None, lambda: self.s3_client.head_object(Bucket=self.bucket_name, Key=key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response.get('Metadata') or {}
+
     # you can't move an object you must copy the object to a new name and then delete the old one
-    async def move_file(self, filename, old_prefix, new_prefix):
+    # new_filename is used as is when it's given, else the file is renamed if its name is taken in new_prefix
+    async def move_file(self, filename, old_prefix, new_prefix, new_filename=None):
         try:
             old_key = f"{old_prefix}/{filename}"
-            new_key = await self.check_and_rename_file(new_prefix, filename)
-            print('move file', old_key, new_key)
+            if new_filename is not None:
+                new_key = f"{new_prefix}/{new_filename}"
+            else:
+                new_key = await self.check_and_rename_file(new_prefix, filename)
+            logger.info('Moving file', from_key=old_key, to_key=new_key)
 
             loop = asyncio.get_event_loop()
             # Copy to new location
-            await loop.run_in_executor(None, lambda:self.s3_client.copy_object(
-                Bucket=self.bucket_name,
-                CopySource=f"{self.bucket_name}/{old_key}",
-                Key=new_key
-            ))
+            await self.copy_file(old_key, new_key)
             # Delete from old location
-            await loop.run_in_executor(None, lambda:self.s3_client.delete_object(
+            await in_executor(loop, None, lambda:self.s3_client.delete_object(
                 Bucket=self.bucket_name,
                 Key=old_key
             ))
@@ -146,7 +184,7 @@ class S3Handler:
             key = f"original/{filename}"
             mimetype = mimetypes.guess_type(filename)[0]
 
-            presigned_url = await loop.run_in_executor(None, lambda: self.s3_client.generate_presigned_url(
+            presigned_url = await in_executor(loop, None, lambda: self.s3_client.generate_presigned_url(
                 ClientMethod='put_object', # the method in S3, essential that it's ClientMethod
                 Params={'Bucket': self.bucket_name, 'Key': key, 'ContentType':mimetype},
                 ExpiresIn=1800, # expiration time in seconds
@@ -157,96 +195,248 @@ class S3Handler:
 
         except ClientError as e:
             return {'error': str(e)}
+    # Generate a presigned URL for downloading from S3
+    async def presign_download(self, key, expires=3600):
+        return (await self.presign_downloads([key], expires))[0]
+    # Download a file from S3 as bytes, None if it doesn't exist
+    async def download_file(self, key):
+        loop = asyncio.get_event_loop()
+        stream = io.BytesIO()
+        try:
+            await in_executor(loop, None, lambda: self.s3_client.download_fileobj(self.bucket_name, key, stream))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return stream.getvalue()
+    # List the objects under a prefix with their size and modification time, over all the pages,
+    # only the keys after start_after when it's given
+    async def list_objects(self, prefix, start_after=None):
+        loop = asyncio.get_event_loop()
+        def list_all():
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            pages = paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, **({'StartAfter': start_after} if start_after else {}))
+            return [{'key': item['Key'], 'size': item['Size'], 'last_modified': item['LastModified']}
+                    for page in pages for item in page.get('Contents', [])]
+        return await in_executor(loop, None, list_all)
+    # Read a file from S3 in chunks, blocking, for streaming it without holding all of it
+    def read_chunks(self, key, chunk_size):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key) from e
+            raise
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+    # Generate presigned URLs for downloading many files from S3, the signing is local so it's one executor call
+    async def presign_downloads(self, keys, expires=3600):
+        loop = asyncio.get_event_loop()
+        return await in_executor(loop, None, lambda: [self.s3_client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=expires,
+            HttpMethod='GET',
+        ) for key in keys])
+    # Delete the dynamic renditions of an image, they're made again when they're requested
+    async def delete_cached(self, group, filename):
+        loop = asyncio.get_event_loop()
+        keys = await self.list_files(renditions.cache_prefix(group, filename) + '/') or []
+        await asyncio.gather(*[in_executor(loop, None, self.delete_file, key) for key in keys])
+        return keys
+    # Make the fullsize image (the top of the ladder), the narrower widths of the ladder and the thumbnail from an image.
+    # Each width is reduced from the one above it so only the fullsize image is made from the original and every
+    # other resize is from a few megapixels at most, the thumbnail from the narrowest image still larger than it
+    def make_renditions(self, image):
+        from PIL import Image
+        fullsize_image = image.copy() # copy for fullsize
+        fullsize_image.thumbnail((self.fullsize_side, self.fullsize_side), Image.LANCZOS) # resize to max size
+        ladder = [] # (width, image), widest first
+        previous = fullsize_image
+        for ladder_width in sorted(self.ladder_widths, reverse=True):
+            if ladder_width >= fullsize_image.width:
+                continue # not upscaled, the fullsize image covers it
+            ladder_height = max(1, round(fullsize_image.height * ladder_width / fullsize_image.width))
+            previous = previous.resize((ladder_width, ladder_height), Image.LANCZOS)
+            ladder.append((ladder_width, previous))
+        thumbnail_source = next((image for _, image in reversed(ladder) if max(image.size) >= self.thumbnail_side), fullsize_image)
+        thumbnail_image = thumbnail_source.copy() #create a copy for thumbnail
+        thumbnail_image.thumbnail((self.thumbnail_side, self.thumbnail_side), Image.LANCZOS) # resize to thumbnail size
+        return fullsize_image, ladder, thumbnail_image
+
+    # Encode a rendition in the rendition format with the exif (without the GPS data), ready for the upload
+    def encode_rendition(self, image, exif):
+        stream = io.BytesIO()
+        image.save(stream, format=renditions.FORMATS[self.rendition_format], exif=exif or b'')
+        stream.seek(0) # seek beginning so it can be read for the upload
+        return stream
+
     # Process an image that was uploaded to S3, this will create a thumbnail and image sized for display
     # It removes GPS data from the new images
-    async def process_image(self, group, filename):
+    # on_stage is called with the name of each stage as it starts, for the processing status
+    # The result has metrics with the time and bytes of each stage, the megapixels and the peak memory
+    async def process_image(self, group, filename, on_stage=None):
+        # Pillow and the exif handling are only imported when processing, the API doesn't need them
+        from PIL import Image
+        from app.image_data_handler import ImageDataHandler
+
         loop = asyncio.get_event_loop()
-        tasks = []
+        timer = StageTimer()
 
         if await self.file_exists(f"original/{group}/{filename}"): # check if file exists
-            print("Yes file exists")
 
             with ThreadPoolExecutor() as pool:
-                max_size = self.fullsize_side #max size for longest side
-
                 # get image bytes from S3
                 image_stream = io.BytesIO() #stream to hold the image bytes
-                print(self.bucket_name, f"orginal/{group}/{filename}")
                 # download from s3 to image_stream
-                await loop.run_in_executor(pool, lambda: self.s3_client.download_fileobj(self.bucket_name, f"original/{group}/{filename}", image_stream))
-                display_image = Image.open(image_stream) # open the image from stream
-                print(display_image)
-                image_handler = ImageDataHandler(display_image) # create ImageDataHandler
-
-                date_and_coords = image_handler.get_date_and_coords() #get dat and coordinates from image
-                print('Date and coords:', date_and_coords)
-
-                display_exif = image_handler.remove_gps(display_image) #remove gps data
-
-                #Thumbnail image
-                thumbnail_image = display_image.copy() #create a copy for thumbnail
-                thumbnail_image.thumbnail((self.thumbnail_side, self.thumbnail_side), Image.LANCZOS) # resize to thumbnail size
-                thumbnail_stream = io.BytesIO() # prepare stream from thumb
-                thumbnail_image.save(thumbnail_stream, format='JPEG', exif=display_exif) #save thumb
-                thumbnail_stream.seek(0) # seek beginning so it can be read for the upload
-
+                with timer.stage('download'):
+                    await in_executor(loop, pool, lambda: self.s3_client.download_fileobj(self.bucket_name, f"original/{group}/{filename}", image_stream))
+                timer.add_bytes('downloaded', image_stream.getbuffer().nbytes)
+
+                with timer.stage('decode'):
+                    display_image = Image.open(image_stream) # open the image from stream
+                    display_image.load() # decode now so the resize times don't include it
+                width, height = display_image.size
+
+                with timer.stage('exif'):
+                    image_handler = ImageDataHandler(display_image) # create ImageDataHandler
+                    date_and_coords = image_handler.get_date_and_coords() #get dat and coordinates from image
+                    logger.debug('Image data', group=group, filename=filename, data=date_and_coords)
+                    display_exif = image_handler.remove_gps(display_image) #remove gps data
+                if on_stage is not None:
+                    on_stage(status.RENDITIONS)
+
+                #Fullsize image, the top of the ladder, the narrower widths and the thumbnail
+                with timer.stage('resize'):
+                    fullsize_image, ladder, thumbnail_image = self.make_renditions(display_image)
+
+                with timer.stage('encode'):
+                    fullsize_stream = self.encode_rendition(fullsize_image, display_exif)
+                    ladder_streams = [(ladder_width, self.encode_rendition(image, display_exif)) for ladder_width, image in ladder]
+                    thumbnail_stream = self.encode_rendition(thumbnail_image, display_exif)
+                timer.add_bytes('fullsize', fullsize_stream.getbuffer().nbytes)
+                timer.add_bytes('ladder', sum(stream.getbuffer().nbytes for _, stream in ladder_streams))
+                timer.add_bytes('thumb', thumbnail_stream.getbuffer().nbytes)
+
+                with timer.stage('hash'):
+                    date_and_coords['phash'] = duplicates.dhash(thumbnail_image) # from the thumbnail, it's already small
+                with timer.stage('placeholder'):
+                    date_and_coords['placeholder'] = placeholders.placeholder(thumbnail_image)
+                    date_and_coords['dominant_color'] = placeholders.dominant_color(thumbnail_image)
+                fullsize_path = f"{renditions.FULLSIZE_FOLDER}/{group}" # set path for fullsize
                 thumbnail_path = f"thumb/{group}" # path for thumb
-                tasks.append(loop.run_in_executor(pool, self.upload_file, thumbnail_stream,  thumbnail_path, filename)) # upload thumbnail image
-
-                #Fullsize image
-                fullsize_image = display_image.copy() # copy for fullsize
-                size = display_image.size # get size of original, we aren't using this for resizing though
-                print(f"Image size: {size}")
-
-                fullsize_image.thumbnail((max_size, max_size), Image.LANCZOS) # resize to max size
-
-                fullsize_stream = io.BytesIO() # prepare stream for display image
-                fullsize_image.save(fullsize_stream, format='JPEG', exif=display_exif) # save fullsize image to stream
-                fullsize_stream.seek(0) # seek beginning so it can be read for the upload
-
-                fullsize_path = f"fullsize/{group}" # set path for fullsize
-                tasks.append(loop.run_in_executor(pool, self.upload_file, fullsize_stream, fullsize_path, filename)) # upload fullsize image
-
-        await asyncio.gather(*tasks)
+                # the widths and keys for the srcset, narrowest first, and the settings they were made with
+                date_and_coords['renditions'] = renditions.entries(group, filename, fullsize_image, ladder)
+                settings = renditions.settings(self)
+                date_and_coords['rendition_specs'] = renditions.specs(settings, fullsize_image.width)
+                date_and_coords['rendition_version'] = renditions.version(settings)
+                date_and_coords['original_size'] = [width, height]
+
+                # upload them all at the same time
+                # the keys keep the filename whatever the format, the content type is what's served for it
+                content_type = f"image/{self.rendition_format}"
+                with timer.stage('upload'):
+                    await asyncio.gather(
+                        in_executor(loop, pool, self.upload_file, thumbnail_stream, thumbnail_path, filename, content_type),
+                        in_executor(loop, pool, self.upload_file, fullsize_stream, fullsize_path, filename, content_type),
+                        *[in_executor(loop, pool, self.upload_file, stream, f"{renditions.folder(ladder_width)}/{group}", filename, content_type)
+                          for ladder_width, stream in ladder_streams],
+                    )
+                timer.add_bytes('uploaded', timer.bytes['thumb'] + timer.bytes['fullsize'] + timer.bytes['ladder'])
+
+        metrics = timer.result()
+        metrics['width'] = width
+        metrics['height'] = height
+        metrics['megapixels'] = round(width * height / 1_000_000, 2)
+        metrics['peak_rss_mb'] = peak_rss_mb()
         return {
             'filename':filename,
             'data': date_and_coords,
             'files':[
                 f"{fullsize_path}/{filename}",
                 f"{thumbnail_path}/{filename}",
-            ]
+                *[rendition['key'] for rendition in date_and_coords['renditions'][:-1]],
+            ],
+            'metrics': metrics,
         }
 
     # Delete an image and all its different sizes from S3
     async def delete_image(self, group, filename):
-        print('s3_handler delete_image', group, filename)
+        logger.info('Deleting image files', group=group, filename=filename)
         loop = asyncio.get_event_loop()
         tasks = [] # tasks pool
-        folders = ['original', 'fullsize', 'thumb'] # the folders to delete from
+        folders = ['original', 'fullsize', 'thumb', *renditions.ladder_folders(self.ladder_widths)] # the folders to delete from
         files = [] # list of files to delete
         with ThreadPoolExecutor() as pool:
             for folder in folders:
                 key = f"{folder}/{group}/{filename}" # the patterns of the paths
-                tasks.append(loop.run_in_executor(pool, self.delete_file, key)) # delete the file
+                tasks.append(in_executor(loop, pool, self.delete_file, key)) # delete the file
                 files.append(key) # add to files to delete
         await asyncio.gather(*tasks)
+        files += await self.delete_cached(group, filename)
         return {
             'group':group,
             'filename':filename,
             'files':files
         }
 
-    # Move an image and all its different sizes from one group to another
-    async def move_image(self, old_group, new_group, filename):
-        print('s3_handler move_image', old_group, new_group, filename)
+    # Names for images moved into a group at the same time, each one renamed like check_and_rename_file when it's taken
+    # in the group or by a name before it, so moves running together can't get the same key and overwrite each other
+    async def reserve_filenames(self, group, filenames):
+        taken = {item['key'].rsplit('/', 1)[-1] for item in await self.list_objects(f"original/{group}/")}
+        names = []
+        for filename in filenames:
+            name = filename
+            if name in taken:
+                find, ext = os.path.splitext(filename)
+                numbers = [int(match.group(1)) for other in taken if (match := re.fullmatch(re.escape(find) + r"-(\d+)" + re.escape(ext), other))]
+                name = f"{find}-{max(numbers, default=0) + 1}{ext}"
+            taken.add(name)
+            names.append(name)
+        return names
+
+    # Move an image and all its different sizes from one group to another, the original first in the results
+    # They all get the same name, new_filename when it's given (from reserve_filenames), else the image is renamed if
+    # its name is taken in the new group. When a file can't be moved the others are moved back, so the files of an
+    # image are always together in one group
+    async def move_image(self, old_group, new_group, filename, new_filename=None):
+        logger.info('Moving image files', from_group=old_group, to_group=new_group, filename=filename)
         tasks = []
         folders = ['original', 'fullsize', 'thumb'] # the subfolders to move from
+        # the ladder widths an image has depend on its size, and the images processed before there was a ladder have none
+        ladder = renditions.ladder_folders(self.ladder_widths)
+        exists = await asyncio.gather(*[self.file_exists(f"{folder}/{old_group}/{filename}") for folder in ladder])
+        folders += [folder for folder, found in zip(ladder, exists) if found]
+        if new_filename is None:
+            new_filename = (await self.check_and_rename_file(f"original/{new_group}", filename)).rsplit('/', 1)[-1]
 
         for folder in folders:
-            tasks.append(self.move_file(filename, f"{folder}/{old_group}", f"{folder}/{new_group}")) # move the file
+            tasks.append(self.move_file(filename, f"{folder}/{old_group}", f"{folder}/{new_group}", new_filename)) # move the file
         results = await asyncio.gather(*tasks)
+        if any('error' in result for result in results):
+            logger.error('Moving image files failed, moving them back', from_group=old_group, to_group=new_group, filename=filename)
+            await asyncio.gather(*[self.move_file(new_filename, f"{folder}/{new_group}", f"{folder}/{old_group}", filename)
+                                   for folder, result in zip(folders, results) if 'error' not in result])
+            return results
+        await self.delete_cached(old_group, filename) # not worth copying, they're made again in the new group
 
         return results
 
+# S3 handler shared by everything in the container, so the role is assumed and the clients are created once
+# instead of for every request, it's replaced when the credentials are about to expire
+shared_handler = None
+
+def get_s3_handler():
+    global shared_handler
+    if shared_handler is None or shared_handler.expiring():
+        shared_handler = S3Handler()
+    return shared_handler
+
+def reset_s3_handler():
+    global shared_handler
+    shared_handler = None
+
 if __name__ == '__main__':
     s3_handler = S3Handler()
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+import asyncio
+
+
+# Single-flight coalescing, concurrent calls with the same key share one in-flight call and its result
+# instead of each running its own database query
+class SingleFlight:
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.in_flight = {} # key: task of the call in progress
+        self.executed = 0 # calls that actually ran
+        self.coalesced = 0 # calls that shared another call's result
+
+    async def do(self, key, fn):
+        if not self.enabled:
+            self.executed += 1
+            return await fn()
+        task = self.in_flight.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(fn())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None)) # the next call after this one runs again
+        else:
+            self.coalesced += 1
+        # shield so a cancelled request (client gone) doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight),
+        }
+
+# Single-flight for each route, SINGLE_FLIGHT_ROUTES is a comma separated list of the routes to coalesce
+class SingleFlightRoutes:
+    def __init__(self, enabled_routes):
+        self.enabled_routes = set(enabled_routes)
+        self.flights = {}
+
+    def __getitem__(self, route):
+        if route not in self.flights:
+            self.flights[route] = SingleFlight(route, enabled=route in self.enabled_routes)
+        return self.flights[route]
+
+    def stats(self):
+        return {route: flight.stats() for route, flight in self.flights.items()}
+
+def routes_from_env(default='get_images,get_image,get_event_summary'):
+    routes = os.getenv('SINGLE_FLIGHT_ROUTES', default)
+    return SingleFlightRoutes(route.strip() for route in routes.split(',') if route.strip())
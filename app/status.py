@@ -0,0 +1,128 @@
+import json
+import base64
+import asyncio
+from datetime import datetime, timezone
+
+
+# Processing status of the images, written at each stage of the processing so clients can follow their uploads
+# with one long-poll or event stream per group instead of polling every image until its data shows up.
+PENDING = 'pending' # presigned url given, waiting for the upload
+METADATA = 'metadata' # uploaded, reading the exif data
+RENDITIONS = 'renditions' # making and uploading the fullsize and thumbnail images
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = [DONE, FAILED]
+
+POLL_INTERVAL = 1 # seconds between the checks for changes
+
+def now():
+    return datetime.now(timezone.utc)
+
+# fields to $set for a status
+def status_fields(status, error=None):
+    fields = {'status': status, 'status_at': now()}
+    if error is not None:
+        fields['status_error'] = error
+    return fields
+
+# set the status of the image matching query, returns its _id and group (None when there's no image) for the caches
+def set_status(images_collection, query, status, error=None):
+    update = {'$set': status_fields(status, error)}
+    if error is None:
+        update['$unset'] = {'status_error': ''}
+    return images_collection.find_one_and_update(query, update, {'group': 1})
+
+# times in the queries are naive UTC like the ones stored
+def naive_utc(time: datetime):
+    return time.astimezone(timezone.utc).replace(tzinfo=None) if time.tzinfo is not None else time
+
+# the key of a change in a cursor
+def change_key(image):
+    return f"{image['_id']}:{image['status']}"
+
+# The stored times are in milliseconds, so a change can have the same status_at as the last one a client got and
+# a query for the changes after it would miss it. The cursor has the time of the last change and the keys of the
+# changes at that time, the next query includes that time and leaves out the changes the client already has.
+def encode_cursor(since: datetime, seen):
+    value = f"{naive_utc(since).isoformat()}|{','.join(sorted(seen))}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        since, seen = value.split('|')
+        return datetime.fromisoformat(since), set(filter(None, seen.split(',')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# the since and seen of the cursor after a client got the changes
+def advance(since: datetime, seen, changes):
+    if not changes:
+        return since, seen
+    last = changes[-1]['status_at']
+    at_last = {change_key(image) for image in changes if image['status_at'] == last}
+    if since is not None and naive_utc(since) == last: # more changes at the same time
+        at_last |= seen or set()
+    return last, at_last
+
+# the keys of the changes at a time, what a client that got the changes up to that time has
+def seen_at(db, group_id, since: datetime):
+    images = db.get_collection('images').find({'group': group_id, 'status_at': naive_utc(since)}, {'status': 1})
+    return {change_key(image) for image in images if 'status' in image}
+
+# status of the images in a group which changed since, all of them when since is None. The changes at since are
+# left out when they're in seen, all of them when seen is None (a since without a cursor)
+def changes_since(db, group_id, since: datetime = None, seen=None):
+    query = {'group': group_id, 'status': {'$exists': True}}
+    if since is not None:
+        query['status_at'] = {'$gt' if seen is None else '$gte': naive_utc(since)}
+    projection = {'filename': 1, 'status': 1, 'status_at': 1, 'status_error': 1}
+    changes = list(db.get_collection('images').find(query, projection).sort([('status_at', 1), ('_id', 1)]))
+    if since is not None and seen:
+        changes = [image for image in changes if image['status_at'] != naive_utc(since) or change_key(image) not in seen]
+    return changes
+
+# number of images in the group still being processed
+def count_in_progress(db, group_id):
+    return db.get_collection('images').count_documents({'group': group_id, 'status': {'$exists': True, '$nin': FINISHED}})
+
+# wait until there are changes since or the timeout runs out, returns the changes (empty on timeout)
+async def wait_for_changes(db, group_id, since: datetime = None, timeout=20, interval=POLL_INTERVAL, seen=None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        changes = await asyncio.to_thread(changes_since, db, group_id, since, seen)
+        if changes or loop.time() >= deadline:
+            return changes
+        await asyncio.sleep(min(interval, max(0, deadline - loop.time())))
+
+# the JSON for a change
+def change_json(image):
+    change = {
+        'id': str(image['_id']),
+        'filename': image.get('filename'),
+        'status': image['status'],
+        'status_at': image['status_at'].replace(tzinfo=timezone.utc).isoformat() if image.get('status_at') else None,
+    }
+    if image.get('status_error'):
+        change['status_error'] = image['status_error']
+    return change
+
+# server-sent events for the changes in a group, until every image is done or failed or max_duration runs out
+async def event_stream(db, group_id, since: datetime = None, max_duration=300, interval=POLL_INTERVAL, heartbeat=15, seen=None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_duration
+    last_sent = loop.time()
+    while loop.time() < deadline:
+        changes = await asyncio.to_thread(changes_since, db, group_id, since, seen)
+        for image in changes:
+            yield f"event: status\ndata: {json.dumps(change_json(image))}\n\n"
+            last_sent = loop.time()
+        since, seen = advance(since, seen, changes)
+        if await asyncio.to_thread(count_in_progress, db, group_id) == 0:
+            yield "event: done\ndata: {}\n\n"
+            return
+        if loop.time() - last_sent >= heartbeat:
+            yield ": heartbeat\n\n" # comment to keep proxies from closing the connection
+            last_sent = loop.time()
+        await asyncio.sleep(interval)
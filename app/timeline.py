@@ -0,0 +1,65 @@
+import base64
+from datetime import datetime
+from bson import ObjectId
+
+
+# Timeline queries over when images were taken (data.DateTimeOriginal), sorted with keyset pagination,
+# and date histograms for the timeline scrubber. The times are compared as stored, which is the camera's
+# local time without an offset, so the start and end should be given without one too.
+
+TAKEN = 'data.DateTimeOriginal'
+
+# query for images taken between start (inclusive) and end (exclusive), either can be None
+def range_query(start: datetime = None, end: datetime = None):
+    taken = {'$exists': True}
+    if start is not None:
+        taken['$gte'] = start
+    if end is not None:
+        taken['$lt'] = end
+    return {TAKEN: taken}
+
+# cursor for the next page, the taken time and id of the last image of the page
+def encode_cursor(image):
+    value = f"{image['data']['DateTimeOriginal'].isoformat()}|{image['_id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        taken, image_id = value.split('|')
+        return datetime.fromisoformat(taken), ObjectId(image_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# images after the cursor in the sort order, the id breaks ties between images taken at the same time
+def after_query(cursor: str, descending=False):
+    taken, image_id = decode_cursor(cursor)
+    compare = '$lt' if descending else '$gt'
+    return {'$or': [
+        {TAKEN: {compare: taken}},
+        {TAKEN: taken, '_id': {compare: image_id}},
+    ]}
+
+def sort_order(descending=False):
+    direction = -1 if descending else 1
+    return [(TAKEN, direction), ('_id', direction)]
+
+# get a page of images and the cursor of the next page (None if it's the last page)
+def find_page(images_collection, query, limit, after=None, descending=False):
+    if after is not None:
+        query = {'$and': [query, after_query(after, descending)]}
+    images = list(images_collection.find(query).sort(sort_order(descending)).limit(limit + 1)) # one extra to know if there's more
+    next_cursor = encode_cursor(images[limit - 1]) if len(images) > limit else None
+    return images[:limit], next_cursor
+
+# histogram pipeline, counts of images per bin_size units of time
+def histogram_pipeline(query, unit='hour', bin_size=1):
+    return [
+        {'$match': query},
+        {'$group': {
+            '_id': {'$dateTrunc': {'date': f"${TAKEN}", 'unit': unit, 'binSize': bin_size}},
+            'count': {'$sum': 1},
+        }},
+        {'$sort': {'_id': 1}},
+        {'$project': {'_id': 0, 'start': '$_id', 'count': 1}},
+    ]
@@ -0,0 +1,42 @@
+import time
+from contextlib import contextmanager
+
+try:
+    import resource # not on Windows
+except ImportError:
+    resource = None
+
+
+# Timers and byte counters for the stages of the image processing, to see where the time of a slow image goes
+# (download, decode, exif, resize, encode or upload) and to size the Lambda memory tier.
+class StageTimer:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.stages = {} # stage: seconds, in the order they first ran
+        self.bytes = {} # name: byte count
+        self.start = clock()
+
+    # time a stage, running a stage more than once adds up
+    @contextmanager
+    def stage(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + self.clock() - start
+
+    def add_bytes(self, name, count):
+        self.bytes[name] = self.bytes.get(name, 0) + count
+
+    def result(self):
+        return {
+            'stages_ms': {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()},
+            'total_ms': round((self.clock() - self.start) * 1000, 3),
+            'bytes': dict(self.bytes),
+        }
+
+# peak resident memory of the process in MB, None where it isn't available
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # ru_maxrss is in KB on Linux
@@ -0,0 +1,69 @@
+# Benchmark the response_model serialization against the fast encoder for large image groups
+# Run with: python -m benchmarks.bench_encoders --images 2000
+import argparse
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+from app.models import ImageGroup
+from app import encoders
+
+# build a group document shaped like what the get_images aggregation returns
+def make_group(num_images):
+    group_id = ObjectId()
+    taken = datetime(2025, 1, 1, 20, 0, 0)
+    return {
+        '_id': group_id,
+        'name': 'benchmark',
+        'event': ObjectId(),
+        'created_at': taken,
+        'updated_at': taken,
+        'images': [
+            {
+                '_id': ObjectId(),
+                'filename': f"img{i}.jpg",
+                'data': {
+                    'DateTime': taken + timedelta(seconds=i),
+                    'DateTimeOriginal': taken + timedelta(seconds=i),
+                    'OffsetTimeOriginal': '-08:00',
+                    'coords': {'latitude': 49.28 + i / 1e5, 'longitude': -123.12 - i / 1e5},
+                },
+                'description': f"Image {i}",
+                'created_at': taken,
+                'updated_at': taken,
+            } for i in range(num_images)
+        ]
+    }
+
+# what FastAPI does with the response_model, validate the document then serialize the model
+def render_with_model(document):
+    return encoders.render_with_model(ImageGroup, document, by_alias=False, exclude_none=True)
+
+def render_fast(document):
+    return encoders.render(ImageGroup, document, by_alias=False, exclude_none=True)
+
+def time_it(fn, document, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(document)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] # median
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare response_model serialization with the fast encoder")
+    parser.add_argument('--images', type=int, nargs='+', default=[10, 100, 1000, 5000], help="Number of images in the group")
+    parser.add_argument('--repeat', type=int, default=20, help="Number of runs, the median is reported")
+    args = parser.parse_args()
+
+    print(f"{'images':>8} {'model ms':>10} {'fast ms':>10} {'speedup':>8}")
+    for num_images in args.images:
+        document = make_group(num_images)
+        assert render_with_model(document) == render_fast(document), "Outputs differ"
+        model_time = time_it(render_with_model, document, args.repeat)
+        fast_time = time_it(render_fast, document, args.repeat)
+        print(f"{num_images:>8} {model_time * 1000:>10.2f} {fast_time * 1000:>10.2f} {model_time / fast_time:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Benchmark the logging of GET /image_groups?event= on large events, the old print of the whole group list
+# against the structured logger at INFO (the default) and at DEBUG (which still logs the documents)
+# Run with: python -m benchmarks.bench_logging [--groups 50] [--images 200] [--rounds 5]
+# The output goes to /dev/null, so this is the cost of formatting the lines, CloudWatch ingestion is on top of that
+# and is charged by the bytes, which are in the table too. mongomock's $lookup is much slower than MongoDB's,
+# so the share of the route is a lot higher against a real database.
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import time
+from datetime import datetime
+from bson import ObjectId
+
+def seed(db, groups, images):
+    event = ObjectId()
+    group_documents = [{'_id': ObjectId(), 'name': f"Group {g}", 'event': event} for g in range(groups)]
+    db.get_collection('image_groups').insert_many(group_documents)
+    db.get_collection('images').insert_many([{
+        'filename': f"IMG_{i:04d}.jpg", 'group': group['_id'], 'description': None,
+        'data': {'DateTimeOriginal': datetime(2025, 6, 1, 20, 30), 'coords': {'latitude': 49.28, 'longitude': -123.12}},
+    } for group in group_documents for i in range(images)])
+    return event
+
+# median seconds of fn over the rounds
+def timed(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+# bytes fn writes to stdout
+def output_size(fn):
+    stream = io.StringIO()
+    with contextlib.redirect_stdout(stream):
+        fn()
+    return len(stream.getvalue().encode())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the logging of large GET /image_groups responses")
+    parser.add_argument('--groups', type=int, default=50, help="Groups in the event")
+    parser.add_argument('--images', type=int, default=200, help="Images in each group")
+    parser.add_argument('--rounds', type=int, default=5, help="Rounds of each measurement, the median is shown")
+    args = parser.parse_args()
+
+    from mongomock import MongoClient
+    from fastapi.testclient import TestClient
+    from app import log
+    from app.main import app
+    from app.db import connect_to_db
+
+    db = MongoClient().get_database('bench')
+    event = str(seed(db, args.groups, args.images))
+    app.dependency_overrides[connect_to_db] = lambda: db
+    client = TestClient(app)
+    logger = log.get_logger('app.main')
+    # the list the route logs, from the same aggregation
+    group_list = list(db.get_collection('image_groups').aggregate([
+        {'$match': {'event': ObjectId(event)}},
+        {'$lookup': {'from': 'images', 'localField': '_id', 'foreignField': 'group', 'as': 'images'}},
+    ]))
+
+    def old(): # what get_image_groups used to do
+        print('group list', group_list)
+    def new():
+        logger.info('Image groups', event=event, groups=len(group_list))
+        logger.debug('Image group documents', groups=group_list)
+    def route():
+        assert client.get("/image_groups", params={'event': event}).status_code == 200
+
+    results = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results.append(('print', timed(old, args.rounds), output_size(old)))
+        for level in ['INFO', 'DEBUG']:
+            log.setup(level)
+            results.append((f"log {level}", timed(new, args.rounds), output_size(new)))
+        log.setup('INFO')
+        route_seconds = timed(route, args.rounds)
+    log.setup()
+
+    print(f"{args.groups} groups with {args.images} images, GET /image_groups?event= takes {route_seconds * 1000:.1f} ms at INFO")
+    print(f"{'logging':>10} {'ms':>9} {'% of route':>11} {'bytes':>11}")
+    for name, seconds, size in results:
+        print(f"{name:>10} {seconds * 1000:>9.3f} {seconds / route_seconds * 100:>10.1f}% {size:>11}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Benchmark S3Handler.process_image over a synthetic corpus, against moto instead of S3 so it runs offline
+# Run with: python -m benchmarks.bench_processing [--per-class 12] [--classes 1mp 12mp] [--save-baseline]
+# The corpus has JPEGs and PNGs, without exif, with exif and with exif and GPS, in landscape and portrait,
+# for each size class. Latency is the whole process_image call, download to upload.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from itertools import product
+
+SIZE_CLASSES = { # name: landscape width and height
+    '1mp': (1200, 900),
+    '4mp': (2304, 1728),
+    '12mp': (4000, 3000),
+    '24mp': (6000, 4000),
+}
+FORMATS = ['JPEG', 'PNG']
+EXIF_KINDS = ['none', 'exif', 'gps']
+ORIENTATIONS = ['landscape', 'portrait']
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'bench_processing.json')
+BUCKET = 'bench-bucket'
+GROUP = 'bench'
+
+# exif bytes with a date, and coordinates for gps
+def make_exif(kind):
+    import piexif
+    if kind == 'none':
+        return None
+    exif = {'0th': {}, 'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2025:06:01 20:30:00'}, 'GPS': {}, '1st': {}, 'thumbnail': None}
+    if kind == 'gps':
+        exif['GPS'] = {
+            piexif.GPSIFD.GPSLatitudeRef: 'N', piexif.GPSIFD.GPSLatitude: [(49, 1), (16, 1), (5000, 100)],
+            piexif.GPSIFD.GPSLongitudeRef: 'W', piexif.GPSIFD.GPSLongitude: [(123, 1), (7, 1), (3000, 100)],
+        }
+    return piexif.dump(exif)
+
+# an image with gradients and some noise, plain colours compress too well to be like a photo
+def make_image(width, height, image_format, exif_kind):
+    from PIL import Image
+    size = (width, height)
+    image = Image.merge('RGB', [
+        Image.linear_gradient('L').resize(size),
+        Image.effect_noise(size, 24),
+        Image.radial_gradient('L').resize(size),
+    ])
+    stream = io.BytesIO()
+    exif = make_exif(exif_kind)
+    options = {'exif': exif} if exif is not None else {}
+    image.save(stream, format=image_format, **({'quality': 90} if image_format == 'JPEG' else {}), **options)
+    return stream.getvalue()
+
+# the images of a size class, cycling through the variants
+def make_corpus(size_class, count):
+    width, height = SIZE_CLASSES[size_class]
+    variants = list(product(FORMATS, EXIF_KINDS, ORIENTATIONS))
+    corpus = []
+    for i in range(count):
+        image_format, exif_kind, orientation = variants[i % len(variants)]
+        w, h = (width, height) if orientation == 'landscape' else (height, width)
+        filename = f"{size_class}-{i}-{exif_kind}-{orientation}.{'jpg' if image_format == 'JPEG' else 'png'}"
+        corpus.append((filename, make_image(w, h, image_format, exif_kind)))
+    return corpus
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_class(handler, s3_client, size_class, count, verbose=False):
+    corpus = make_corpus(size_class, count)
+    for filename, body in corpus:
+        s3_client.put_object(Bucket=BUCKET, Key=f"original/{GROUP}/{filename}", Body=body)
+
+    latencies, stages, peak_rss, megapixels, failures = [], {}, 0, 0, 0
+    start = time.perf_counter()
+    for filename, _ in corpus:
+        image_start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()): # the pipeline prints a lot
+                result = await handler.process_image(GROUP, filename)
+        except Exception as e:
+            failures += 1
+            print(f"  {filename} failed: {e!r}", file=sys.stderr)
+            continue
+        latencies.append((time.perf_counter() - image_start) * 1000)
+        metrics = result['metrics']
+        megapixels += metrics['megapixels']
+        peak_rss = max(peak_rss, metrics['peak_rss_mb'] or 0)
+        for stage, ms in metrics['stages_ms'].items():
+            stages.setdefault(stage, []).append(ms)
+    elapsed = time.perf_counter() - start
+
+    if not latencies:
+        return {'images': 0, 'failures': failures}
+    return {
+        'images': len(latencies),
+        'failures': failures,
+        'images_per_s': round(len(latencies) / elapsed, 2),
+        'megapixels_per_s': round(megapixels / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'peak_rss_mb': peak_rss, # of the process so far, the classes run smallest first
+        'stages_p50_ms': {stage: round(percentile(values, 50), 1) for stage, values in stages.items()},
+    }
+
+async def run(classes, count, verbose=False):
+    import boto3
+    from moto import mock_aws
+    # moto stands in for S3 and STS, the credentials only have to exist
+    for name, value in [('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench'), ('AWS_DEFAULT_REGION', 'us-east-1'),
+                        ('S3_ROLE_ARN', 'arn:aws:iam::123456789012:role/bench'), ('S3_BUCKET_NAME', BUCKET)]:
+        os.environ.setdefault(name, value)
+    with mock_aws():
+        from app.s3_handler import S3Handler
+        s3_client = boto3.client('s3', region_name=os.environ['AWS_DEFAULT_REGION'])
+        s3_client.create_bucket(Bucket=BUCKET)
+        handler = S3Handler()
+        handler.s3_client = s3_client
+        handler.bucket_name = BUCKET
+        return {size_class: await run_class(handler, s3_client, size_class, count, verbose) for size_class in classes}
+
+# percent change from the baseline, positive is slower
+def change(value, base):
+    return (value - base) / base * 100 if base else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image processing over a synthetic corpus")
+    parser.add_argument('--classes', nargs='+', default=list(SIZE_CLASSES), choices=list(SIZE_CLASSES), help="Size classes to run")
+    parser.add_argument('--per-class', type=int, default=12, help="Images per size class, 12 covers every variant once")
+    parser.add_argument('--baseline', default=BASELINE, help="Baseline file to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the baseline")
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help="Exit with an error when a p50 is more than this percent slower than the baseline")
+    parser.add_argument('--verbose', action='store_true', help="Show what the pipeline prints")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.classes, args.per_class, args.verbose))
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print(f"{'class':>6} {'images':>6} {'img/s':>7} {'MP/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'rss MB':>7} {'vs base p50':>12}  stages p50 ms")
+    regressions = []
+    for size_class, result in results.items():
+        if result['images'] == 0:
+            print(f"{size_class:>6} all {result['failures']} images failed")
+            continue
+        base = baseline.get(size_class)
+        versus = f"{change(result['p50_ms'], base['p50_ms']):+.1f}%" if base else '-'
+        if base and args.max_regression is not None and change(result['p50_ms'], base['p50_ms']) > args.max_regression:
+            regressions.append(size_class)
+        stages = ' '.join(f"{stage}={ms}" for stage, ms in result['stages_p50_ms'].items())
+        print(f"{size_class:>6} {result['images']:>6} {result['images_per_s']:>7} {result['megapixels_per_s']:>7} "
+              f"{result['p50_ms']:>8} {result['p95_ms']:>8} {result['peak_rss_mb']:>7} {versus:>12}  {stages}")
+        if result['failures']:
+            print(f"{'':>6} {result['failures']} failed")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'per_class': args.per_class, 'results': results}, f, indent=2)
+        print('Saved baseline to', args.baseline)
+    if regressions:
+        print(f"p50 regressed more than {args.max_regression}% for: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
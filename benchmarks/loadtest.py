@@ -0,0 +1,212 @@
+# Load test of the API with mixed read and write traffic, in process through httpx's ASGI transport
+# with mongomock (or a local MongoDB with --mongo-url) and moto standing in for S3, so it runs without a network.
+# Run with: python -m benchmarks.loadtest [--groups 200] [--images 50] [--concurrency 20] [--duration 30] [--json out.json]
+# mongomock scans whole collections, so for thousands of groups with hundreds of images point it at a local mongod.
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.bench_processing import percentile, change
+
+BUCKET = 'loadtest-bucket'
+
+# the traffic mix, route: weight
+MIX = {
+    'get_images': 45, # GET /image_groups/{group_id}
+    'get_image': 20, # GET /images/{image_id}
+    'get_image_groups': 10, # GET /image_groups?event=
+    'get_event_summary': 5, # GET /events/{event_id}/summary
+    'edit_image': 5, # PATCH /images/{image_id}
+    'upload_images': 8, # POST /image_groups
+    'delete_group': 7, # DELETE /image_groups/{group_id}, of the groups the test uploaded
+}
+
+# groups and images like the real ones, with their aggregates filled in so no rebuild is needed
+def seed(db, groups, images_per_group, events, rng):
+    from bson import ObjectId
+    from app import group_stats
+    event_ids = [ObjectId() for _ in range(events)]
+    group_documents, image_documents = [], []
+    start = datetime(2025, 1, 1, 18, tzinfo=timezone.utc)
+    for g in range(groups):
+        group_id = ObjectId()
+        group_documents.append({
+            '_id': group_id, 'name': f"Group {g}", 'description': 'Seeded for the load test',
+            'event': event_ids[g % events], 'created_at': start, 'updated_at': start,
+        })
+        for i in range(images_per_group):
+            taken = (start + timedelta(days=g, seconds=i * 30)).replace(tzinfo=None)
+            image_documents.append({
+                '_id': ObjectId(), 'filename': f"IMG_{i:04d}.jpg", 'group': group_id, 'description': None,
+                'data': {
+                    'DateTimeOriginal': taken, 'DateTime': taken,
+                    'coords': {'latitude': 49 + rng.random(), 'longitude': -123 + rng.random()},
+                },
+                'status': 'done', 'status_at': start, 'created_at': start, 'updated_at': start,
+            })
+    db.get_collection('image_groups').insert_many(group_documents)
+    for i in range(0, len(image_documents), 10000):
+        db.get_collection('images').insert_many(image_documents[i:i + 10000])
+
+    stats = group_stats.compute(db)
+    for group_id, group_stat in stats.items():
+        db.get_collection('image_groups').update_one({'_id': group_id}, {'$set': group_stat})
+    return {
+        'events': [str(event_id) for event_id in event_ids],
+        'groups': [str(group['_id']) for group in group_documents],
+        'images': [str(image['_id']) for image in image_documents],
+    }
+
+# one request of a route, returns the status code
+async def call(client, route, ids, uploaded, rng):
+    if route == 'delete_group' and not uploaded:
+        route = 'upload_images' # nothing of ours to delete yet
+    if route == 'get_images':
+        response = await client.get(f"/image_groups/{rng.choice(ids['groups'])}")
+    elif route == 'get_image':
+        response = await client.get(f"/images/{rng.choice(ids['images'])}")
+    elif route == 'get_image_groups':
+        response = await client.get("/image_groups", params={'event': rng.choice(ids['events'])})
+    elif route == 'get_event_summary':
+        response = await client.get(f"/events/{rng.choice(ids['events'])}/summary")
+    elif route == 'edit_image':
+        response = await client.patch(f"/images/{rng.choice(ids['images'])}", json={'data': {'description': f"Edited {rng.random()}"}})
+    elif route == 'upload_images':
+        response = await client.post("/image_groups", json={'group': {
+            'name': 'Load test upload', 'event': rng.choice(ids['events']),
+            'images': [f"upload_{i}.jpg" for i in range(5)],
+        }})
+        if response.status_code == 200:
+            uploaded.append(response.json()['group_id'])
+    elif route == 'delete_group':
+        response = await client.delete(f"/image_groups/{uploaded.pop(rng.randrange(len(uploaded)))}")
+    return route, response.status_code
+
+async def worker(client, ids, uploaded, deadline, remaining, latencies, errors, rng):
+    routes, weights = list(MIX), list(MIX.values())
+    while time.perf_counter() < deadline and remaining[0] > 0:
+        remaining[0] -= 1
+        route = rng.choices(routes, weights)[0]
+        start = time.perf_counter()
+        try:
+            route, status = await call(client, route, ids, uploaded, rng)
+        except Exception as e:
+            route, status = route, repr(e)
+        latencies.setdefault(route, []).append((time.perf_counter() - start) * 1000)
+        if status not in (200, 304):
+            errors.setdefault(route, []).append(status)
+
+async def run(args):
+    import boto3
+    import httpx
+    from moto import mock_aws
+    for name, value in [('AWS_ACCESS_KEY_ID', 'loadtest'), ('AWS_SECRET_ACCESS_KEY', 'loadtest'), ('AWS_DEFAULT_REGION', 'us-east-1'),
+                        ('S3_ROLE_ARN', 'arn:aws:iam::123456789012:role/loadtest'), ('S3_BUCKET_NAME', BUCKET),
+                        ('MONGO_DB_NAME', 'loadtest')]:
+        os.environ.setdefault(name, value)
+
+    with mock_aws():
+        from app import main
+        from app.db import connect_to_db
+        from app.cache import ResponseCache
+        from app.s3_handler import S3Handler
+
+        if args.mongo_url:
+            from pymongo import MongoClient
+            client = MongoClient(args.mongo_url)
+            client.drop_database('loadtest')
+            db = client.get_database('loadtest')
+        else:
+            from mongomock import MongoClient
+            db = MongoClient().get_database('loadtest')
+        rng = random.Random(args.seed)
+        print(f"Seeding {args.groups} groups with {args.images} images each...")
+        ids = seed(db, args.groups, args.images, args.events, rng)
+
+        boto3.client('s3', region_name=os.environ['AWS_DEFAULT_REGION']).create_bucket(Bucket=BUCKET)
+        s3 = S3Handler()
+        main.app.dependency_overrides[connect_to_db] = lambda: db
+        main.app.dependency_overrides[main.setup_s3_handler] = lambda: s3
+        if args.no_cache:
+            main.response_cache = ResponseCache(max_size=0)
+
+        latencies, errors, uploaded = {}, {}, []
+        remaining = [args.requests or float('inf')]
+        transport = httpx.ASGITransport(app=main.app)
+        print(f"Running {args.concurrency} workers for {args.duration}s...")
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest') as client:
+            start = time.perf_counter()
+            deadline = start + args.duration
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): # the app logs every request
+                await asyncio.gather(*[
+                    worker(client, ids, uploaded, deadline, remaining, latencies, errors, random.Random(args.seed + i))
+                    for i in range(args.concurrency)
+                ])
+            elapsed = time.perf_counter() - start
+        main.app.dependency_overrides.clear()
+
+    results = {}
+    for route, values in sorted(latencies.items()):
+        results[route] = {
+            'requests': len(values),
+            'errors': len(errors.get(route, [])),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': round(percentile(values, 50), 2),
+            'p95_ms': round(percentile(values, 95), 2),
+            'p99_ms': round(percentile(values, 99), 2),
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {'elapsed_s': round(elapsed, 2), 'requests': total, 'rps': round(total / elapsed, 1), 'routes': results,
+            'error_samples': {route: [str(status) for status in statuses[:3]] for route, statuses in errors.items()}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API with mixed traffic against local stand-ins")
+    parser.add_argument('--groups', type=int, default=200, help="Number of groups to seed")
+    parser.add_argument('--images', type=int, default=50, help="Number of images in each group")
+    parser.add_argument('--events', type=int, default=20, help="Number of events the groups are spread over")
+    parser.add_argument('--concurrency', type=int, default=20, help="Number of concurrent clients")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to run for")
+    parser.add_argument('--requests', type=int, default=None, help="Stop after this many requests")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed for the data and the traffic")
+    parser.add_argument('--mongo-url', default=None, help="Use this MongoDB (its loadtest database is dropped) instead of mongomock")
+    parser.add_argument('--no-cache', action='store_true', help="Turn off the response cache")
+    parser.add_argument('--json', default=None, help="Write the results to this file")
+    parser.add_argument('--baseline', default=None, help="Results file from an earlier run to compare with")
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help="Exit with an error when a route's p95 is more than this percent slower than the baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['routes']
+
+    print(f"{results['requests']} requests in {results['elapsed_s']}s, {results['rps']} requests/s")
+    print(f"{'route':>18} {'requests':>8} {'errors':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'vs base p95':>12}")
+    regressions = []
+    for route, result in results['routes'].items():
+        base = baseline.get(route)
+        versus = f"{change(result['p95_ms'], base['p95_ms']):+.1f}%" if base else '-'
+        if base and args.max_regression is not None and change(result['p95_ms'], base['p95_ms']) > args.max_regression:
+            regressions.append(route)
+        print(f"{route:>18} {result['requests']:>8} {result['errors']:>6} {result['rps']:>7} "
+              f"{result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8} {versus:>12}")
+    for route, samples in results['error_samples'].items():
+        print(f"Errors for {route}: {', '.join(samples)}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"p95 regressed more than {args.max_regression}% for: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,15 @@ from fastapi.testclient import TestClient
 from bson import ObjectId
 from datetime import datetime
 
+# mongomock 4.3 doesn't accept the sort option pymongo 4.13 passes for UpdateOne/ReplaceOne in bulk_write
+from mongomock.collection import BulkOperationBuilder
+def drop_sort(method):
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return wrapper
+BulkOperationBuilder.add_update = drop_sort(BulkOperationBuilder.add_update)
+BulkOperationBuilder.add_replace = drop_sort(BulkOperationBuilder.add_replace)
+
 class MockMongoClient:
     def __init__(self, db):
         self.db = db
@@ -113,6 +122,22 @@ def generate_mock_mongodb_image_groups_initialized():
 
 
 
+# clear the response cache so entries don't leak between tests using different mock databases
+@fixture(autouse=True)
+def clear_response_cache():
+    from app.main import response_cache
+    response_cache.clear()
+    yield
+
+# the database client and S3 handler are shared by the container, start each test without them
+@fixture(autouse=True)
+def reset_shared_clients():
+    yield
+    from app.db import reset_db
+    from app.s3_handler import reset_s3_handler
+    reset_db()
+    reset_s3_handler()
+
 @fixture
 def client():
     # we patch auth within our client fixture
@@ -148,6 +173,9 @@ def mock_executor():
 
     return mock_get_executor
 
+def mock_move_image(old_group, new_group, filename, new_filename=None):
+    return [{'old_key': f"{folder}/{old_group}/{filename}", 'new_key': f"{folder}/{new_group}/{new_filename or filename}"} for folder in ['original', 'fullsize', 'thumb']]
+
 def mock_upload_image(*args, **kwargs):
     group = args[0]
     filename = args[1]
@@ -199,10 +227,12 @@ def mock_s3_handler():
     def mock_get_s3_handler():
         s3 = MagicMock()
         s3.upload_image = AsyncMock(side_effect=mock_upload_image)
-        s3.move_image = AsyncMock()
+        s3.move_image = AsyncMock(side_effect=mock_move_image)
+        s3.reserve_filenames = AsyncMock(side_effect=lambda group, filenames: list(filenames))
         s3.delete_image = AsyncMock()
         s3.check_and_rename_file = AsyncMock(side_effect=lambda prefix, filename: f"{prefix}/{filename}")
         s3.presign_file = AsyncMock(side_effect=mock_presign_file)
         s3.process_image = AsyncMock(side_effect=mock_process_image)
+        s3.file_metadata = AsyncMock(return_value={})
         return s3
     return mock_get_s3_handler
\ No newline at end of file
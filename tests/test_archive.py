@@ -0,0 +1,106 @@
+import io
+import asyncio
+import zipfile
+import boto3
+import pytest
+from datetime import datetime, timezone
+from moto import mock_aws
+
+from app.archive import zip_stream, archive_name
+from app.main import app, setup_s3_handler
+from app.db import connect_to_db
+from app.s3_handler import S3Handler
+
+bucket_name = 'test-bucket'
+modified = datetime(2025, 6, 1, 20, 30, tzinfo=timezone.utc)
+
+def in_memory(objects, produced=None):
+    def read_chunks(key, chunk_size):
+        if key not in objects:
+            raise FileNotFoundError(key)
+        data = objects[key]
+        for start in range(0, len(data), chunk_size):
+            if produced is not None:
+                produced.append(key)
+            yield data[start:start + chunk_size]
+    return read_chunks
+
+async def collect(stream):
+    return b''.join([chunk async for chunk in stream])
+
+@pytest.mark.asyncio
+async def test_zip_stream():
+    objects = {f"original/g/{i}.jpg": bytes([i]) * (1000 + i * 777) for i in range(7)}
+    files = [{'name': key.rsplit('/', 1)[-1], 'key': key, 'size': len(data), 'last_modified': modified} for key, data in objects.items()]
+    files.insert(3, {'name': 'gone.jpg', 'key': 'original/g/gone.jpg', 'size': 10, 'last_modified': modified})
+
+    body = await collect(zip_stream(files, in_memory(objects), read_ahead=3, buffered=2, chunk_size=500))
+    with zipfile.ZipFile(io.BytesIO(body)) as zip:
+        assert zip.namelist() == [f"{i}.jpg" for i in range(7)] # the missing one left out, in order
+        for info in zip.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert zip.read(info) == objects[f"original/g/{info.filename}"]
+            assert info.date_time == (2025, 6, 1, 20, 30, 0)
+        assert zip.testzip() is None
+
+@pytest.mark.asyncio
+async def test_zip_stream_reads_ahead_a_bounded_amount():
+    objects = {f"k{i}": b'x' * 10_000 for i in range(20)}
+    files = [{'name': key, 'key': key, 'size': len(data), 'last_modified': modified} for key, data in objects.items()]
+    produced = []
+    stream = zip_stream(files, in_memory(objects, produced), read_ahead=2, buffered=3, chunk_size=100)
+    await stream.__anext__()
+    await asyncio.sleep(0.3) # a slow client, the reading waits for it
+    assert len(produced) <= 1 + 2 * (3 + 1) # the chunk written, the buffers and a chunk waiting for room in each
+    await stream.aclose() # the client went away, the threads stop
+    stopped = len(produced)
+    await asyncio.sleep(0.6)
+    assert len(produced) == stopped
+
+def test_archive_name():
+    assert archive_name('Summer Fest 2025 / Main stage') == 'Summer_Fest_2025_Main_stage'
+    assert archive_name(None) == 'images'
+
+@pytest.fixture
+def archive_app(mock_mongodb_image_groups_initialized, get_group_id):
+    with mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=bucket_name)
+        handler = S3Handler()
+        handler.s3_client = s3
+        handler.bucket_name = bucket_name
+        for i in range(3):
+            s3.put_object(Bucket=bucket_name, Key=f"original/{get_group_id}/img{i}.jpg", Body=bytes([i]) * 5000)
+        s3.put_object(Bucket=bucket_name, Key=f"fullsize/{get_group_id}/img0.jpg", Body=b'small')
+        db = mock_mongodb_image_groups_initialized()
+        app.dependency_overrides[connect_to_db] = lambda: db
+        app.dependency_overrides[setup_s3_handler] = lambda: handler
+        yield handler
+        app.dependency_overrides.clear()
+
+def test_group_archive(client, archive_app, get_group_id):
+    response = client.get(f"/image_groups/{get_group_id}/archive")
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/zip'
+    assert response.headers['content-disposition'].startswith('attachment; filename="')
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip:
+        assert zip.namelist() == ['img0.jpg', 'img1.jpg', 'img2.jpg']
+        assert zip.read('img2.jpg') == bytes([2]) * 5000
+
+    response = client.get(f"/image_groups/{get_group_id}/archive", params={'source': 'fullsize'})
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip:
+        assert zip.namelist() == ['img0.jpg'] and zip.read('img0.jpg') == b'small'
+
+    assert client.get("/image_groups/nope/archive").status_code == 400
+    assert client.get("/image_groups/bbbbbbbbbbbbbbbbbbbbbbbb/archive").status_code == 404
+    assert client.get(f"/image_groups/{get_group_id}/archive", params={'source': 'thumb'}).status_code == 422
+
+def test_group_archive_manifest(client, archive_app, get_group_id):
+    response = client.get(f"/image_groups/{get_group_id}/archive/manifest")
+    assert response.status_code == 200
+    manifest = response.json()
+    assert manifest['source'] == 'original' and manifest['total_bytes'] == 15000
+    assert [file['name'] for file in manifest['files']] == ['img0.jpg', 'img1.jpg', 'img2.jpg']
+    assert f"original/{get_group_id}/img1.jpg" in manifest['files'][1]['url']
+    assert 'Signature' in manifest['files'][1]['url'] or 'X-Amz-Signature' in manifest['files'][1]['url']
+    assert client.get("/image_groups/bbbbbbbbbbbbbbbbbbbbbbbb/archive/manifest").status_code == 404
@@ -0,0 +1,151 @@
+import io
+import boto3
+import pytest
+import mongomock
+from moto import mock_aws
+from PIL import Image
+
+from app import status, processing
+from app.backfill import backfill, Checkpoint, Progress, split_key, CHECKPOINTS
+from app.s3_handler import S3Handler
+from tests.test_main import make_s3_event
+
+bucket_name = 'test-bucket'
+source = 'archive/2019/'
+
+def jpeg(color):
+    stream = io.BytesIO()
+    Image.new('RGB', (800, 600), color).save(stream, format='JPEG')
+    return stream.getvalue()
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=bucket_name)
+        handler = S3Handler()
+        handler.s3_client = client
+        handler.bucket_name = bucket_name
+        for key, color in [('Summer Fest/a.jpg', 'red'), ('Summer Fest/b.jpg', 'green'), ('Summer Fest/c.JPG', 'blue'),
+                           ('Winter/a.jpg', 'white'), ('Winter/d.jpg', 'black')]:
+            client.put_object(Bucket=bucket_name, Key=source + key, Body=jpeg(color), ContentType='image/jpeg')
+        client.put_object(Bucket=bucket_name, Key=source + 'Winter/notes.txt', Body=b'not an image')
+        yield handler
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().get_database('backfill')
+
+def test_checkpoint_only_moves_past_finished_keys(db):
+    checkpoint = Checkpoint(db.get_collection(CHECKPOINTS), source)
+    for key in ['a', 'b', 'c']:
+        checkpoint.start(key)
+    checkpoint.finish('b', processed=True)
+    assert checkpoint.after is None # a is still running
+    checkpoint.finish('a', failed=True)
+    assert checkpoint.after == 'b'
+    checkpoint.save()
+    resumed = Checkpoint(db.get_collection(CHECKPOINTS), source)
+    assert (resumed.after, resumed.processed, resumed.failed) == ('b', 1, 1)
+    assert resumed.retries() == ['a']
+    resumed.finish('a', processed=True) # retried, the checkpoint doesn't move back
+    assert (resumed.after, resumed.failed, resumed.retries()) == ('b', 0, [])
+
+def test_split_key():
+    assert split_key('archive/2019/Summer Fest/a.jpg', source) == ('Summer Fest', 'a.jpg')
+    assert split_key('archive/2019/a.jpg', source) == ('', 'a.jpg')
+
+def test_progress():
+    now = [0]
+    progress = Progress(10, clock=lambda: now[0])
+    progress.image_processed({'bytes': {'downloaded': 4_000_000}, 'megapixels': 12})
+    progress.image_processed({'bytes': {'downloaded': 4_000_000}, 'megapixels': 12})
+    now[0] = 2
+    summary = progress.summary()
+    assert (summary['images_per_s'], summary['mb_per_s'], summary['megapixels_per_s'], summary['eta_s']) == (1, 4, 12, 8)
+
+@pytest.mark.asyncio
+async def test_backfill(db, s3):
+    lines = []
+    summary = await backfill(db, s3, source, concurrency=2, report=lines.append)
+    assert (summary['processed'], summary['failed'], summary['skipped']) == (5, 0, 0)
+
+    groups = {group['name']: group for group in db.get_collection('image_groups').find()}
+    assert sorted(groups) == ['Summer Fest', 'Winter']
+    assert groups['Summer Fest']['image_count'] == 3 and groups['Summer Fest']['cover'] is not None
+    images = list(db.get_collection('images').find({'group': groups['Winter']['_id']}))
+    assert sorted(image['filename'] for image in images) == ['a.jpg', 'd.jpg']
+    assert all(image['status'] == status.DONE and image['data']['renditions'] for image in images)
+    assert await s3.file_exists(f"original/{groups['Winter']['_id']}/d.jpg")
+    original = s3.s3_client.head_object(Bucket=bucket_name, Key=f"original/{groups['Winter']['_id']}/d.jpg")
+    assert original['ContentType'] == 'image/jpeg' and original['Metadata'] == {'backfill': 'true'}
+    assert await s3.file_exists(f"w640/{groups['Winter']['_id']}/d.jpg")
+    assert '5/5 images' in lines[-1]
+
+    # resumes after the last key, nothing left
+    assert db.get_collection(CHECKPOINTS).find_one({'_id': source})['after'] == source + 'Winter/d.jpg'
+    assert (await backfill(db, s3, source, report=lines.append))['total'] == 0
+    # from the start again, the images done are skipped and no group or image is created twice
+    summary = await backfill(db, s3, source, restart=True, report=lines.append)
+    assert (summary['processed'], summary['skipped']) == (0, 5)
+    assert db.get_collection('image_groups').count_documents({}) == 2
+    assert db.get_collection('images').count_documents({}) == 5
+
+@pytest.mark.asyncio
+async def test_backfill_failures_and_dry_run(db, s3):
+    s3.s3_client.put_object(Bucket=bucket_name, Key=source + 'Winter/broken.jpg', Body=b'not a jpeg')
+    lines = []
+    assert (await backfill(db, s3, source, dry_run=True, report=lines.append))['total'] == 6
+    assert lines == [f"6 images in 2 groups to backfill from {source}"]
+    assert db.get_collection('images').count_documents({}) == 0
+
+    summary = await backfill(db, s3, source, event='aaaaaaaaaaaaaaaaaaaaaaaa', report=lines.append)
+    assert (summary['processed'], summary['failed']) == (5, 1)
+    broken = db.get_collection('images').find_one({'filename': 'broken.jpg'})
+    assert broken['status'] == status.FAILED and broken['status_error']
+    assert all(str(group['event']) == 'aaaaaaaaaaaaaaaaaaaaaaaa' for group in db.get_collection('image_groups').find())
+    # the failed image is tried again from the start
+    summary = await backfill(db, s3, source, restart=True, report=lines.append)
+    assert (summary['failed'], summary['skipped']) == (1, 5)
+
+@pytest.mark.asyncio
+async def test_backfill_resume_retries_failed(db, s3):
+    s3.s3_client.put_object(Bucket=bucket_name, Key=source + 'Summer Fest/broken.jpg', Body=b'not a jpeg')
+    lines = []
+    assert (await backfill(db, s3, source, report=lines.append))['failed'] == 1
+    assert db.get_collection(CHECKPOINTS).find_one({'_id': source})['failed_keys'] == [source + 'Summer Fest/broken.jpg']
+
+    # fixed in the source, a plain resume tries it again
+    s3.s3_client.put_object(Bucket=bucket_name, Key=source + 'Summer Fest/broken.jpg', Body=jpeg('yellow'))
+    group = db.get_collection('image_groups').find_one({'name': 'Summer Fest'})['_id']
+    s3.s3_client.delete_object(Bucket=bucket_name, Key=f"original/{group}/broken.jpg")
+    summary = await backfill(db, s3, source, report=lines.append)
+    assert (summary['total'], summary['processed'], summary['failed']) == (1, 1, 0)
+    assert any('retrying 1 failed images' in line for line in lines)
+    assert db.get_collection('images').find_one({'filename': 'broken.jpg'})['status'] == status.DONE
+    checkpoint = db.get_collection(CHECKPOINTS).find_one({'_id': source})
+    assert (checkpoint['after'], checkpoint['failed_keys']) == (source + 'Winter/d.jpg', [])
+
+@pytest.mark.asyncio
+async def test_backfill_processes_each_image_once(db, s3, mocker):
+    # the upload trigger fires for the copies to original/, it has to leave them to the backfill
+    mocker.patch('app.processing.get_db', lambda: db)
+    mocker.patch('app.processing.get_s3_handler', lambda: s3)
+    triggered = []
+    copy_file = s3.copy_file
+    async def copy_and_trigger(old_key, new_key, metadata=None):
+        await copy_file(old_key, new_key, metadata)
+        _, group_id, filename = new_key.split('/')
+        triggered.append(await processing.process_s3_image(make_s3_event(group_id, filename), None))
+    s3.copy_file = copy_and_trigger
+    process_image = mocker.spy(s3, 'process_image')
+
+    summary = await backfill(db, s3, source, report=[].append)
+    assert summary['processed'] == 5
+    assert process_image.call_count == 5
+    assert len(triggered) == 5 and all('skipped' in result for result in triggered)
+
+    # an upload to the same key is processed by the trigger again
+    group = db.get_collection('image_groups').find_one({'name': 'Winter'})['_id']
+    s3.s3_client.put_object(Bucket=bucket_name, Key=f"original/{group}/d.jpg", Body=jpeg('gray'))
+    assert (await processing.process_s3_image(make_s3_event(group, 'd.jpg'), None))['filename'] == 'd.jpg'
@@ -0,0 +1,117 @@
+from http import HTTPStatus
+
+from app.main import app, setup_s3_handler
+from app.db import connect_to_db
+from app import group_stats
+
+missing_id = 'bbbbbbbbbbbbbbbbbbbbbbbb'
+
+def test_edit_images(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_image_id2, get_group_id, get_group2_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+    group_stats.rebuild(db)
+
+    response = client.patch("/images", json={'updates': [
+        {'id': str(get_image_id1), 'description': 'retagged', 'group': str(get_group2_id)},
+        {'id': str(get_image_id2), 'description': 'retagged'},
+        {'id': missing_id, 'description': 'nope'},
+        {'id': str(get_image_id1), 'description': 'again'},
+        {'id': 'not-an-id'},
+    ]})
+    assert response.status_code == HTTPStatus.OK
+    body = response.json()
+    assert [result['status'] for result in body['results']] == ['updated', 'updated', 'not_found', 'duplicate', 'invalid_id']
+    assert body['results'][0]['moved'] is True and 'moved' not in body['results'][1]
+    assert body['updated'] == 2 and body['moved'] == 1
+
+    images = db.get_collection('images')
+    assert images.find_one({'_id': get_image_id1})['group'] == get_group2_id
+    assert images.find_one({'_id': get_image_id2})['description'] == 'retagged'
+    s3.move_image.assert_awaited_once_with(str(get_group_id), str(get_group2_id), 'img1.jpg', 'img1.jpg')
+
+    groups = db.get_collection('image_groups')
+    assert groups.find_one({'_id': get_group_id})['image_count'] == 1
+    assert groups.find_one({'_id': get_group2_id})['image_count'] == 1
+
+def test_edit_images_unchanged_and_bad_group(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_image_id2, get_group_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+
+    response = client.patch("/images", json={'updates': [
+        {'id': str(get_image_id1), 'group': str(get_group_id)},
+        {'id': str(get_image_id2), 'group': missing_id},
+    ]})
+    assert [result['status'] for result in response.json()['results']] == ['unchanged', 'group_not_found']
+    s3.move_image.assert_not_awaited()
+
+def test_edit_images_move_error(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_group_id, get_group2_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    s3.move_image.side_effect = lambda old_group, new_group, filename, new_filename=None: [
+        {'old_key': f"original/{old_group}/{filename}", 'new_key': f"original/{new_group}/{filename}"}, {'error': 'AccessDenied'}]
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+    group_stats.rebuild(db)
+
+    response = client.patch("/images", json={'updates': [{'id': str(get_image_id1), 'group': str(get_group2_id), 'description': 'moved'}]})
+    body = response.json()
+    result = body['results'][0]
+    assert result['status'] == 'move_failed' and result['moved'] is False and result['error'] == 'AccessDenied'
+    assert body['updated'] == 0 and body['moved'] == 0
+    image = db.get_collection('images').find_one({'_id': get_image_id1})
+    assert image['group'] == get_group_id and 'description' not in image, "The image should stay where its files are"
+    groups = db.get_collection('image_groups')
+    assert groups.find_one({'_id': get_group_id})['image_count'] == 2 and groups.find_one({'_id': get_group2_id})['image_count'] == 0
+
+def test_edit_images_move_renamed(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_group2_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    s3.reserve_filenames.side_effect = lambda group, filenames: ['img1-1.jpg'] # the name is taken in the group
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+    images = db.get_collection('images')
+    images.update_one({'_id': get_image_id1}, {'$set': {'data.renditions': [{'width': 2880, 'height': 2160, 'key': 'fullsize/g/img1.jpg'}]}})
+
+    response = client.patch("/images", json={'updates': [{'id': str(get_image_id1), 'group': str(get_group2_id)}]})
+    assert response.json()['results'][0]['filename'] == 'img1-1.jpg'
+    image = images.find_one({'_id': get_image_id1})
+    assert image['filename'] == 'img1-1.jpg' and image['group'] == get_group2_id
+    assert image['data']['renditions'][0]['key'] == f"fullsize/{get_group2_id}/img1-1.jpg"
+
+def test_moves_keep_rendition_keys(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_image_id2, get_group_id, get_group2_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+    images = db.get_collection('images')
+    for image_id, filename in [(get_image_id1, 'img1.jpg'), (get_image_id2, 'img2.jpg')]:
+        images.update_one({'_id': image_id}, {'$set': {'data.renditions': [
+            {'width': 320, 'height': 240, 'key': f"w320/{get_group_id}/{filename}"},
+            {'width': 2880, 'height': 2160, 'key': f"fullsize/{get_group_id}/{filename}"}]}})
+
+    response = client.patch(f"/images/{get_image_id1}", json={'data': {'group': str(get_group2_id)}})
+    assert [rendition['key'] for rendition in response.json()['data']['renditions']] == [f"w320/{get_group2_id}/img1.jpg", f"fullsize/{get_group2_id}/img1.jpg"]
+    client.patch("/images", json={'updates': [{'id': str(get_image_id2), 'group': str(get_group2_id)}]})
+    for image_id, filename in [(get_image_id1, 'img1.jpg'), (get_image_id2, 'img2.jpg')]:
+        stored = images.find_one({'_id': image_id})['data']['renditions']
+        assert [rendition['key'] for rendition in stored] == [f"w320/{get_group2_id}/{filename}", f"fullsize/{get_group2_id}/{filename}"]
+        assert [rendition['width'] for rendition in stored] == [320, 2880]
+
+def test_edit_image_move_error(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_image_id1, get_group_id, get_group2_id):
+    db = mock_mongodb_image_groups_initialized()
+    s3 = mock_s3_handler()
+    s3.move_image.side_effect = lambda old_group, new_group, filename, new_filename=None: [{'error': 'AccessDenied'}]
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3
+    group_stats.rebuild(db)
+
+    response = client.patch(f"/images/{get_image_id1}", json={'data': {'group': str(get_group2_id), 'description': 'moved'}})
+    assert response.status_code == HTTPStatus.BAD_GATEWAY and 'AccessDenied' in response.json()['detail']
+    image = db.get_collection('images').find_one({'_id': get_image_id1})
+    assert image['group'] == get_group_id and 'description' not in image, "The image should stay where its files are"
+    groups = db.get_collection('image_groups')
+    assert groups.find_one({'_id': get_group_id})['image_count'] == 2 and groups.find_one({'_id': get_group2_id})['image_count'] == 0
@@ -0,0 +1,129 @@
+from http import HTTPStatus
+from mongomock import MongoClient
+
+from app.main import app, setup_s3_handler, response_cache
+from app.db import connect_to_db
+from app.cache import LRUCache, MongoCacheBackend, ResponseCache, etag_matches, group_key, image_key, current_version
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def test_lru_size_bound():
+    lru = LRUCache(max_size=2, ttl=60)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a') # a is now the most recently used
+    lru.set('c', 3)
+
+    assert len(lru) == 2, "Cache grew past its size"
+    assert lru.get('b') is None, "Least recently used entry not evicted"
+    assert lru.get('a') == 1 and lru.get('c') == 3
+
+def test_lru_ttl():
+    clock = FakeClock()
+    lru = LRUCache(max_size=10, ttl=30, clock=clock)
+    lru.set('a', 1)
+    clock.now = 29
+    assert lru.get('a') == 1, "Entry expired early"
+    clock.now = 30
+    assert lru.get('a') is None, "Entry not expired"
+
+def test_shared_backend():
+    shared = MongoCacheBackend(MongoClient().db.get_collection('response_cache'))
+    first = ResponseCache(max_size=10, ttl=60, shared=shared)
+    second = ResponseCache(max_size=10, ttl=60, shared=shared) # like another container
+
+    entry = first.set('group:1', b'{"name":"test"}')
+    assert second.get('group:1') == entry, "Entry not shared"
+
+    first.invalidate('group:1')
+    second.local.clear()
+    assert second.get('group:1') is None, "Invalidation not shared"
+
+def test_versions_invalidate_other_containers():
+    db = MongoClient().db
+    first = ResponseCache(max_size=10, ttl=60)
+    second = ResponseCache(max_size=10, ttl=60) # another container, no shared backend
+    first.set('group:1', b'{"name":"test"}', version=current_version(db, 'group:1'))
+    assert first.get('group:1', current_version(db, 'group:1')) is not None
+
+    second.invalidate('group:1', db=db) # a write in the other container
+    assert first.get('group:1', current_version(db, 'group:1')) is None, "Entry served after a write elsewhere"
+    # a read started before the write is stored with the old version and isn't served
+    first.set('group:1', b'{"name":"old"}', version=0)
+    assert first.get('group:1', current_version(db, 'group:1')) is None
+
+def test_set_after_invalidation_not_stored():
+    response_cache = ResponseCache(max_size=10, ttl=60)
+    generation = response_cache.generation # a read starts
+    response_cache.invalidate('group:1') # a write happens while reading
+    entry = response_cache.set('group:1', b'{}', generation)
+
+    assert entry['etag'], "Entry should still have an ETag"
+    assert response_cache.get('group:1') is None, "Stale read stored in the cache"
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"x"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+def test_get_images_etag(client, mock_mongodb_image_groups_initialized, get_group_id):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    response = client.get(f"/image_groups/{get_group_id}")
+    etag = response.headers['etag']
+    assert response.status_code == HTTPStatus.OK
+    assert group_key(get_group_id) in response_cache.local.entries, "Group not cached"
+
+    not_modified = client.get(f"/image_groups/{get_group_id}", headers={'If-None-Match': etag})
+    assert not_modified.status_code == HTTPStatus.NOT_MODIFIED
+    assert not_modified.headers['etag'] == etag
+    assert not_modified.content == b''
+
+    cached = client.get(f"/image_groups/{get_group_id}")
+    assert cached.content == response.content, "Cached body differs"
+
+def test_get_image_etag(client, mock_mongodb_image_groups_initialized, get_image_id1):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    response = client.get(f"/images/{get_image_id1}")
+    assert response.status_code == HTTPStatus.OK
+
+    not_modified = client.get(f"/images/{get_image_id1}", headers={'If-None-Match': response.headers['etag']})
+    assert not_modified.status_code == HTTPStatus.NOT_MODIFIED
+
+def test_edit_image_invalidates(client, mock_mongodb_image_groups_initialized, get_image_id1, get_group_id, get_group2_id, mock_s3_handler):
+    db = mock_mongodb_image_groups_initialized() # one database for all the requests
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+
+    # cache the image and both groups
+    image = client.get(f"/images/{get_image_id1}")
+    old_group = client.get(f"/image_groups/{get_group_id}")
+    client.get(f"/image_groups/{get_group2_id}")
+
+    response = client.patch(f"/images/{get_image_id1}", json={'data': {'description': 'changed', 'group': str(get_group2_id)}})
+    assert response.status_code == HTTPStatus.OK
+    for key in [image_key(get_image_id1), group_key(get_group_id), group_key(get_group2_id)]:
+        assert key not in response_cache.local.entries, f"{key} not invalidated"
+
+    # the old ETag no longer matches
+    changed = client.get(f"/images/{get_image_id1}", headers={'If-None-Match': image.headers['etag']})
+    assert changed.status_code == HTTPStatus.OK
+    assert changed.json()['description'] == 'changed'
+    assert len(client.get(f"/image_groups/{get_group_id}").json()['images']) == len(old_group.json()['images']) - 1
+
+def test_delete_group_invalidates(client, mock_mongodb_image_groups_initialized, get_group_id, get_image_id1, mock_s3_handler):
+    db = mock_mongodb_image_groups_initialized() # one database for all the requests
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+
+    client.get(f"/image_groups/{get_group_id}")
+    client.get(f"/images/{get_image_id1}")
+    client.delete(f"/image_groups/{get_group_id}")
+
+    assert client.get(f"/image_groups/{get_group_id}").status_code == HTTPStatus.NOT_FOUND
+    assert client.get(f"/images/{get_image_id1}").status_code == HTTPStatus.NOT_FOUND
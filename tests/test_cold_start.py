@@ -0,0 +1,40 @@
+import os
+import sys
+import subprocess
+
+# Import time profile of app.main with -X importtime, the Lambda cold start pays for every import
+# so the heavy modules should only be imported by the paths that need them
+
+HEAVY_MODULES = ['PIL', 'piexif', 'numpy', 'boto3', 'botocore', 'app.s3_handler', 'app.image_data_handler']
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import a module in a new interpreter, returns {module: (self us, cumulative us)}
+def import_times(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            capture_output=True, text=True, cwd=repo_root, env=os.environ)
+    assert result.returncode == 0, result.stderr
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix('import time:').split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def test_main_import_is_light():
+    times = import_times('app.main')
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:10]
+    print('Slowest imports (cumulative us):', [(name, cumulative) for name, (_, cumulative) in slowest])
+
+    assert 'app.main' in times
+    imported = [module for module in HEAVY_MODULES if module in times]
+    assert imported == [], f"app.main shouldn't import {imported} at load"
+
+def test_s3_handler_imports_pillow_lazily():
+    times = import_times('app.s3_handler')
+    assert 'PIL' not in times and 'app.image_data_handler' not in times
+
+def test_processing_doesnt_import_the_api():
+    times = import_times('app.processing')
+    imported = [module for module in ['fastapi', 'starlette', 'mangum', 'app.main', 'PIL'] if module in times]
+    assert imported == [], f"app.processing shouldn't import {imported} at load"
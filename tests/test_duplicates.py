@@ -0,0 +1,80 @@
+import io
+import random
+from bson import ObjectId
+from PIL import Image, ImageDraw
+
+from app import duplicates
+from app.duplicates import BKTree, dhash, hamming, duplicate_sets
+from app.main import app
+from app.db import connect_to_db
+from tests.conftest import test_event_id
+
+
+def photo(seed, size=(400, 300)):
+    rng = random.Random(seed)
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + rng.randrange(40, 150), y + rng.randrange(40, 150)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image
+
+def recompressed(image, size):
+    stream = io.BytesIO()
+    image.resize(size).save(stream, format='JPEG', quality=60)
+    return Image.open(io.BytesIO(stream.getvalue()))
+
+def test_dhash():
+    original = photo(1)
+    phash = dhash(original)
+    assert len(phash) == 16 and int(phash, 16) >= 0
+    assert hamming(int(phash, 16), int(dhash(recompressed(original, (200, 150))), 16)) <= duplicates.DEFAULT_MAX_DISTANCE
+    assert hamming(int(phash, 16), int(dhash(photo(2)), 16)) > duplicates.DEFAULT_MAX_DISTANCE
+
+def test_bk_tree_matches_brute_force():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(500)]
+    hashes += [hash ^ (1 << rng.randrange(64)) for hash in hashes[:50]] # some one bit apart
+    tree = BKTree()
+    for i, hash in enumerate(hashes):
+        tree.add(hash, i)
+    for query in hashes[:20] + [rng.getrandbits(64)]:
+        expected = sorted((hamming(query, hash), i) for i, hash in enumerate(hashes) if hamming(query, hash) <= 10)
+        assert sorted(tree.search(query, 10)) == expected
+
+def image(phash, group=None, filename=None):
+    return {'_id': ObjectId(), 'filename': filename, 'group': group, 'data': {'phash': f"{phash:016x}"}}
+
+def test_duplicate_sets():
+    images = [image(0b0), image(0b111), image(0b111111), image(0xffff0000ffff0000), image(0xffff0000ffff0001)]
+    sets = duplicate_sets(images, max_distance=3)
+    # 0 and 0b111 are 3 apart, 0b111 and 0b111111 too, so all three are a set even if the ends are 6 apart
+    assert [[member['id'] for member in found['images']] for found in sets] == [
+        [images[0]['_id'], images[1]['_id'], images[2]['_id']], [images[3]['_id'], images[4]['_id']]]
+    assert [member['distance'] for member in sets[0]['images']] == [0, 3, 6]
+    assert duplicate_sets(images, max_distance=0) == []
+
+def test_duplicates_endpoints(client, get_group_id, get_group2_id, mock_mongodb_image_groups_initialized):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    burst = [image(0x0f0f0f0f0f0f0f0f, get_group_id, 'burst1.jpg'), image(0x0f0f0f0f0f0f0f0e, get_group_id, 'burst2.jpg'),
+             image(0x0f0f0f0f0f0f0f0c, get_group2_id, 'copy.jpg'), image(0xf0f0f0f0f0f0f0f0, get_group_id, 'other.jpg')]
+    db.get_collection('images').insert_many(burst)
+
+    response = client.get(f"/image_groups/{get_group_id}/duplicates")
+    assert response.status_code == 200
+    result = response.json()
+    assert result['max_distance'] == duplicates.DEFAULT_MAX_DISTANCE
+    assert result['hashed_images'] == 3 # the images without a hash aren't compared
+    assert [member['filename'] for member in result['sets'][0]['images']] == ['burst1.jpg', 'burst2.jpg']
+    assert result['sets'][0]['images'][1] == {'id': str(burst[1]['_id']), 'filename': 'burst2.jpg', 'group': str(get_group_id),
+                                              'phash': '0f0f0f0f0f0f0f0e', 'distance': 1}
+
+    db.get_collection('image_groups').update_one({'_id': get_group2_id}, {'$set': {'event': test_event_id}})
+    response = client.get(f"/events/{test_event_id}/duplicates", params={'max_distance': 2})
+    assert [member['filename'] for member in response.json()['sets'][0]['images']] == ['burst1.jpg', 'burst2.jpg', 'copy.jpg']
+
+    assert client.get(f"/image_groups/{get_group_id}/duplicates", params={'max_distance': 0}).json()['sets'] == []
+    assert client.get("/image_groups/nope/duplicates").status_code == 400
+    assert client.get("/events/nope/duplicates").status_code == 400
+    assert client.get(f"/image_groups/{get_group_id}/duplicates", params={'max_distance': 40}).status_code == 422
@@ -0,0 +1,91 @@
+from datetime import datetime, timezone, timedelta
+from http import HTTPStatus
+from typing import List
+import json
+from bson import ObjectId
+
+from app.main import app, response_cache
+from app.db import connect_to_db
+from app.models import ImageGroup, ImageData
+from app import encoders
+
+# get the same url with the normal response_model path and the fast encoder, the bodies should be identical
+def get_both(client, mocker, url):
+    mocker.patch('app.main.fast_responses', False)
+    slow = client.get(url)
+    response_cache.clear() # so the fast one isn't served from the cache
+    mocker.patch('app.main.fast_responses', True)
+    fast = client.get(url)
+    return slow, fast
+
+def test_get_images_equivalent(client, mock_mongodb_image_groups_initialized, get_group_id, mocker):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    slow, fast = get_both(client, mocker, f"/image_groups/{get_group_id}")
+
+    assert slow.status_code == fast.status_code == HTTPStatus.OK
+    assert fast.headers['content-type'] == 'application/json'
+    assert slow.content == fast.content, "Fast encoder output differs from response_model output"
+
+def test_get_image_groups_equivalent(client, mock_mongodb_image_groups_initialized, get_event_id, mocker):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    # both the route with exclude_none and the trailing slash one using the return annotation
+    for url in ["/image_groups", "/image_groups/", f"/image_groups?event={get_event_id}"]:
+        slow, fast = get_both(client, mocker, url)
+        assert slow.status_code == fast.status_code == HTTPStatus.OK
+        assert slow.content == fast.content, f"Fast encoder output differs for {url}"
+
+def test_get_image_equivalent(client, mock_mongodb_image_groups_initialized, get_image_id1, mocker):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    slow, fast = get_both(client, mocker, f"/images/{get_image_id1}")
+
+    assert slow.status_code == fast.status_code == HTTPStatus.OK
+    assert slow.content == fast.content, "Fast encoder output differs from response_model output"
+
+def test_get_image_404_fast(client, mock_mongodb_image_groups_initialized, mocker):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    mocker.patch('app.main.fast_responses', True)
+    response = client.get("/images/" + 'bbbbbbbbbbbbbbbbbbbbbbbb')
+
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+# check the edge cases directly against the pydantic serialization
+def test_encode_matches_model():
+    group_id = ObjectId()
+    document = {
+        '_id': group_id,
+        'name': 'edge cases',
+        'event': ObjectId(),
+        'created_at': datetime(2025, 1, 1, 1, 2, 3, 4500),
+        'updated_at': datetime(2025, 1, 1, tzinfo=timezone.utc),
+        'not_in_model': 'ignored',
+        'images': [
+            {
+                '_id': ObjectId(),
+                'filename': 'img.jpg',
+                'group': group_id,
+                'data': {
+                    'DateTime': datetime(2025, 1, 1, 12, 0, 0),
+                    'DateTimeOriginal': datetime(2025, 1, 1, 12, 0, 0, tzinfo=timezone(timedelta(hours=-8))),
+                    'OffsetTimeOriginal': None,
+                    'coords': {'latitude': 1.23, 'longitude': 45.6},
+                },
+                'created_at': datetime(2025, 1, 1),
+                'updated_at': datetime(2025, 1, 1),
+            },
+            {
+                '_id': ObjectId(),
+                'filename': 'no_data.jpg',
+                'data': {},
+                'created_at': datetime(2025, 1, 1),
+                'updated_at': datetime(2025, 1, 1),
+            }
+        ]
+    }
+    for by_alias in [True, False]:
+        for exclude_none in [True, False]:
+            expected = ImageGroup.model_validate(document).model_dump(mode='json', by_alias=by_alias, exclude_none=exclude_none)
+            assert encoders.encode(ImageGroup, document, by_alias, exclude_none) == expected, \
+                f"Mismatch with by_alias={by_alias} exclude_none={exclude_none}"
+
+    expected = [ImageData.model_validate(image).model_dump(mode='json', exclude_none=True) for image in document['images']]
+    assert json.loads(encoders.render(List[ImageData], document['images'])) == expected
@@ -0,0 +1,75 @@
+from datetime import datetime
+from http import HTTPStatus
+from mongomock import MongoClient
+from bson import ObjectId
+
+from app.main import app, setup_s3_handler
+from app.db import connect_to_db
+from app import group_stats
+from tests.test_group_stats import make_image, group_id, group2_id
+
+event_id = ObjectId('eeeeeeeeeeeeeeeeeeeeee03')
+
+def make_db():
+    db = MongoClient().db
+    db.image_groups.insert_many([
+        {'_id': group_id, 'name': 'first', 'event': event_id},
+        {'_id': group2_id, 'name': 'second', 'event': event_id},
+        {'_id': ObjectId(), 'name': 'not in the event'},
+    ])
+    db.images.insert_many([
+        make_image('a.jpg', datetime(2025, 1, 1, 20), 49.0, -123.0),
+        make_image('b.jpg', datetime(2025, 1, 1, 22), 49.5, -122.5),
+        make_image('c.jpg', datetime(2025, 1, 2, 1), 40.0, -100.0, group=group2_id),
+        make_image('pending.jpg', group=group2_id),
+    ])
+    group_stats.rebuild(db)
+    return db
+
+def test_event_summary():
+    summary = group_stats.event_summary(make_db(), str(event_id))
+
+    assert summary['group_count'] == 2
+    assert summary['image_count'] == 4
+    assert summary['first_taken'] == datetime(2025, 1, 1, 20)
+    assert summary['last_taken'] == datetime(2025, 1, 2, 1)
+    assert summary['bounds'] == {'min_latitude': 40.0, 'max_latitude': 49.5, 'min_longitude': -123.0, 'max_longitude': -100.0}
+    assert [group['name'] for group in summary['groups']] == ['first', 'second'], "Groups should be earliest first"
+    assert summary['groups'][0]['cover']['thumb'] == f"thumb/{group_id}/a.jpg"
+    assert 'event' not in summary['groups'][0]
+
+def test_event_summary_empty():
+    summary = group_stats.event_summary(make_db(), str(ObjectId()))
+    assert summary['group_count'] == 0 and summary['image_count'] == 0
+    assert summary['groups'] == [] and 'bounds' not in summary
+
+def test_get_event_summary(client, mock_s3_handler):
+    db = make_db()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+
+    response = client.get(f"/events/{event_id}/summary")
+    assert response.status_code == HTTPStatus.OK
+    summary = response.json()
+    assert summary['event'] == str(event_id)
+    assert summary['image_count'] == 4
+    assert summary['groups'][0]['id'] == str(group_id)
+    assert summary['groups'][0]['cover']['image']
+
+    etag = response.headers['etag']
+    assert client.get(f"/events/{event_id}/summary", headers={'If-None-Match': etag}).status_code == HTTPStatus.NOT_MODIFIED
+
+    # adding images to a group of the event changes the summary
+    client.post(f"/images/{group_id}", json={'images': ['new.jpg']})
+    response = client.get(f"/events/{event_id}/summary", headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['image_count'] == 5
+
+    # so does moving a group out of the event
+    client.patch(f"/image_groups/{group2_id}", json={'group': {'event': str(ObjectId())}})
+    summary = client.get(f"/events/{event_id}/summary").json()
+    assert summary['group_count'] == 1 and summary['image_count'] == 3
+
+def test_get_event_summary_invalid(client):
+    app.dependency_overrides[connect_to_db] = make_db
+    assert client.get("/events/not-an-id/summary").status_code == HTTPStatus.BAD_REQUEST
@@ -0,0 +1,120 @@
+from unittest.mock import MagicMock
+from http import HTTPStatus
+from mongomock import MongoClient
+from bson import ObjectId
+
+from app.main import app
+from app.db import connect_to_db
+from app import geo
+from app.indexes import ensure_indexes
+from tests.conftest import test_images, test_image_group, test_image_group2
+
+def test_within_query():
+    query = geo.within_query(49.0, -123.5, 49.5, -122.5)
+    geometry = query['data.location']['$geoWithin']['$geometry']
+    ring = geometry['coordinates'][0]
+
+    assert geometry['type'] == 'Polygon'
+    assert geometry['crs'] == geo.STRICT_WINDING_CRS
+    assert ring[0] == ring[-1], "Ring not closed"
+    assert ring[0] == [-123.5, 49.0], "Ring should start at the south west corner"
+    assert ring[1][1] == 49.0 and ring[1][0] > ring[0][0], "Ring should go east first (counterclockwise)"
+    assert all(-123.5 <= lng <= -122.5 and 49.0 <= lat <= 49.5 for lng, lat in ring)
+
+def test_within_query_antimeridian():
+    ring = geo.within_query(-20, 170, -10, -170)['data.location']['$geoWithin']['$geometry']['coordinates'][0]
+    longitudes = [lng for lng, lat in ring]
+
+    assert all(-180 <= lng <= 180 for lng in longitudes), "Longitudes not normalized"
+    assert not any(-170 < lng < 170 for lng in longitudes), "Box should go across the antimeridian, not around the world"
+
+def test_within_query_all_longitudes():
+    query = geo.within_query(-10, -180, 10, 180)
+    assert query['data.coords.latitude'] == {'$gte': -10, '$lte': 10}
+
+def test_within_query_long_edges():
+    ring = geo.within_query(0, -100, 10, 100)['data.location']['$geoWithin']['$geometry']['coordinates'][0]
+    # consecutive points no more than EDGE_STEP apart
+    assert all(abs(a[0] - b[0]) <= geo.EDGE_STEP and abs(a[1] - b[1]) <= geo.EDGE_STEP for a, b in zip(ring, ring[1:]))
+
+def test_near_query():
+    query = geo.near_query(49.28, -123.12, 500)
+    assert query == {'data.location': {'$near': {
+        '$geometry': {'type': 'Point', 'coordinates': [-123.12, 49.28]},
+        '$maxDistance': 500
+    }}}
+
+def test_backfill_locations():
+    db = MongoClient().db
+    db.images.insert_many([dict(image) for image in test_images])
+    db.images.insert_one({'_id': ObjectId(), 'filename': 'no_coords.jpg', 'data': {}})
+
+    assert geo.backfill_locations(db, batch_size=1) == (2, 0), "Both images with coordinates should be updated"
+    for image in db.images.find({'data.coords': {'$exists': True}}):
+        assert image['data']['location'] == {'type': 'Point', 'coordinates': [45.6, 1.23]}
+    assert geo.backfill_locations(db) == (0, 0), "Backfill should skip images that have a location"
+
+def test_backfill_locations_invalid():
+    db = MongoClient().db
+    db.images.insert_many([
+        {'_id': ObjectId(), 'filename': 'valid.jpg', 'data': {'coords': {'latitude': 1.23, 'longitude': 45.6}}},
+        {'_id': ObjectId(), 'filename': 'out_of_range.jpg', 'data': {'coords': {'latitude': 91.0, 'longitude': 45.6}}},
+        {'_id': ObjectId(), 'filename': 'nan.jpg', 'data': {'coords': {'latitude': float('nan'), 'longitude': 45.6}}},
+        {'_id': ObjectId(), 'filename': 'missing.jpg', 'data': {'coords': {'latitude': 1.23}}},
+    ])
+
+    assert geo.backfill_locations(db) == (1, 3)
+    assert db.images.count_documents({'data.location': {'$exists': True}}) == 1, "Only the valid coordinates should get a location"
+
+def test_ensure_indexes():
+    db = MongoClient().db
+    ensure_indexes(db)
+    assert 'location_group' in db.images.index_information()
+
+# mock database where find on images records the query, mongomock doesn't support geo queries
+def make_geo_db():
+    db = MongoClient().db
+    db.image_groups.insert_many([dict(test_image_group), dict(test_image_group2)])
+    images = MagicMock()
+    images.find.return_value.limit.return_value = [dict(image) for image in test_images]
+    class MockDB:
+        def get_collection(self, name):
+            return images if name == 'images' else db.get_collection(name)
+    return MockDB(), images
+
+def test_get_images_within(client, get_event_id, get_group_id):
+    db, images = make_geo_db()
+    app.dependency_overrides[connect_to_db] = lambda: db
+
+    response = client.get("/images/geo/within", params={
+        'min_latitude': 1, 'min_longitude': 45, 'max_latitude': 2, 'max_longitude': 46, 'event': str(get_event_id)
+    })
+    assert response.status_code == HTTPStatus.OK
+    assert len(response.json()) == 2
+    query = images.find.call_args[0][0]
+    assert '$geoWithin' in query['data.location']
+    assert query['group'] == {'$in': [get_group_id]}, "Query not scoped to the event's groups"
+
+def test_get_images_within_invalid(client):
+    db, images = make_geo_db()
+    app.dependency_overrides[connect_to_db] = lambda: db
+
+    response = client.get("/images/geo/within", params={'min_latitude': 2, 'min_longitude': 45, 'max_latitude': 1, 'max_longitude': 46})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    response = client.get("/images/geo/within", params={'min_latitude': -91, 'min_longitude': 45, 'max_latitude': 1, 'max_longitude': 46})
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+    response = client.get("/images/geo/within", params={'min_latitude': 1, 'min_longitude': 45, 'max_latitude': 1, 'max_longitude': 46})
+    assert response.status_code == HTTPStatus.BAD_REQUEST, "Zero height box should be rejected"
+    response = client.get("/images/geo/within", params={'min_latitude': 1, 'min_longitude': 45, 'max_latitude': 2, 'max_longitude': 45})
+    assert response.status_code == HTTPStatus.BAD_REQUEST, "Zero width box should be rejected"
+    images.find.assert_not_called()
+
+def test_get_images_near(client):
+    db, images = make_geo_db()
+    app.dependency_overrides[connect_to_db] = lambda: db
+
+    response = client.get("/images/geo/near", params={'latitude': 1.2, 'longitude': 45.6, 'max_distance': 1000, 'limit': 10})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()[0]['filename'] == 'img1.jpg'
+    assert images.find.call_args[0][0] == geo.near_query(1.2, 45.6, 1000)
+    images.find.return_value.limit.assert_called_with(10)
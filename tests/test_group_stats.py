@@ -0,0 +1,125 @@
+from datetime import datetime
+from http import HTTPStatus
+from mongomock import MongoClient
+from bson import ObjectId
+
+from app.main import app, setup_s3_handler
+from app.db import connect_to_db
+from app import group_stats
+
+group_id = ObjectId('bbbbbbbbbbbbbbbbbbbbbbb1')
+group2_id = ObjectId('bbbbbbbbbbbbbbbbbbbbbbb2')
+
+def make_image(filename, taken=None, latitude=None, longitude=None, group=group_id):
+    data = {}
+    if taken is not None:
+        data['DateTimeOriginal'] = taken
+    if latitude is not None:
+        data['coords'] = {'latitude': latitude, 'longitude': longitude}
+    return {
+        '_id': ObjectId(),
+        'filename': filename,
+        'data': data,
+        'group': group,
+        'created_at': datetime(2025, 1, 1),
+        'updated_at': datetime(2025, 1, 1),
+    }
+
+def make_db(images):
+    db = MongoClient().db
+    db.image_groups.insert_many([{'_id': group_id, 'name': 'stats'}, {'_id': group2_id, 'name': 'other'}])
+    if images:
+        db.images.insert_many(images)
+    return db
+
+images = [
+    make_image('a.jpg', datetime(2025, 1, 1, 20), 49.0, -123.0),
+    make_image('b.jpg', datetime(2025, 1, 1, 22), 49.5, -122.5),
+    make_image('c.jpg', datetime(2025, 1, 1, 21), 49.2, -123.2),
+    make_image('pending.jpg'), # uploaded but not processed
+]
+
+def test_rebuild():
+    db = make_db(images)
+    updated = group_stats.rebuild(db)
+    assert updated == 2, "Both groups should be updated"
+
+    group = db.image_groups.find_one({'_id': group_id})
+    assert group['image_count'] == 4
+    assert group['first_taken'] == datetime(2025, 1, 1, 20)
+    assert group['last_taken'] == datetime(2025, 1, 1, 22)
+    assert group['bounds'] == {'min_latitude': 49.0, 'max_latitude': 49.5, 'min_longitude': -123.2, 'max_longitude': -122.5}
+    assert group['cover']['image'] == images[0]['_id']
+    assert group['cover']['thumb'] == f"thumb/{group_id}/a.jpg"
+
+    empty = db.image_groups.find_one({'_id': group2_id})
+    assert empty['image_count'] == 0 and 'cover' not in empty
+
+def test_incremental_matches_rebuild():
+    db = make_db([])
+    group_stats.images_added(db, group_id, len(images))
+    for image in images:
+        db.images.insert_one(image)
+        if image['data']:
+            group_stats.image_processed(db, image)
+    incremental = db.image_groups.find_one({'_id': group_id})
+
+    group_stats.rebuild(db, [group_id])
+    rebuilt = db.image_groups.find_one({'_id': group_id})
+    for field in group_stats.STATS_FIELDS:
+        assert incremental.get(field) == rebuilt.get(field), f"{field} differs from the rebuild"
+
+def test_image_removed_shrinks_bounds():
+    db = make_db(images)
+    group_stats.rebuild(db)
+
+    db.images.delete_one({'_id': images[1]['_id']}) # the latest and the max coordinates
+    group_stats.image_removed(db, group_id, images[1])
+    group = db.image_groups.find_one({'_id': group_id})
+    assert group['image_count'] == 3
+    assert group['last_taken'] == datetime(2025, 1, 1, 21)
+    assert group['bounds']['max_latitude'] == 49.2
+
+    db.images.delete_one({'_id': images[3]['_id']}) # not processed, only the count changes
+    group_stats.image_removed(db, group_id, images[3])
+    assert db.image_groups.find_one({'_id': group_id})['image_count'] == 2
+
+def test_image_moved():
+    db = make_db(images)
+    group_stats.rebuild(db)
+
+    db.images.update_one({'_id': images[0]['_id']}, {'$set': {'group': group2_id}})
+    group_stats.image_moved(db, group_id, group2_id, images[0])
+    old_group = db.image_groups.find_one({'_id': group_id})
+    new_group = db.image_groups.find_one({'_id': group2_id})
+
+    assert old_group['image_count'] == 3 and new_group['image_count'] == 1
+    assert old_group['cover']['image'] == images[1]['_id'], "Cover should move to the next processed image"
+    assert old_group['first_taken'] == datetime(2025, 1, 1, 21)
+    assert new_group['cover']['image'] == images[0]['_id']
+    assert new_group['first_taken'] == new_group['last_taken'] == datetime(2025, 1, 1, 20)
+
+def test_endpoints_maintain_stats(client, get_group_id, get_group2_id, get_image_id1, mock_mongodb_image_groups_initialized, mock_s3_handler):
+    db = mock_mongodb_image_groups_initialized() # one database for all the requests
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+    group_stats.rebuild(db)
+
+    response = client.post(f"/images/{get_group_id}", json={'images': ['new1.jpg', 'new2.jpg']})
+    assert response.status_code == HTTPStatus.OK
+    assert db.get_collection('image_groups').find_one({'_id': get_group_id})['image_count'] == 4
+
+    client.patch(f"/images/{get_image_id1}", json={'data': {'group': str(get_group2_id)}})
+    assert db.get_collection('image_groups').find_one({'_id': get_group_id})['image_count'] == 3
+    assert db.get_collection('image_groups').find_one({'_id': get_group2_id})['image_count'] == 1
+
+    client.delete(f"/images/{get_image_id1}")
+    assert db.get_collection('image_groups').find_one({'_id': get_group2_id})['image_count'] == 0
+
+    group = client.get(f"/image_groups/{get_group_id}").json()
+    assert group['image_count'] == 3
+    assert group['bounds']['min_latitude'] == 1.23
+
+    # clients can't overwrite the aggregates
+    client.patch(f"/image_groups/{get_group_id}", json={'group': {'name': 'renamed', 'image_count': 100}})
+    assert db.get_collection('image_groups').find_one({'_id': get_group_id})['image_count'] == 3
@@ -0,0 +1,42 @@
+from http import HTTPStatus
+
+from app.main import app, MAX_BATCH_IDS
+from app.db import connect_to_db
+from tests.test_encoders import get_both
+
+missing_id = 'bbbbbbbbbbbbbbbbbbbbbbbb'
+
+def test_get_images_by_ids(client, mock_mongodb_image_groups_initialized, get_image_id1, get_image_id2):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    ids = [str(get_image_id2), missing_id, str(get_image_id1), 'not-an-id']
+
+    response = client.get("/images", params={'ids': ','.join(ids)})
+    assert response.status_code == HTTPStatus.OK
+    batch = response.json()
+    assert [image and image['id'] for image in batch['images']] == [ids[0], None, ids[2], None], "Images should be in the order of the ids"
+    assert batch['not_found'] == [missing_id, 'not-an-id']
+
+    # repeated ids params work too
+    response = client.get("/images", params=[('ids', ids[0]), ('ids', ids[2])])
+    assert [image['id'] for image in response.json()['images']] == [ids[0], ids[2]]
+
+def test_post_images_by_ids(client, mock_mongodb_image_groups_initialized, get_image_id1):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    ids = [str(get_image_id1), str(get_image_id1), missing_id]
+
+    response = client.post("/images", json={'ids': ids})
+    assert response.status_code == HTTPStatus.OK
+    batch = response.json()
+    assert batch['images'][0] == batch['images'][1], "Duplicate ids should get the same image"
+    assert batch['images'][2] is None and batch['not_found'] == [missing_id]
+
+def test_images_by_ids_limit(client, mock_mongodb_image_groups_initialized):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    response = client.post("/images", json={'ids': [missing_id] * (MAX_BATCH_IDS + 1)})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+def test_get_images_by_ids_equivalent(client, mock_mongodb_image_groups_initialized, get_image_id1, mocker):
+    app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
+    slow, fast = get_both(client, mocker, f"/images?ids={get_image_id1},{missing_id}")
+    assert slow.status_code == fast.status_code == HTTPStatus.OK
+    assert slow.content == fast.content, "Fast encoder output differs from response_model output"
@@ -80,6 +80,7 @@ class test_image_handler(unittest.TestCase):
         assert results['DateTime'] == self.testdate, "DateTime does not match"
         assert results['DateTimeOriginal'] == self.testdate, "DateTimeOriginal does not match"
         assert results['coords']['latitude'] == testcoord and results['coords']['longitude'] -testcoord, "Coordinates do not match"
+        assert results['location'] == {'type': 'Point', 'coordinates': [-testcoord, testcoord]}, "GeoJSON location does not match"
 
     def create_test_image(self, width=100, height=100, color='red', gps_data={}):
         image = Image.new('RGB', (width, height), color=color)
@@ -90,6 +91,27 @@ class test_image_handler(unittest.TestCase):
         stream.seek(0)
         return stream
 
+    # GPS the geo index would reject is left out, the rest of the data is still there
+    def test_get_date_and_coords_bad_gps(self):
+        for latitude, longitude in [
+            ([(123, 1), (45, 1), (0, 1)], [(10, 1), (0, 1), (0, 1)]), # latitude over 90
+            ([(10, 1), (0, 1), (0, 1)], [(190, 1), (0, 1), (0, 1)]), # longitude over 180
+            ([(10, 0), (0, 1), (0, 1)], [(10, 1), (0, 1), (0, 1)]), # zero denominator
+        ]:
+            gps_ifd = {
+                piexif.GPSIFD.GPSLatitudeRef: 'N',
+                piexif.GPSIFD.GPSLatitude: latitude,
+                piexif.GPSIFD.GPSLongitudeRef: 'E',
+                piexif.GPSIFD.GPSLongitude: longitude,
+            }
+            image = Image.open(self.create_test_image(gps_data=gps_ifd))
+            results = ImageDataHandler(image).get_date_and_coords()
+            assert 'coords' not in results and 'location' not in results, f"Bad GPS {latitude} {longitude} kept"
+
+        self.img.getexif.return_value = self.mock_exif({0x8825: 0x0001}, {ExifTags.IFD.GPSInfo: {
+            0x0001: 'N', 0x0002: (float('nan'), 0, 0), 0x0003: 'W', 0x0004: self.testgpsdegrees}})
+        assert 'location' not in ImageDataHandler(self.img).get_date_and_coords(), "NaN latitude kept"
+
     #test remove_gps
     def test_remove_gps(self):
         handler = ImageDataHandler(self.img)
@@ -117,3 +139,15 @@ class test_image_handler(unittest.TestCase):
         print(mod_data)
 
         assert 'GPS' not in mod_data or not mod_data['GPS'], "Modified image still has non-empty GPS data"
+
+    #test remove_gps on an image without exif
+    def test_remove_gps_no_exif(self):
+        stream = io.BytesIO()
+        Image.new('RGB', (100, 80), color='blue').save(stream, format='PNG')
+        stream.seek(0)
+        image = Image.open(stream)
+        handler = ImageDataHandler(image)
+
+        new_exif = handler.remove_gps(image)
+        assert new_exif == b'', "Image without exif should get empty exif"
+        image.save(io.BytesIO(), format='JPEG', exif=new_exif) # still saves
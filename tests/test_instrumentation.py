@@ -0,0 +1,99 @@
+import os
+import json
+import asyncio
+import pytest
+import boto3
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+from moto import mock_aws
+
+from app import instrumentation
+from app.instrumentation import ProfilingMiddleware, RequestProfile
+from app.main import app
+from app.db import connect_to_db
+
+
+def profiled_client(tmp_path, mock_mongodb_image_groups_initialized, **settings):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    return TestClient(ProfilingMiddleware(app, directory=str(tmp_path), **settings))
+
+def test_sampled_request_is_profiled(tmp_path, get_group_id, mock_mongodb_image_groups_initialized):
+    client = profiled_client(tmp_path, mock_mongodb_image_groups_initialized, sample_rate=1, token='')
+    response = client.get(f"/image_groups/{get_group_id}")
+    assert response.status_code == 200
+    profile_id = response.headers['x-profile-id']
+    assert os.path.exists(tmp_path / f"{profile_id}.prof")
+    with open(tmp_path / f"{profile_id}.json") as f:
+        summary = json.load(f)
+    assert summary['route'] == 'get_images'
+    assert summary['status'] == 200
+    assert summary['profiled'] and summary['top_functions']
+    assert summary['duration_ms'] > 0
+    assert not instrumentation.profiler_busy
+
+def test_debug_header(tmp_path, get_group_id, mock_mongodb_image_groups_initialized):
+    client = profiled_client(tmp_path, mock_mongodb_image_groups_initialized, sample_rate=0, token='secret')
+    response = client.get(f"/image_groups/{get_group_id}", headers={'X-Debug-Profile': 'wrong'})
+    assert 'x-profile-id' not in response.headers
+    response = client.get(f"/image_groups/{get_group_id}", headers={'X-Debug-Profile': 'secret'})
+    assert 'x-profile-id' in response.headers
+    assert len(os.listdir(tmp_path)) == 2 # the json and the prof of the second request
+
+def test_old_profiles_deleted(tmp_path, get_group_id, mock_mongodb_image_groups_initialized):
+    client = profiled_client(tmp_path, mock_mongodb_image_groups_initialized, sample_rate=1, token='', max_profiles=2)
+    profile_ids = [client.get(f"/image_groups/{get_group_id}").headers['x-profile-id'] for _ in range(3)]
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{profile_id}.{ext}" for profile_id in profile_ids[1:] for ext in ['json', 'prof']), \
+        "Only the two newest profiles should be kept"
+
+def test_disabled(tmp_path, get_group_id, mock_mongodb_image_groups_initialized):
+    client = profiled_client(tmp_path, mock_mongodb_image_groups_initialized, sample_rate=0, token='')
+    response = client.get(f"/image_groups/{get_group_id}", headers={'X-Debug-Profile': ''})
+    assert response.status_code == 200
+    assert 'x-profile-id' not in response.headers
+    assert os.listdir(tmp_path) == []
+
+def test_mongo_listener():
+    listener = instrumentation.MongoCommandListener()
+    started = SimpleNamespace(command_name='find', command={'find': 'images'}, request_id=1)
+    succeeded = SimpleNamespace(command_name='find', request_id=1, duration_micros=2500)
+    listener.started(started) # not profiled, nothing recorded
+    listener.succeeded(succeeded)
+    assert listener.collections == {}
+
+    profile = RequestProfile('GET', '/images')
+    reset = instrumentation.current.set(profile)
+    try:
+        listener.started(started)
+        listener.succeeded(succeeded)
+        listener.started(SimpleNamespace(command_name='aggregate', command={'aggregate': 'image_groups'}, request_id=2))
+        listener.failed(SimpleNamespace(command_name='aggregate', request_id=2, duration_micros=1000))
+    finally:
+        instrumentation.current.reset(reset)
+    assert [(call['name'], call['collection'], call['ms'], call['ok']) for call in profile.calls] == [
+        ('find', 'images', 2.5, True), ('aggregate', 'image_groups', 1.0, False)]
+    assert profile.summary()['totals'] == {'mongo': {'count': 2, 'ms': 3.5}}
+
+@mock_aws
+def test_s3_hooks():
+    s3_client = instrumentation.instrument_boto_client(boto3.client('s3', region_name='us-east-1'))
+    s3_client.create_bucket(Bucket='bucket')
+    s3_client.put_object(Bucket='bucket', Key='a.jpg', Body=b'a')
+    profile = RequestProfile('GET', '/images')
+    reset = instrumentation.current.set(profile)
+    try:
+        s3_client.head_object(Bucket='bucket', Key='a.jpg')
+        try:
+            s3_client.head_object(Bucket='bucket', Key='missing.jpg')
+        except s3_client.exceptions.ClientError:
+            pass
+    finally:
+        instrumentation.current.reset(reset)
+    assert [(call['type'], call['name'], call['ok']) for call in profile.calls] == [('s3', 'HeadObject', True), ('s3', 'HeadObject', False)]
+
+@pytest.mark.asyncio
+async def test_executor_calls_keep_the_profile():
+    from app.s3_handler import in_executor
+    profile = RequestProfile('GET', '/images')
+    instrumentation.current.set(profile) # the test's own context, gone with it
+    assert await in_executor(asyncio.get_running_loop(), None, instrumentation.current.get) is profile
@@ -0,0 +1,86 @@
+import json
+import logging
+import pytest
+from types import SimpleNamespace
+
+from app import log
+from app.main import app
+from app.db import connect_to_db
+
+
+@pytest.fixture
+def logger():
+    logger = log.get_logger('app.test')
+    yield logger
+    log.setup() # back to LOG_LEVEL
+
+def lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+
+def test_json_lines(logger, capsys):
+    reset = log.correlation_id.set('abc')
+    try:
+        logger.info('Group created', group=123, names=['a', 'b'])
+    finally:
+        log.correlation_id.reset(reset)
+    [line] = lines(capsys)
+    assert line['level'] == 'INFO'
+    assert line['logger'] == 'app.test'
+    assert line['message'] == 'Group created'
+    assert line['correlation_id'] == 'abc'
+    assert (line['group'], line['names']) == (123, ['a', 'b'])
+
+class Expensive:
+    formatted = 0
+
+    def __str__(self):
+        Expensive.formatted += 1
+        return 'expensive'
+
+def test_fields_only_serialized_when_logged(logger, capsys):
+    log.setup('INFO')
+    logger.debug('Documents', documents=Expensive())
+    assert Expensive.formatted == 0
+    assert lines(capsys) == []
+
+    log.setup('DEBUG')
+    logger.debug('Documents', documents=Expensive())
+    assert Expensive.formatted == 1
+    assert lines(capsys)[0]['documents'] == 'expensive'
+
+def test_exception(logger, capsys):
+    try:
+        raise ValueError('bad image')
+    except ValueError:
+        logger.exception('Processing failed', filename='a.jpg')
+    [line] = lines(capsys)
+    assert line['level'] == 'ERROR'
+    assert 'ValueError: bad image' in line['exception']
+
+def test_request_id(client, get_group_id, mock_mongodb_image_groups_initialized, capsys):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    response = client.get(f"/image_groups/{get_group_id}", headers={'X-Request-Id': 'request-1'})
+    assert response.headers['x-request-id'] == 'request-1'
+
+    log.setup('DEBUG')
+    try:
+        response = client.get("/image_groups")
+    finally:
+        log.setup()
+    request_id = response.headers['x-request-id']
+    assert len(request_id) == 32 # a new one
+    logged = [line for line in lines(capsys) if line['message'].startswith('Image group')]
+    assert logged and all(line['correlation_id'] == request_id for line in logged)
+
+def test_processing_correlation_id(mocker):
+    from app import processing
+    mocker.patch('app.processing.process_s3_image', mocker.AsyncMock(return_value={}))
+    processing.handler({'Records': [{'eventSource': 'aws:s3'}]}, SimpleNamespace(aws_request_id='lambda-1'))
+    assert log.correlation_id.get() == 'lambda-1'
+    log.correlation_id.set(None)
+
+def test_not_propagated():
+    log.setup()
+    assert logging.getLogger('app').propagate is False
+    assert len(logging.getLogger('app').handlers) == 1
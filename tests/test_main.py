@@ -8,7 +8,7 @@ from http import HTTPStatus
 from tests.conftest import mock_presign_file, mock_prepare_upload_single_image
 from bson.objectid import ObjectId
 
-from app.main import app, add_images_to_group, prepare_upload_single_image, setup_s3_handler, process_s3_image, handler
+from app.main import app, add_images_to_group, prepare_upload_single_image, setup_s3_handler, handler
 from app.db import connect_to_db
 
 # test get_images
@@ -356,33 +356,17 @@ def make_s3_event(group_id, filename):
               'configurationId': 'image_uploaded',
               'bucket': {'name': 'test_bucket', 'ownerIdentity': {'principalId': 'AAAAA'}, 'arn': 'arn:aws:s3:::test'},
               'object': {'key': f"original/{group_id}/{filename}", 'size': 1024, 'eTag': 'eTAG', 'sequencer': 'asdfasdfasdf'}}}]}
-@pytest.mark.asyncio
-async def test_process_image(get_group_id, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
-    filename = 'img1.jpg'
-    # Mocked S3 event
-    event = make_s3_event(get_group_id, filename)
-    context = MagicMock()
-
-    mocker.patch('app.main.connect_to_db', generate_mock_mongodb_image_groups_initialized)
-    #app.dependency_overrides[connect_to_db] = generate_mock_mongodb_image_groups_initialized
-    mocker.patch('app.main.S3Handler', mock_s3_handler)
-
-    image_data = await process_s3_image(event, context)
-    print('image_data:', image_data)
-
-    assert image_data['filename'] == filename, "Filename does not match"
-    assert 'filename' in image_data, "Data not found"
-    assert 'data' in image_data, "Data not found"
-
 def test_handler(get_group_id, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
     filename = 'img1.jpg'
     # Mocked S3 event
     event = make_s3_event(get_group_id, filename)
     context = MagicMock()
 
-    mocker.patch('app.main.connect_to_db', generate_mock_mongodb_image_groups_initialized)
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    mocker.patch('app.processing.get_db', lambda: db)
+    mocker.patch('app.main.get_db', lambda: db)
     #app.dependency_overrides[connect_to_db] = mock_mongodb_image_groups_initialized
-    mocker.patch('app.main.S3Handler', mock_s3_handler)
+    mocker.patch('app.processing.get_s3_handler', mock_s3_handler)
 
     image_data = handler(event, context)
     print('image_data:', image_data)
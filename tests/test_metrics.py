@@ -0,0 +1,120 @@
+import json
+import boto3
+import pytest
+from types import SimpleNamespace
+from moto import mock_aws
+
+from app import metrics, instrumentation
+from app.metrics import Registry
+from app.main import app
+from app.db import connect_to_db
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter('things_total', 'Things', ('kind',))
+    histogram = registry.histogram('thing_seconds', 'Thing latency', buckets=(0.1, 1))
+    counter.inc(kind='a "quoted"\nthing')
+    counter.inc(2, kind='b')
+    for value in [0.05, 0.5, 5]:
+        histogram.observe(value)
+    text = registry.render()
+    assert '# TYPE things_total counter' in text
+    assert 'things_total{kind="a \\"quoted\\"\\nthing"} 1' in text
+    assert 'things_total{kind="b"} 2' in text
+    assert 'thing_seconds_bucket{le="0.1"} 1' in text
+    assert 'thing_seconds_bucket{le="1"} 2' in text
+    assert 'thing_seconds_bucket{le="+Inf"} 3' in text
+    assert 'thing_seconds_sum 5.55' in text
+    assert 'thing_seconds_count 3' in text
+
+def test_registered_once():
+    registry = Registry()
+    registry.counter('things_total', 'Things')
+    with pytest.raises(ValueError):
+        registry.gauge('things_total', 'Things')
+
+def test_emf():
+    registry = Registry()
+    counter = registry.counter('things_total', 'Things', ('kind',))
+    histogram = registry.histogram('thing_seconds', 'Thing latency')
+    registry.gauge('depth', 'Depth', callback=lambda: {(): 3})
+    counter.inc(5, kind='a')
+    histogram.observe(0.2)
+    histogram.observe(0.3)
+
+    lines = [json.loads(line) for line in registry.emf('Bandpics', timestamp=1)]
+    assert lines[0]['_aws'] == {'Timestamp': 1000, 'CloudWatchMetrics': [{
+        'Namespace': 'Bandpics', 'Dimensions': [['kind']], 'Metrics': [{'Name': 'things_total', 'Unit': 'Count'}]}]}
+    assert (lines[0]['kind'], lines[0]['things_total']) == ('a', 5)
+    assert lines[1]['thing_seconds'] == {'Values': [0.2, 0.3], 'Counts': [1, 1]}
+    assert lines[2]['depth'] == 3
+
+    counter.inc(kind='a')
+    lines = [json.loads(line) for line in registry.emf('Bandpics')]
+    assert [line.get('things_total') for line in lines] == [1, None] # only the increment, no histogram values left
+    assert 'thing_seconds_count 2' in registry.render() # Prometheus stays cumulative
+
+def test_emf_every_observation():
+    registry = Registry()
+    histogram = registry.histogram('thing_seconds', 'Thing latency')
+    for i in range(1000):
+        histogram.observe(0.001 * (i % 250 + 1)) # 250 distinct values, 4 times each
+    histogram.observe(0.0012341) # kept with 3 significant digits
+
+    lines = [json.loads(line)['thing_seconds'] for line in registry.emf('Bandpics')]
+    assert [len(line['Values']) for line in lines] == [100, 100, 51]
+    assert sum(sum(line['Counts']) for line in lines) == 1001, "Every observation should be in the EMF lines"
+    assert lines[0]['Values'][:2] == [0.001, 0.00123] and lines[0]['Counts'][:2] == [4, 1]
+
+def test_metrics_endpoint(client, get_group_id, mock_mongodb_image_groups_initialized):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    assert client.get(f"/image_groups/{get_group_id}").status_code == 200
+    assert client.get("/nowhere").status_code == 404
+    response = client.get("/metrics")
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'http_request_duration_seconds_count{route="get_images",method="GET",status="200"}' in response.text
+    assert 'http_request_duration_seconds_count{route="unmatched",method="GET",status="404"}' in response.text
+    assert 'executor_queue_depth{executor="anyio"}' in response.text
+
+def count(histogram, **labels):
+    series = histogram.values.get(histogram.key(labels))
+    return series[2] if series else 0
+
+def test_mongo_metrics():
+    listener = instrumentation.MongoCommandListener()
+    before = count(metrics.mongo_commands, collection='images', command='getMore')
+    listener.started(SimpleNamespace(command_name='getMore', command={'getMore': 123, 'collection': 'images'}, request_id=1))
+    listener.failed(SimpleNamespace(command_name='getMore', request_id=1, duration_micros=1000))
+    assert count(metrics.mongo_commands, collection='images', command='getMore') == before + 1
+    assert metrics.mongo_failures.values[('images', 'getMore')] >= 1
+
+@mock_aws
+def test_s3_metrics():
+    s3_client = instrumentation.instrument_boto_client(boto3.client('s3', region_name='us-east-1'))
+    s3_client.create_bucket(Bucket='bucket')
+    sent = metrics.s3_bytes.values.get(('PutObject', 'sent'), 0)
+    received = metrics.s3_bytes.values.get(('GetObject', 'received'), 0)
+    s3_client.put_object(Bucket='bucket', Key='a.jpg', Body=b'x' * 1000)
+    s3_client.get_object(Bucket='bucket', Key='a.jpg')['Body'].read()
+    assert metrics.s3_bytes.values[('PutObject', 'sent')] == sent + 1000
+    assert metrics.s3_bytes.values[('GetObject', 'received')] == received + 1000
+    assert count(metrics.s3_calls, operation='PutObject') >= 1
+
+def test_image_processed():
+    before = metrics.pixels_processed.values.get((), 0)
+    rates = count(metrics.processing_rate)
+    metrics.image_processed({'width': 4000, 'height': 3000, 'megapixels': 12, 'total_ms': 2000})
+    assert metrics.pixels_processed.values[()] == before + 12_000_000
+    assert count(metrics.processing_rate) == rates + 1
+
+def test_flush_emf(monkeypatch, capsys):
+    monkeypatch.delenv('METRICS_EMF_NAMESPACE', raising=False)
+    metrics.flush_emf()
+    assert capsys.readouterr().out == ''
+    monkeypatch.setenv('METRICS_EMF_NAMESPACE', 'Bandpics')
+    metrics.images_processed.inc(status='done')
+    metrics.flush_emf()
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert any(line.get('images_processed_total') for line in lines)
@@ -0,0 +1,53 @@
+import io
+import base64
+from bson import ObjectId
+from PIL import Image, ImageDraw
+
+from app import group_stats
+from app.placeholders import placeholder, dominant_color
+from app.main import app
+from app.db import connect_to_db
+
+
+def test_placeholder():
+    image = Image.linear_gradient('L').resize((300, 200)).convert('RGB')
+    uri = placeholder(image)
+    assert uri.startswith('data:image/jpeg;base64,')
+    jpeg = base64.b64decode(uri.removeprefix('data:image/jpeg;base64,'))
+    assert len(jpeg) < 1000, "Placeholder should stay tiny"
+    tiny = Image.open(io.BytesIO(jpeg))
+    assert tiny.format == 'JPEG' and tiny.size == (16, 11)
+
+def test_placeholder_of_other_modes():
+    assert placeholder(Image.new('RGBA', (50, 50), (0, 0, 255, 128))).startswith('data:image/jpeg;base64,')
+    assert placeholder(Image.new('L', (50, 50), 128)).startswith('data:image/jpeg;base64,')
+
+def test_dominant_color():
+    image = Image.new('RGB', (300, 200), (200, 30, 30))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 100, 200), fill=(20, 40, 220)) # a third blue
+    assert dominant_color(image) == '#c81e1e'
+    assert dominant_color(Image.new('L', (10, 10), 255)) == '#ffffff'
+
+def test_cover_has_placeholder(client, get_group_id, mock_mongodb_image_groups_initialized):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    images = db.get_collection('images')
+    images.update_many({'group': get_group_id}, {'$unset': {'data': ''}}) # nothing processed yet
+    db.get_collection('image_groups').update_one({'_id': get_group_id}, {'$unset': {'cover': ''}})
+    image_id = images.insert_one({'filename': 'new.jpg', 'group': get_group_id, 'data': {
+        'placeholder': 'data:image/jpeg;base64,AAAA', 'dominant_color': '#102030'}}).inserted_id
+    group_stats.image_processed(db, images.find_one({'_id': image_id}))
+
+    groups = client.get("/image_groups").json()
+    cover = next(group for group in groups if group['id'] == str(get_group_id))['cover']
+    assert cover['placeholder'] == 'data:image/jpeg;base64,AAAA'
+    assert cover['dominant_color'] == '#102030'
+
+    group = client.get(f"/image_groups/{get_group_id}").json()
+    image = next(image for image in group['images'] if image['id'] == str(image_id))
+    assert image['data']['dominant_color'] == '#102030'
+
+def test_make_cover_without_placeholder():
+    cover = group_stats.make_cover('g', {'_id': ObjectId(), 'filename': 'a.jpg', 'data': {}})
+    assert 'placeholder' not in cover and 'dominant_color' not in cover
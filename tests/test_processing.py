@@ -0,0 +1,86 @@
+from unittest.mock import MagicMock
+import pytest
+
+from app import processing, cache, status
+from app.cache import LRUCache
+from tests.test_main import make_s3_event
+from tests.conftest import test_event_id
+
+@pytest.mark.asyncio
+async def test_process_image(get_group_id, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    filename = 'img1.jpg'
+    # Mocked S3 event
+    event = make_s3_event(get_group_id, filename)
+    context = MagicMock()
+
+    mocker.patch('app.processing.get_db', lambda: next(generate_mock_mongodb_image_groups_initialized()))
+    mocker.patch('app.processing.get_s3_handler', mock_s3_handler)
+
+    image_data = await processing.process_s3_image(event, context)
+    print('image_data:', image_data)
+
+    assert image_data['filename'] == filename, "Filename does not match"
+    assert 'filename' in image_data, "Data not found"
+    assert 'data' in image_data, "Data not found"
+
+def test_handler(get_group_id, get_image_id1, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    mocker.patch('app.processing.get_db', lambda: db)
+    mocker.patch('app.processing.get_s3_handler', mock_s3_handler)
+    shared = LRUCache()
+    mocker.patch('app.processing.shared_cache', shared)
+    keys = [cache.image_key(get_image_id1), cache.group_key(get_group_id), cache.event_key(test_event_id)]
+    for key in keys:
+        shared.set(key, {'etag': '"x"', 'body': b'{}'})
+
+    image_data = processing.handler(make_s3_event(get_group_id, 'img1.jpg'), MagicMock())
+    assert image_data['id'] == str(get_image_id1)
+    assert all(shared.get(key) is None for key in keys), "Cached responses for the image should be removed"
+
+def test_handler_other_events():
+    assert processing.handler({'httpMethod': 'GET', 'path': '/'}, MagicMock()) == {'error': 'Not an S3 event'}
+
+def test_handler_bumps_versions_without_shared_cache(get_group_id, get_image_id1, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    mocker.patch('app.processing.get_db', lambda: db)
+    mocker.patch('app.processing.get_s3_handler', mock_s3_handler)
+    mocker.patch('app.processing.shared_cache', None)
+    keys = [cache.image_key(get_image_id1), cache.group_key(get_group_id), cache.event_key(test_event_id)]
+    before = [cache.current_version(db, key) for key in keys]
+
+    processing.handler(make_s3_event(get_group_id, 'img1.jpg'), MagicMock())
+    assert all(cache.current_version(db, key) > version for key, version in zip(keys, before)), \
+        "The API containers should see the processed image"
+
+@pytest.mark.asyncio
+async def test_process_image_failed_bumps_versions(get_group_id, get_image_id1, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    s3 = mock_s3_handler()
+    s3.process_image.side_effect = OSError('broken image')
+    mocker.patch('app.processing.shared_cache', None)
+    invalidated = []
+    mocker.patch('app.processing.invalidate_cached', lambda db, image: invalidated.append(image['_id']))
+
+    with pytest.raises(OSError):
+        await processing.process_image_file(db, s3, str(get_group_id), 'img1.jpg')
+    assert invalidated == [get_image_id1, get_image_id1], "The metadata stage and the failure should both invalidate the image"
+    image = db.get_collection('images').find_one({'_id': get_image_id1})
+    assert image['status'] == status.FAILED and image['status_error'] == 'broken image'
+
+@pytest.mark.asyncio
+async def test_process_image_stage_bumps_versions(get_group_id, get_image_id1, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    s3 = mock_s3_handler()
+    mocker.patch('app.processing.shared_cache', None)
+    key = cache.image_key(get_image_id1)
+    seen = []
+    async def process_image(group, filename, on_stage=None):
+        before = cache.current_version(db, key)
+        on_stage(status.RENDITIONS)
+        seen.append((db.get_collection('images').find_one({'_id': get_image_id1})['status'], cache.current_version(db, key) - before))
+        raise OSError('stop')
+    s3.process_image.side_effect = process_image
+
+    with pytest.raises(OSError):
+        await processing.process_image_file(db, s3, str(get_group_id), 'img1.jpg')
+    assert seen == [(status.RENDITIONS, 1)], "The renditions stage should be visible to the API containers"
@@ -0,0 +1,115 @@
+import io
+import asyncio
+import boto3
+import httpx
+import pytest
+from moto import mock_aws
+from PIL import Image
+
+from app import renditions
+from app.renditions import output_size, source_key, render, moved
+from app.main import app, setup_s3_handler, single_flights
+from app.db import connect_to_db
+from app.s3_handler import S3Handler
+
+bucket_name = 'test-bucket'
+
+def jpeg(width, height, color='red'):
+    stream = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(stream, format='JPEG')
+    return stream.getvalue()
+
+def ladder(group, filename):
+    return [{'width': 320, 'height': 240, 'key': f"w320/{group}/{filename}"},
+            {'width': 640, 'height': 480, 'key': f"w640/{group}/{filename}"},
+            {'width': 2880, 'height': 2160, 'key': f"fullsize/{group}/{filename}"}]
+
+def test_output_size():
+    assert output_size((2880, 2160), width=640) == ((640, 480), (640, 480))
+    assert output_size((2880, 2160), width=640, height=240) == ((320, 240), (320, 240)) # contain, the height limits it
+    assert output_size((2880, 2160), width=640, height=240, fit='cover') == ((640, 480), (640, 240))
+    assert output_size((300, 200), width=640) == ((300, 200), (300, 200)) # not upscaled
+    assert output_size((300, 200), width=640, height=640, fit='cover') == ((300, 200), (200, 200)) # the box is reduced
+
+def test_source_key():
+    image = {'group': 'g', 'filename': 'a.jpg', 'data': {'renditions': ladder('g', 'a.jpg')}}
+    assert source_key(image, width=320) == 'w320/g/a.jpg'
+    assert source_key(image, width=480) == 'w640/g/a.jpg' # the nearest larger one
+    assert source_key(image, height=320) == 'w640/g/a.jpg' # 427 wide
+    assert source_key(image, width=320, height=320, fit='cover') == 'w640/g/a.jpg'
+    assert source_key(image, width=1920) == 'fullsize/g/a.jpg'
+    assert source_key({'group': 'g', 'filename': 'a.jpg', 'data': {}}, width=320) == 'fullsize/g/a.jpg' # processed before the ladder
+
+def test_render():
+    webp = Image.open(io.BytesIO(render(jpeg(640, 480), width=320, height=320, fit='cover', format='webp')))
+    assert webp.format == 'WEBP' and webp.size == (320, 320)
+    assert Image.open(io.BytesIO(render(jpeg(640, 480), height=120))).size == (160, 120)
+
+def test_moved():
+    assert [rendition['key'] for rendition in moved(ladder('g', 'a.jpg'), 'h', 'a.jpg')] == ['w320/h/a.jpg', 'w640/h/a.jpg', 'fullsize/h/a.jpg']
+
+@pytest.fixture
+def s3_bucket():
+    with mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=bucket_name)
+        handler = S3Handler()
+        handler.s3_client = s3
+        handler.bucket_name = bucket_name
+        yield handler
+
+@pytest.fixture
+def rendition_app(mock_mongodb_image_groups_initialized, get_image_id1, get_group_id, s3_bucket):
+    db = mock_mongodb_image_groups_initialized()
+    db.get_collection('images').update_one({'_id': get_image_id1}, {'$set': {'data.renditions': ladder(get_group_id, 'img1.jpg')}})
+    # the widths in different colors to see which one was used
+    for rendition, color in zip(ladder(get_group_id, 'img1.jpg'), ['blue', 'green', 'red']):
+        s3_bucket.s3_client.put_object(Bucket=bucket_name, Key=rendition['key'], Body=jpeg(rendition['width'], rendition['height'], color))
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = lambda: s3_bucket
+    yield s3_bucket
+    app.dependency_overrides.clear()
+
+def test_get_rendition(client, rendition_app, get_image_id1, get_group_id):
+    response = client.get(f"/images/{get_image_id1}/rendition", params={'width': 480, 'format': 'webp'}, follow_redirects=False)
+    assert response.status_code == 307
+    key = f"cache/{get_group_id}/img1.jpg/480x-contain.webp"
+    assert key in response.headers['location']
+    cached = rendition_app.s3_client.get_object(Bucket=bucket_name, Key=key)
+    assert cached['ContentType'] == 'image/webp'
+    image = Image.open(cached['Body'])
+    assert image.size == (480, 360)
+    assert image.getpixel((240, 180))[1] > 100, "Not made from the 640 wide rendition"
+
+    # the next request is redirected to the cached one without making it again
+    rendition_app.s3_client.delete_object(Bucket=bucket_name, Key=f"w640/{get_group_id}/img1.jpg")
+    assert client.get(f"/images/{get_image_id1}/rendition", params={'width': 480, 'format': 'webp'}, follow_redirects=False).status_code == 307
+
+    # dropped when the image is deleted
+    asyncio.run(rendition_app.delete_image(str(get_group_id), 'img1.jpg'))
+    assert not asyncio.run(rendition_app.file_exists(key))
+
+def test_get_rendition_errors(client, rendition_app, get_image_id1):
+    url = f"/images/{get_image_id1}/rendition"
+    assert client.get(url, follow_redirects=False).status_code == 400 # no size
+    assert client.get(url, params={'width': 333}, follow_redirects=False).status_code == 400 # not in the allowlist
+    assert client.get(url, params={'width': 320, 'fit': 'stretch'}, follow_redirects=False).status_code == 422
+    assert client.get(url, params={'width': 320, 'format': 'gif'}, follow_redirects=False).status_code == 422
+    assert client.get("/images/nope/rendition", params={'width': 320}, follow_redirects=False).status_code == 400
+    assert client.get("/images/bbbbbbbbbbbbbbbbbbbbbbbb/rendition", params={'width': 320}, follow_redirects=False).status_code == 404
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_make_it_once(rendition_app, get_image_id1, monkeypatch):
+    rendered = []
+    def counting_render(*args):
+        rendered.append(args)
+        return render(*args)
+    monkeypatch.setattr(renditions, 'render', counting_render)
+    flight = single_flights['get_rendition']
+    executed, coalesced = flight.executed, flight.coalesced
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        responses = await asyncio.gather(*[client.get(f"/images/{get_image_id1}/rendition", params={'height': 160}) for _ in range(5)])
+    assert [response.status_code for response in responses] == [307] * 5
+    assert len(rendered) == 1
+    assert flight.executed - executed + flight.coalesced - coalesced == 5 and flight.executed - executed < 5
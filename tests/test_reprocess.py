@@ -0,0 +1,104 @@
+import io
+import time
+import boto3
+import pytest
+import piexif
+import mongomock
+from moto import mock_aws
+from PIL import Image
+
+from app import renditions
+from app.processing import process_image_file
+from app.reprocess import RateLimiter, plan, reprocess
+from app.s3_handler import S3Handler
+
+bucket_name = 'test-bucket'
+settings = {'format': 'jpeg', 'fullsize_side': 2880, 'thumbnail_side': 300, 'ladder_widths': [320, 640, 1280, 1920]}
+
+def data_with(fullsize_width, fullsize_height, **fields):
+    return {
+        'renditions': [{'width': width, 'height': 0, 'key': f"w{width}/g/a.jpg"} for width in [320, 640, 1280, 1920] if width < fullsize_width] +
+                      [{'width': fullsize_width, 'height': fullsize_height, 'key': 'fullsize/g/a.jpg'}],
+        **fields,
+    }
+
+def test_plan():
+    current = data_with(2880, 2160, rendition_specs=renditions.specs(settings, 2880))
+    assert plan(current, settings) == {'source': 'fullsize', 'stale': set(), 'extra': set()}
+    # recorded before the specs, with the same settings
+    assert plan(data_with(2880, 2160), settings) == {'source': 'fullsize', 'stale': set(), 'extra': set()}
+
+    assert plan(current, {**settings, 'thumbnail_side': 200})['stale'] == {'thumb'}
+    changed_ladder = plan(current, {**settings, 'ladder_widths': [320, 800, 1280]})
+    assert (changed_ladder['stale'], changed_ladder['extra']) == ({'w800'}, {'w640', 'w1920'})
+    assert plan(current, {**settings, 'format': 'webp'})['source'] == 'fullsize' # every file, from the fullsize image
+
+    # a larger fullsize side needs the original, unless the old fullsize image already was the original's size
+    assert plan(current, {**settings, 'fullsize_side': 4000})['source'] == 'original'
+    assert plan(data_with(2000, 1500), {**settings, 'fullsize_side': 4000})['source'] == 'fullsize'
+    assert plan(data_with(2880, 2160, original_size=[3000, 2250]), {**settings, 'fullsize_side': 4000})['source'] == 'original'
+    assert plan(current, {**settings, 'fullsize_side': 2048}) == {'source': 'fullsize', 'stale': None, 'extra': None}
+
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    limiter = RateLimiter(100)
+    start = time.monotonic()
+    for _ in range(150): # 100 in the bucket, 50 more at 100 per second
+        await limiter.acquire()
+    assert 0.4 < time.monotonic() - start < 1.5
+    await RateLimiter(0).acquire(1000) # no limit
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=bucket_name)
+        handler = S3Handler()
+        handler.s3_client = client
+        handler.bucket_name = bucket_name
+        yield handler
+
+def etag(s3, key):
+    return s3.s3_client.head_object(Bucket=bucket_name, Key=key)['ETag']
+
+@pytest.mark.asyncio
+async def test_reprocess(s3):
+    db = mongomock.MongoClient().get_database('reprocess')
+    group = db.get_collection('image_groups').insert_one({'name': 'g'}).inserted_id
+    image_id = db.get_collection('images').insert_one({'filename': 'a.jpg', 'group': group, 'data': {}}).inserted_id
+    stream = io.BytesIO()
+    Image.linear_gradient('L').resize((4048, 3036)).convert('RGB').save(stream, format='JPEG', exif=piexif.dump({'0th': {}, 'Exif': {}, 'GPS': {}}))
+    s3.s3_client.put_object(Bucket=bucket_name, Key=f"original/{group}/a.jpg", Body=stream.getvalue())
+    await process_image_file(db, s3, str(group), 'a.jpg')
+    fullsize_etag = etag(s3, f"fullsize/{group}/a.jpg")
+    lines = []
+    assert (await reprocess(db, s3, report=lines.append))['total'] == 0 # up to date
+
+    s3.thumbnail_side = 200
+    s3.ladder_widths = (320, 800, 1280)
+    assert (await reprocess(db, s3, dry_run=True, report=lines.append))['sources'] == {'fullsize': 1}
+    summary = await reprocess(db, s3, concurrency=2, report=lines.append)
+    assert summary['outcomes'] == {'fullsize': 1}
+    image = db.get_collection('images').find_one({'_id': image_id})
+    assert image['data']['rendition_version'] == renditions.version(renditions.settings(s3))
+    assert [rendition['width'] for rendition in image['data']['renditions']] == [320, 800, 1280, 2880]
+    thumb = Image.open(s3.s3_client.get_object(Bucket=bucket_name, Key=f"thumb/{group}/a.jpg")['Body'])
+    assert thumb.width == 200
+    assert await s3.file_exists(f"w800/{group}/a.jpg")
+    assert not await s3.file_exists(f"w1920/{group}/a.jpg") and not await s3.file_exists(f"w640/{group}/a.jpg")
+    assert etag(s3, f"fullsize/{group}/a.jpg") == fullsize_etag, "The fullsize image was up to date"
+    assert (await reprocess(db, s3, report=lines.append))['total'] == 0 # done, a new run has nothing to do
+
+    s3.fullsize_side = 4000 # more than the old fullsize image has
+    summary = await reprocess(db, s3, report=lines.append)
+    assert summary['outcomes'] == {'original': 1}
+    fullsize = Image.open(s3.s3_client.get_object(Bucket=bucket_name, Key=f"fullsize/{group}/a.jpg")['Body'])
+    assert fullsize.width == 4000
+    assert db.get_collection('images').find_one({'_id': image_id})['data']['rendition_specs']['fullsize'] == 'jpeg/4000'
+
+    # another format, the keys stay the same and the files have its content type
+    s3.rendition_format = 'webp'
+    assert (await reprocess(db, s3, report=lines.append))['outcomes'] == {'fullsize': 1}
+    for folder in ['fullsize', 'thumb', 'w320']:
+        stored = s3.s3_client.get_object(Bucket=bucket_name, Key=f"{folder}/{group}/a.jpg")
+        assert stored['ContentType'] == 'image/webp' and Image.open(stored['Body']).format == 'WEBP'
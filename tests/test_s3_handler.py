@@ -1,8 +1,10 @@
+import asyncio
 import unittest
 from unittest.mock import patch, MagicMock
 import boto3
 from moto import mock_aws
-from app.s3_handler import S3Handler
+from app.s3_handler import S3Handler, get_s3_handler, reset_s3_handler
+from datetime import datetime, timedelta, timezone
 from PIL import Image
 import piexif
 import io
@@ -176,11 +178,15 @@ class test_s3_handler(unittest.IsolatedAsyncioTestCase):
         key1 = f"original/{group}/{filename}"
         key2 = f"fullsize/{group}/{filename}"
         key3 = f"thumb/{group}/{filename}"
+        key4 = f"w640/{group}/{filename}"
         s3.Object(self.bucket_name, key1).put(Body=image_bytes1)
         s3.Object(self.bucket_name, key2).put(Body=image_bytes2)
         s3.Object(self.bucket_name, key3).put(Body=image_bytes3)
+        s3.Object(self.bucket_name, key4).put(Body=image_bytes3)
 
         results = await self.s3_handler.delete_image(group, filename)
+        assert key4 in results['files'], f"{key4} not in files listed as deleted"
+        assert not await self.s3_handler.file_exists(key4), "Ladder width not deleted"
 
         assert key1 in results['files'], f"{key1} not in files listed as deleted"
         assert key2 in results['files'], f"{key2} not in files listed as deleted"
@@ -213,12 +219,17 @@ class test_s3_handler(unittest.IsolatedAsyncioTestCase):
         key1 = f"original/{group1}/{filename}"
         key2 = f"fullsize/{group1}/{filename}"
         key3 = f"thumb/{group1}/{filename}"
+        key4 = f"w640/{group1}/{filename}"
         s3.Object(self.bucket_name, key1).put(Body=image_bytes1)
         s3.Object(self.bucket_name, key2).put(Body=image_bytes2)
         s3.Object(self.bucket_name, key3).put(Body=image_bytes3)
+        s3.Object(self.bucket_name, key4).put(Body=image_bytes3)
 
         results = await self.s3_handler.move_image(group1, group2, filename)
         print(results)
+        # only the ladder widths the image has are moved
+        assert sorted(result['old_key'] for result in results) == sorted([key1, key2, key3, key4])
+        assert await self.s3_handler.file_exists(f"w640/{group2}/{filename}"), "Ladder width not moved"
 
         for result in results:
             assert result['old_key'] != result['new_key'], "File not moved in results"
@@ -238,6 +249,47 @@ class test_s3_handler(unittest.IsolatedAsyncioTestCase):
         except s3.meta.client.exceptions.NoSuchKey:
             assert True
 
+    # a name taken in the new group renames every file of the image the same way
+    async def test_move_image_renamed(self):
+        s3 = boto3.resource("s3")
+        group1, group2, filename = 'test_move_renamed1', 'test_move_renamed2', 'test_image.jpg'
+        for folder in ['original', 'fullsize', 'thumb']:
+            s3.Object(self.bucket_name, f"{folder}/{group1}/{filename}").put(Body=b'image')
+        s3.Object(self.bucket_name, f"original/{group2}/{filename}").put(Body=b'other image') # only the original is taken
+
+        results = await self.s3_handler.move_image(group1, group2, filename)
+        assert [result['new_key'] for result in results] == [f"{folder}/{group2}/test_image-1.jpg" for folder in ['original', 'fullsize', 'thumb']]
+
+    # images with the same filename moved into a group together get different names
+    async def test_move_images_same_name(self):
+        s3 = boto3.resource("s3")
+        group3, filename = 'test_move_same3', 'a.jpg'
+        for group in ['test_move_same1', 'test_move_same2']:
+            for folder in ['original', 'fullsize', 'thumb']:
+                s3.Object(self.bucket_name, f"{folder}/{group}/{filename}").put(Body=group.encode())
+        s3.Object(self.bucket_name, f"original/{group3}/a-1.jpg").put(Body=b'taken')
+
+        names = await self.s3_handler.reserve_filenames(group3, [filename, filename])
+        assert names == ['a.jpg', 'a-2.jpg']
+        await asyncio.gather(*[self.s3_handler.move_image(group, group3, filename, name)
+                               for group, name in zip(['test_move_same1', 'test_move_same2'], names)])
+        for group, name in zip(['test_move_same1', 'test_move_same2'], names):
+            for folder in ['original', 'fullsize', 'thumb']:
+                assert s3.Object(self.bucket_name, f"{folder}/{group3}/{name}").get()['Body'].read() == group.encode()
+
+    # when a file can't be moved the others are moved back
+    async def test_move_image_failed(self):
+        s3 = boto3.resource("s3")
+        group1, group2, filename = 'test_move_failed1', 'test_move_failed2', 'test_image.jpg'
+        for folder in ['original', 'thumb']: # no fullsize, its copy fails
+            s3.Object(self.bucket_name, f"{folder}/{group1}/{filename}").put(Body=b'image')
+
+        results = await self.s3_handler.move_image(group1, group2, filename)
+        assert any('error' in result for result in results)
+        for folder in ['original', 'thumb']:
+            assert await self.s3_handler.file_exists(f"{folder}/{group1}/{filename}"), f"{folder} not moved back"
+            assert not await self.s3_handler.file_exists(f"{folder}/{group2}/{filename}")
+
     # test check_and_rename_file
     async def test_check_and_rename_file(self):
         s3 = boto3.resource("s3")
@@ -303,7 +355,48 @@ class test_s3_handler(unittest.IsolatedAsyncioTestCase):
 
         #check for date and coordinates
         assert 'data' in results, "Date and coordinates not in results"
+        assert len(results['data']['phash']) == 16, "Perceptual hash not in the data"
+        assert results['data']['placeholder'].startswith('data:image/jpeg;base64,'), "Placeholder not in the data"
+        assert results['data']['dominant_color'].startswith('#'), "Dominant color not in the data"
+
+        #check for the metrics
+        metrics = results['metrics']
+        assert list(metrics['stages_ms']) == ['download', 'decode', 'exif', 'resize', 'encode', 'hash', 'placeholder', 'upload'], "Stages missing"
+        assert metrics['megapixels'] == round(width * height / 1_000_000, 2)
+        assert metrics['bytes']['downloaded'] == len(image_bytes.getvalue())
+        assert metrics['bytes']['uploaded'] == metrics['bytes']['thumb'] + metrics['bytes']['fullsize'] + metrics['bytes']['ladder']
+        assert metrics['peak_rss_mb'] > 0
+
+        #check the ladder, the fullsize image is the widest
+        ladder = results['data']['renditions']
+        assert [rendition['width'] for rendition in ladder] == [320, 640, 1280, 1920, 2880], "Ladder widths don't match"
+        assert ladder[-1]['key'] == f"fullsize/{group}/{filename}"
+        for rendition in ladder[:-1]:
+            assert rendition['key'] == f"w{rendition['width']}/{group}/{filename}"
+            assert rendition['key'] in results['files'], "Rendition not in the files"
+            rung = Image.open(s3.Object(self.bucket_name, rendition['key']).get()['Body'])
+            assert rung.size == (rendition['width'], rendition['height']), "Rendition not resized to its width"
+            assert abs(rung.width / rung.height - width / height) < 0.01, "Rendition aspect ratio changed"
+
+    # the ladder only has the widths narrower than the image
+    async def test_process_small_image(self):
+        filename = 'small.jpg'
+        group = 'test_process_small_image'
+        s3 = boto3.resource("s3")
+        s3.Object(self.bucket_name, f"original/{group}/{filename}").put(Body=self.create_test_image(width=900, height=1200))
+        results = await self.s3_handler.process_image(group, filename)
 
+        assert [(rendition['width'], rendition['height']) for rendition in results['data']['renditions']] == [(320, 427), (640, 853), (900, 1200)]
+        thumb = Image.open(s3.Object(self.bucket_name, f"thumb/{group}/{filename}").get()['Body'])
+        assert thumb.height == self.s3_handler.thumbnail_side, "Not resized to thumbnail size"
 
+    # Test the shared handler is reused until its credentials are about to expire
+    def test_get_s3_handler(self):
+        reset_s3_handler()
+        handler = get_s3_handler()
+        assert get_s3_handler() is handler, "Handler should be shared"
 
-
+        handler.expiration = datetime.now(timezone.utc) + timedelta(minutes=1)
+        assert handler.expiring(), "Credentials expiring within the margin"
+        assert get_s3_handler() is not handler, "Handler should be replaced before the credentials expire"
+        reset_s3_handler()
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import pytest
+import httpx
+from http import HTTPStatus
+
+from app.main import app, single_flights
+from app.db import connect_to_db
+from app.singleflight import SingleFlight, SingleFlightRoutes
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces():
+    flight = SingleFlight('test')
+    calls = 0
+    async def query():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {'calls': calls}
+
+    results = await asyncio.gather(*[flight.do('key', query) for _ in range(10)])
+    assert calls == 1, "Query should run once"
+    assert all(result is results[0] for result in results), "All calls should share the result"
+    assert flight.stats()['executed'] == 1 and flight.stats()['coalesced'] == 9
+    assert flight.in_flight == {}, "Finished call not removed"
+
+    await flight.do('key', query) # not in flight anymore so it runs again
+    assert calls == 2
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_errors():
+    flight = SingleFlight('test')
+    async def query():
+        await asyncio.sleep(0.01)
+        raise ValueError('not found')
+
+    results = await asyncio.gather(*[flight.do('key', query) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results), "Error should be raised for every call"
+    assert flight.stats()['executed'] == 1
+
+@pytest.mark.asyncio
+async def test_single_flight_disabled():
+    routes = SingleFlightRoutes(['get_images'])
+    flight = routes['other_route']
+    calls = 0
+    async def query():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[flight.do('key', query) for _ in range(3)])
+    assert calls == 3, "Disabled route shouldn't coalesce"
+    assert routes.stats()['other_route']['coalesced'] == 0
+
+# collection wrapper where the aggregation is slow and counted
+class SlowAggregate:
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = 0
+    def aggregate(self, *args, **kwargs):
+        self.calls += 1
+        time.sleep(0.2)
+        return self.collection.aggregate(*args, **kwargs)
+
+@pytest.mark.asyncio
+async def test_get_images_coalesced(mock_mongodb_image_groups_initialized, get_group_id):
+    db = mock_mongodb_image_groups_initialized()
+    groups = SlowAggregate(db.get_collection('image_groups'))
+    class MockDB:
+        def get_collection(self, name):
+            return groups if name == 'image_groups' else db.get_collection(name)
+    app.dependency_overrides[connect_to_db] = lambda: MockDB()
+    coalesced = single_flights['get_images'].coalesced
+
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            responses = await asyncio.gather(*[client.get(f"/image_groups/{get_group_id}") for _ in range(5)])
+            stats = (await client.get("/stats/single_flight")).json()
+    finally:
+        app.dependency_overrides.clear()
+
+    assert all(response.status_code == HTTPStatus.OK for response in responses)
+    assert all(response.content == responses[0].content for response in responses)
+    assert groups.calls == 1, "Concurrent requests should share one aggregation"
+    assert single_flights['get_images'].coalesced - coalesced == 4
+    assert stats['get_images']['coalesced'] >= 4
@@ -0,0 +1,123 @@
+from unittest.mock import MagicMock, AsyncMock
+from datetime import datetime, timedelta
+from http import HTTPStatus
+import json
+import pytest
+from mongomock import MongoClient
+from bson import ObjectId
+
+from app.main import app, setup_s3_handler
+from app.db import connect_to_db
+from app import status, processing
+from tests.test_main import make_s3_event
+
+group_id = ObjectId('dddddddddddddddddddddd01')
+
+def make_db(statuses):
+    db = MongoClient().db
+    db.image_groups.insert_one({'_id': group_id, 'name': 'status'})
+    for i, image_status in enumerate(statuses):
+        db.images.insert_one({'_id': ObjectId(), 'filename': f"{i}.jpg", 'group': group_id, 'data': {},
+                              'status': image_status, 'status_at': datetime(2025, 1, 1, 0, 0, i)})
+    return db
+
+def test_set_status():
+    db = make_db([status.PENDING])
+    query = {'filename': '0.jpg'}
+    status.set_status(db.images, query, status.FAILED, 'broken')
+    assert db.images.find_one(query)['status_error'] == 'broken'
+    status.set_status(db.images, query, status.METADATA)
+    image = db.images.find_one(query)
+    assert image['status'] == status.METADATA and 'status_error' not in image
+    assert image['status_at'] > datetime(2025, 1, 1)
+
+def test_changes_since():
+    db = make_db([status.DONE, status.RENDITIONS, status.PENDING])
+    assert len(status.changes_since(db, group_id)) == 3
+    changes = status.changes_since(db, group_id, datetime(2025, 1, 1, 0, 0, 0))
+    assert [image['filename'] for image in changes] == ['1.jpg', '2.jpg']
+    assert status.count_in_progress(db, group_id) == 2
+
+def test_changes_in_the_same_millisecond():
+    db = make_db([status.DONE, status.PENDING])
+    changes = status.changes_since(db, group_id)
+    since, seen = status.advance(None, None, changes)
+    assert since == datetime(2025, 1, 1, 0, 0, 1) and len(seen) == 1
+    assert status.changes_since(db, group_id, since, seen) == []
+
+    # another image changes in the same millisecond as the last change the client got
+    db.images.insert_one({'_id': ObjectId(), 'filename': 'late.jpg', 'group': group_id, 'status': status.METADATA, 'status_at': since})
+    changes = status.changes_since(db, group_id, since, seen)
+    assert [image['filename'] for image in changes] == ['late.jpg']
+    since, seen = status.advance(since, seen, changes)
+    assert len(seen) == 2 and status.changes_since(db, group_id, since, seen) == []
+    assert status.decode_cursor(status.encode_cursor(since, seen)) == (since, seen)
+
+def test_get_group_status_cursor(client):
+    db = make_db([status.DONE, status.PENDING])
+    app.dependency_overrides[connect_to_db] = lambda: db
+    body = client.get(f"/image_groups/{group_id}/status").json()
+    db.images.insert_one({'_id': ObjectId(), 'filename': 'late.jpg', 'group': group_id, 'status': status.METADATA,
+                          'status_at': datetime(2025, 1, 1, 0, 0, 1)})
+    response = client.get(f"/image_groups/{group_id}/status", params={'cursor': body['cursor'], 'timeout': 0.1})
+    assert [change['filename'] for change in response.json()['changes']] == ['late.jpg']
+    response = client.get(f"/image_groups/{group_id}/status", params={'cursor': response.json()['cursor'], 'timeout': 0.1})
+    assert response.json()['changes'] == []
+    assert client.get(f"/image_groups/{group_id}/status", params={'cursor': 'nope'}).status_code == HTTPStatus.BAD_REQUEST
+
+def test_get_group_status(client, mock_s3_handler):
+    db = make_db([status.DONE, status.PENDING])
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+
+    response = client.get(f"/image_groups/{group_id}/status")
+    assert response.status_code == HTTPStatus.OK
+    body = response.json()
+    assert [change['status'] for change in body['changes']] == [status.DONE, status.PENDING]
+    assert body['in_progress'] == 1
+
+    # nothing changed since, the long-poll waits for the timeout and returns no changes
+    response = client.get(f"/image_groups/{group_id}/status", params={'since': body['since'], 'timeout': 0.1})
+    assert response.json()['changes'] == [] and response.json()['since'] == body['since']
+
+    # the image is processed
+    db.images.update_one({'filename': '1.jpg'}, {'$set': status.status_fields(status.DONE)})
+    response = client.get(f"/image_groups/{group_id}/status", params={'since': body['since'], 'timeout': 0.1})
+    assert [change['filename'] for change in response.json()['changes']] == ['1.jpg']
+    assert response.json()['in_progress'] == 0
+
+def test_stream_group_status(client):
+    db = make_db([status.DONE, status.FAILED])
+    app.dependency_overrides[connect_to_db] = lambda: db
+
+    response = client.get(f"/image_groups/{group_id}/status/stream")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = [event for event in response.text.split('\n\n') if event]
+    assert [json.loads(event.split('data: ')[1])['filename'] for event in events[:2]] == ['0.jpg', '1.jpg']
+    assert events[-1].startswith('event: done'), "Stream should end when nothing is in progress"
+
+@pytest.mark.asyncio
+async def test_processing_sets_status(get_group_id, generate_mock_mongodb_image_groups_initialized, mock_s3_handler, mocker):
+    db = next(generate_mock_mongodb_image_groups_initialized())
+    s3 = mock_s3_handler()
+    mocker.patch('app.processing.get_db', lambda: db)
+    mocker.patch('app.processing.get_s3_handler', lambda: s3)
+
+    await processing.process_s3_image(make_s3_event(get_group_id, 'img1.jpg'), MagicMock())
+    assert db.images.find_one({'filename': 'img1.jpg'})['status'] == status.DONE
+    assert s3.process_image.call_args.kwargs['on_stage'] is not None
+
+    s3.process_image = AsyncMock(side_effect=RuntimeError('corrupt image'))
+    with pytest.raises(RuntimeError):
+        await processing.process_s3_image(make_s3_event(get_group_id, 'img1.jpg'), MagicMock())
+    image = db.images.find_one({'filename': 'img1.jpg'})
+    assert image['status'] == status.FAILED and image['status_error'] == 'corrupt image'
+
+def test_upload_sets_pending(client, mock_mongodb_image_groups_initialized, mock_s3_handler, get_group_id):
+    db = mock_mongodb_image_groups_initialized()
+    app.dependency_overrides[connect_to_db] = lambda: db
+    app.dependency_overrides[setup_s3_handler] = mock_s3_handler
+
+    client.post(f"/images/{get_group_id}", json={'images': ['new.jpg']})
+    assert db.get_collection('images').find_one({'filename': 'new.jpg'})['status'] == status.PENDING
@@ -0,0 +1,99 @@
+from unittest.mock import MagicMock
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from mongomock import MongoClient
+from bson import ObjectId
+
+from app.main import app
+from app.db import connect_to_db
+from app import timeline
+from app.indexes import ensure_indexes
+
+group_id = ObjectId('cccccccccccccccccccccc01')
+group2_id = ObjectId('cccccccccccccccccccccc02')
+event_id = ObjectId('eeeeeeeeeeeeeeeeeeeeee01')
+
+def make_image(filename, taken, group=group_id):
+    return {'_id': ObjectId(), 'filename': filename, 'data': {'DateTimeOriginal': taken}, 'group': group}
+
+start = datetime(2025, 6, 1, 12)
+images = [make_image(f"{i}.jpg", start + timedelta(minutes=i // 2)) for i in range(7)] # pairs taken at the same time
+images.append(make_image('other.jpg', start, group2_id))
+images.append({'_id': ObjectId(), 'filename': 'pending.jpg', 'group': group_id}) # not processed yet
+
+def make_db():
+    db = MongoClient().db
+    db.image_groups.insert_many([{'_id': group_id, 'event': event_id}, {'_id': group2_id}])
+    db.images.insert_many([dict(image) for image in images])
+    return db
+
+def test_range_query():
+    assert timeline.range_query() == {'data.DateTimeOriginal': {'$exists': True}}
+    assert timeline.range_query(start, start + timedelta(hours=1)) == {
+        'data.DateTimeOriginal': {'$exists': True, '$gte': start, '$lt': start + timedelta(hours=1)}
+    }
+
+def test_cursor_round_trip():
+    cursor = timeline.encode_cursor(images[0])
+    assert timeline.decode_cursor(cursor) == (images[0]['data']['DateTimeOriginal'], images[0]['_id'])
+
+def test_find_page_covers_all_images():
+    db = make_db()
+    for descending in [False, True]:
+        seen = []
+        after = None
+        while True:
+            page, after = timeline.find_page(db.images, {'group': group_id, **timeline.range_query()}, 2, after, descending)
+            seen += page
+            if after is None:
+                break
+        expected = sorted(images[:7], key=lambda image: (image['data']['DateTimeOriginal'], image['_id']), reverse=descending)
+        assert [image['_id'] for image in seen] == [image['_id'] for image in expected], "Pages should cover every image once in order"
+
+def test_histogram_pipeline():
+    pipeline = timeline.histogram_pipeline({'group': group_id}, 'minute', 5)
+    assert pipeline[0] == {'$match': {'group': group_id}}
+    assert pipeline[1]['$group']['_id'] == {'$dateTrunc': {'date': '$data.DateTimeOriginal', 'unit': 'minute', 'binSize': 5}}
+
+def test_ensure_indexes():
+    db = MongoClient().db
+    ensure_indexes(db)
+    assert {'taken', 'group_taken'} <= set(db.images.index_information())
+
+def test_get_timeline_images(client):
+    db = make_db()
+    app.dependency_overrides[connect_to_db] = lambda: db
+
+    response = client.get("/timeline/images", params={'event': str(event_id), 'limit': 4, 'order': 'desc'})
+    assert response.status_code == HTTPStatus.OK
+    page = response.json()
+    assert [image['filename'] for image in page['images']][:1] == ['6.jpg']
+    assert len(page['images']) == 4 and page['next']
+
+    response = client.get("/timeline/images", params={'event': str(event_id), 'limit': 4, 'order': 'desc', 'after': page['next']})
+    page = response.json()
+    assert len(page['images']) == 3 and 'next' not in page
+
+    response = client.get("/timeline/images", params={'start': '2025-06-01T12:01:00', 'end': '2025-06-01T12:02:00'})
+    assert sorted(image['filename'] for image in response.json()['images']) == ['2.jpg', '3.jpg']
+
+def test_get_timeline_images_invalid(client):
+    app.dependency_overrides[connect_to_db] = make_db
+    assert client.get("/timeline/images", params={'after': 'not a cursor'}).status_code == HTTPStatus.BAD_REQUEST
+    assert client.get("/timeline/images", params={'order': 'sideways'}).status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+def test_get_timeline_histogram(client):
+    # mongomock doesn't support $dateTrunc
+    db = make_db()
+    images_collection = MagicMock()
+    images_collection.aggregate.return_value = [{'start': start, 'count': 3}]
+    class MockDB:
+        def get_collection(self, name):
+            return images_collection if name == 'images' else db.get_collection(name)
+    app.dependency_overrides[connect_to_db] = lambda: MockDB()
+
+    response = client.get("/timeline/histogram", params={'group': str(group_id), 'unit': 'day'})
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == [{'start': '2025-06-01T12:00:00', 'count': 3}]
+    pipeline = images_collection.aggregate.call_args[0][0]
+    assert pipeline == timeline.histogram_pipeline({'group': group_id, **timeline.range_query()}, 'day', 1)
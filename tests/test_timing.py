@@ -0,0 +1,38 @@
+from app.timing import StageTimer, peak_rss_mb
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+    def __call__(self):
+        return self.time
+
+def test_stage_timer():
+    clock = FakeClock()
+    timer = StageTimer(clock)
+    with timer.stage('resize'):
+        clock.time += 0.5
+    with timer.stage('encode'):
+        clock.time += 0.25
+    with timer.stage('resize'): # stages that run again add up
+        clock.time += 0.5
+    timer.add_bytes('uploaded', 100)
+    timer.add_bytes('uploaded', 50)
+
+    result = timer.result()
+    assert result['stages_ms'] == {'resize': 1000.0, 'encode': 250.0}
+    assert result['total_ms'] == 1250.0
+    assert result['bytes'] == {'uploaded': 150}
+
+def test_stage_timer_records_failed_stage():
+    clock = FakeClock()
+    timer = StageTimer(clock)
+    try:
+        with timer.stage('decode'):
+            clock.time += 0.1
+            raise ValueError('corrupt')
+    except ValueError:
+        pass
+    assert timer.result()['stages_ms'] == {'decode': 100.0}
+
+def test_peak_rss_mb():
+    assert peak_rss_mb() > 0